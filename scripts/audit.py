@@ -0,0 +1,344 @@
+import os
+import re
+import sys
+import json
+import time
+import math
+import argparse
+from psycopg2 import sql
+
+from provision import (CONFIG_DIR, PLAN_CACHE_FILE, connect, resolve_config_val, parse_identifier, load_tasks,
+                       get_relation_columns, job_adaptive_settings, range_job_window, keyset_scan_sql, range_scan_sql)
+
+# ==========================================
+# تنظیمات سراسری
+# ==========================================
+AUDIT_TIMEOUT = int(os.environ.get('AUDIT_TIMEOUT', '60'))
+AUDIT_SECTIONS = ['tables', 'views', 'materialized_views', 'period_snapshots', 'incremental_jobs', 'custom_functions']
+
+# عملیات محلی فقط وقتی گزارش می‌شوند که زیر آن‌ها اسکن خارجی باشد (روی داده‌ی منتقل‌شده اجرا شوند)
+LOCAL_NODE_KINDS = {
+    'Hash Join': 'join', 'Merge Join': 'join', 'Nested Loop': 'join',
+    'Aggregate': 'aggregate', 'Group': 'aggregate', 'WindowAgg': 'aggregate',
+    'Sort': 'sort', 'Incremental Sort': 'sort',
+    'Limit': 'limit',
+}
+REMOTE_SQL_KEYS = ('Remote SQL', 'Remote query', 'Remote Query')
+REMOTE_CLAUSES = [
+    ('qual', re.compile(r'\bWHERE\b', re.I)),
+    ('join', re.compile(r'\bJOIN\b', re.I)),
+    ('aggregate', re.compile(r'\bGROUP\s+BY\b|\b(count|count_big|sum|min|max|avg)\s*\(', re.I)),
+    ('sort', re.compile(r'\bORDER\s+BY\b', re.I)),
+    ('limit', re.compile(r'\bLIMIT\b|\bTOP\s*\(?\d', re.I)),
+]
+
+# ==========================================
+# ساخت کوئری نمونه برای هر شیء
+# ==========================================
+
+def collect_sections(data, context_vars):
+    sections = {}
+    for cfg in data['configs']:
+        for section in AUDIT_SECTIONS:
+            for entry in cfg.get(section, []):
+                sections.setdefault(section, {}).setdefault(resolve_config_val(entry['name'], context_vars), entry)
+    return sections
+
+def audit_calls(entry):
+    # audit_args: یک نگاشت یا فهرستی از نگاشت‌ها ({p_persianyear: 1403})؛ هر نگاشت یک فراخوانی نمونه است
+    calls = entry.get('audit_args') or [{}]
+    return calls if isinstance(calls, list) else [calls]
+
+def function_queries(func_name, func, context_vars):
+    # کوئری توابع Generated همان متنی است که بدنه‌ی تابع با آرگومان‌های غیر NULL می‌سازد
+    queries = []
+    for i, call in enumerate(audit_calls(func)):
+        label = f"{func_name}#{i + 1}" if len(audit_calls(func)) > 1 else func_name
+        if 'target_table' not in func:
+            # بدنه‌ی توابع ساختاریافته/خام قابل بازسازی نیست؛ فقط با audit_args خود فراخوانی EXPLAIN می‌شود
+            # (توابع sql ساده Inline می‌شوند)
+            if 'audit_args' not in func: break
+            args = [sql.SQL("{} => %s").format(sql.Identifier(k)) for k in call]
+            queries.append((label, 'function', sql.SQL("SELECT * FROM {}({})").format(
+                parse_identifier(func_name), sql.SQL(', ').join(args)), list(call.values())))
+            continue
+        target = resolve_config_val(func['target_table'], context_vars)
+        select_sql = ", ".join(f"{rc['expression']} AS {rc['name']}" for rc in func.get('return_columns', []))
+        where, params = ["TRUE"], []
+        for fc in func.get('filter_columns', []):
+            value = call.get(f"p_{fc['name']}")
+            if value is None: continue
+            where.append(f"{fc['name']} {fc.get('filter_type', '=')} %s")
+            params.append(value)
+        queries.append((label, 'function', sql.SQL(f"SELECT {select_sql} FROM {target} WHERE {' AND '.join(where)}"), params))
+    return queries
+
+def job_window(cur, func_name, adaptive, size, max_window, p_limit):
+    # همان انتخاب پنجره‌ی تابع: p_limit صریح، در حالت تطبیقی next_window از job_batch_state، سپس محدودسازی
+    if not adaptive:
+        return min(p_limit if p_limit is not None else size, max_window)
+    window = p_limit
+    if window is None:
+        try:
+            cur.execute("SELECT next_window FROM job_batch_state WHERE job_name = %s", (func_name,))
+            row = cur.fetchone()
+        except Exception:
+            # جدول هنوز ساخته نشده (provision اجرا نشده)؛ تابع هم از اندازه‌ی پیش‌فرض شروع می‌کند
+            row = None
+        cur.connection.rollback()
+        window = row[0] if row else None
+    return min(max(float(window if window is not None else size), adaptive['min']), adaptive['max'])
+
+def job_queries(cur, func_name, job, context_vars, table_columns):
+    # متن اسکن با همان سازنده‌های provision.py ساخته می‌شود تا تغییر در تولید تابع در ممیزی دیده شود
+    # (range: پنجره‌ی کلید، در حالت تطبیقی پنجره‌ی فعلی job_batch_state؛ keyset: ORDER BY + LIMIT در زیرکوئری)
+    queries = []
+    target = resolve_config_val(job['target_table'], context_vars)
+    key = job['key_column']
+    key_type = job['key_type'].lower()
+    time_key = 'time' in key_type or 'date' in key_type
+    mode = job.get('mode', 'range')
+    if mode == 'keyset':
+        columns = table_columns.get(target) or get_relation_columns(cur, target)
+        cur.connection.rollback()
+        # provision.py این Job را نمی‌سازد؛ چیزی برای ممیزی نیست
+        if not columns: return []
+        batch_size = job.get('batch_size', 1000)
+        max_limit = job.get('max_limit', batch_size * 10)
+        adaptive = job_adaptive_settings(job, func_name, 1, max_limit)
+    else:
+        try:
+            window = range_job_window(job, func_name)
+        except ValueError:
+            return []
+        adaptive = window['adaptive']
+    for i, call in enumerate(audit_calls(job)):
+        label = f"{func_name}#{i + 1}" if len(audit_calls(job)) > 1 else func_name
+        last = call.get(f"p_last_{key}", '1900-01-01 00:00:00' if time_key else 0)
+        filters, params = [], []
+        for fc in job.get('filter_columns', []):
+            value = call.get(f"p_{fc['name']}")
+            if value is None: continue
+            filters.append(f" AND {fc['name']} = %s")
+            params.append(value)
+        if mode == 'keyset':
+            limit = math.ceil(job_window(cur, func_name, adaptive, batch_size, max_limit, call.get('p_limit')))
+            query = keyset_scan_sql(target, key, columns, ''.join(filters), last='%s', limit='%s')
+            queries.append((label, 'job', sql.SQL(query), [last] + params + [limit]))
+            continue
+        size = job_window(cur, func_name, adaptive, window['size'], window['max'], call.get('p_limit'))
+        if window['unit'] is None:
+            end = int(last) + max(math.floor(size + 0.5), 1)
+        else:
+            # تابع مرز را با quote_literal (لیترال بدون نوع) در متن کوئری می‌گذارد
+            cur.execute(f"SELECT (%s::{job['key_type']} + %s * INTERVAL '1 {window['unit']}')::text", (last, size))
+            end = cur.fetchone()[0]
+            cur.connection.rollback()
+        query = range_scan_sql(target, key, '%s', '%s') + ''.join(filters)
+        queries.append((label, 'job', sql.SQL(query), [last, end] + params))
+    return queries
+
+def audit_targets(cur, sections, context_vars):
+    targets = []
+    for name, tbl in sections.get('tables', {}).items():
+        if tbl.get('type') == 'query':
+            targets.append((name, 'query_table', sql.SQL("SELECT * FROM {}").format(parse_identifier(name)), []))
+    for name in sections.get('views', {}):
+        targets.append((name, 'view', sql.SQL("SELECT * FROM {}").format(parse_identifier(name)), []))
+    for snap in sections.get('period_snapshots', {}).values():
+        view = resolve_config_val(snap['view'], context_vars)
+        targets.append((view, 'view', sql.SQL("SELECT * FROM {}").format(parse_identifier(view)), []))
+    # کوئری تعریف Materialized View همان چیزی است که در هر REFRESH از سرور راه دور خوانده می‌شود
+    for name, mv in sections.get('materialized_views', {}).items():
+        targets.append((name, 'materialized_view', sql.SQL(resolve_config_val(mv['sql'], context_vars)), []))
+    table_columns = {name: tbl.get('columns', []) for name, tbl in sections.get('tables', {}).items()}
+    for name, job in sections.get('incremental_jobs', {}).items():
+        targets += job_queries(cur, name, job, context_vars, table_columns)
+    for name, func in sections.get('custom_functions', {}).items():
+        targets += function_queries(name, func, context_vars)
+    return targets
+
+# ==========================================
+# تحلیل پلن (Push Down در برابر اجرای محلی)
+# ==========================================
+
+def analyze_node(node, report):
+    # خروجی: آیا زیر این گره اسکن خارجی وجود دارد
+    children = [analyze_node(child, report) for child in node.get('Plans', [])]
+    if node['Node Type'] == 'Foreign Scan':
+        remote_sql = next((node[k] for k in REMOTE_SQL_KEYS if k in node), '')
+        relation = node.get('Relations') or '.'.join(p for p in (node.get('Schema'), node.get('Relation Name')) if p)
+        scan = {
+            'relation': relation,
+            'rows': node.get('Plan Rows', 0),
+            'width': node.get('Plan Width', 0),
+            'remote_sql': remote_sql,
+            'local_filter': node.get('Filter'),
+        }
+        report['foreign_scans'].append(scan)
+        report['remote'].update(kind for kind, pattern in REMOTE_CLAUSES if pattern.search(remote_sql))
+        if ' JOIN ' in relation.upper(): report['remote'].add('join')
+        if relation.startswith('Aggregate on'): report['remote'].add('aggregate')
+        if scan['local_filter']:
+            report['local'].append(f"filter on {relation}: {scan['local_filter']}")
+        if not remote_sql:
+            # بدون متن کوئری راه دور درباره‌ی Push Down این اسکن ادعایی نمی‌شود
+            report['notes'].append(f"no remote query text for {relation}")
+        return True
+    below_foreign = any(children)
+    kind = LOCAL_NODE_KINDS.get(node['Node Type'])
+    if below_foreign and kind:
+        detail = node.get('Sort Key') or node.get('Group Key') or node.get('Hash Cond') or node.get('Join Filter') or ''
+        report['local'].append(f"{kind} ({node['Node Type']}){': ' + str(detail) if detail else ''}")
+    if below_foreign and node.get('Filter') and node['Node Type'] != 'Foreign Scan':
+        report['local'].append(f"filter ({node['Node Type']}): {node['Filter']}")
+    return below_foreign
+
+def explain_target(cur, database, target):
+    name, kind, query, params = target
+    report = {'database': database, 'name': name, 'kind': kind, 'remote': set(), 'local': [],
+              'foreign_scans': [], 'notes': []}
+    statement = sql.SQL("EXPLAIN (VERBOSE, FORMAT JSON) {}").format(query)
+    params = params or None
+    report['query'] = cur.mogrify(query, params).decode()
+    try:
+        cur.execute(statement, params)
+        plan = cur.fetchone()[0][0]['Plan']
+    except Exception as e:
+        cur.connection.rollback()
+        report['error'] = str(e).strip().splitlines()[0]
+        report['remote'] = []
+        return report
+    cur.connection.rollback()
+    analyze_node(plan, report)
+    report['remote'] = sorted(report['remote'])
+    report['local_kinds'] = sorted({line.split(' ', 1)[0] for line in report['local']})
+    report['rows_transferred'] = sum(s['rows'] for s in report['foreign_scans'])
+    report['bytes_transferred'] = sum(s['rows'] * s['width'] for s in report['foreign_scans'])
+    report['total_cost'] = plan.get('Total Cost')
+    # اسکن خارجی بدون شرط، Join یا تجمیع راه دور = خواندن کل جدول راه دور
+    report['full_remote_scans'] = [s['relation'] for s in report['foreign_scans']
+                                   if not any(p.search(s['remote_sql']) for k, p in REMOTE_CLAUSES if k != 'sort')
+                                   and s['remote_sql']]
+    return report
+
+def print_report(report):
+    label = f"{report['database']}:{report['name']} [{report['kind']}]"
+    if 'error' in report:
+        print(f"   ❌ {label}: {report['error']}")
+        return
+    if not report['foreign_scans']:
+        print(f"   ⚪ {label}: local only")
+        return
+    icon = "⚠️ " if report['local'] or report['full_remote_scans'] else "✅"
+    print(f"   {icon} {label}: ~{report['rows_transferred']:.0f} rows / {report['bytes_transferred'] / 1024:.0f} KiB transferred")
+    print(f"      remote: {', '.join(report['remote']) or '-'}")
+    for line in report['local']:
+        print(f"      local:  {line}")
+    for relation in report['full_remote_scans']:
+        print(f"      full remote scan: {relation}")
+    for note in report['notes']:
+        print(f"      note: {note}")
+
+# ==========================================
+# مقایسه با Baseline
+# ==========================================
+
+def report_key(report):
+    return f"{report['database']}:{report['name']}"
+
+def compare_with_baseline(reports, baseline_path, tolerance):
+    with open(baseline_path, 'r') as f:
+        baseline = {report_key(r): r for r in json.load(f)['objects']}
+    regressions = []
+    for r in reports:
+        if r['kind'] == 'database':
+            regressions.append(f"{report_key(r)}: not audited ({r['error']})")
+            continue
+        base = baseline.get(report_key(r))
+        if not base: continue
+        if 'error' in r and 'error' not in base:
+            regressions.append(f"{report_key(r)}: EXPLAIN now fails ({r['error']})")
+            continue
+        if 'error' in r or 'error' in base: continue
+        lost = sorted(set(base['remote']) - set(r['remote']))
+        if lost:
+            regressions.append(f"{report_key(r)}: no longer pushed down: {', '.join(lost)}")
+        gained = sorted(set(r['local_kinds']) - set(base['local_kinds']))
+        if gained:
+            regressions.append(f"{report_key(r)}: now runs locally: {', '.join(gained)}")
+        new_full = sorted(set(r['full_remote_scans']) - set(base['full_remote_scans']))
+        if new_full:
+            regressions.append(f"{report_key(r)}: new full remote scan of {', '.join(new_full)}")
+        base_rows, rows = base['rows_transferred'], r['rows_transferred']
+        if rows > max(base_rows, 1) * (1 + tolerance):
+            regressions.append(f"{report_key(r)}: estimated transfer {base_rows:.0f} -> {rows:.0f} rows")
+    return regressions
+
+# ==========================================
+# اجرای اصلی
+# ==========================================
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="provision.py audit",
+                                     description="EXPLAIN every configured view, function and job and report what reaches the remote server")
+    parser.add_argument('--config-dir', default=CONFIG_DIR, help="domain configs directory (env: GATEWAY_CONFIG_DIR)")
+    parser.add_argument('--plan-cache', default=PLAN_CACHE_FILE, help="compiled config cache (env: PROVISION_PLAN_CACHE)")
+    parser.add_argument('--no-cache', action='store_true', help="ignore and do not write the compiled config cache")
+    parser.add_argument('--database', action='append', help="audit only this database (repeatable)")
+    parser.add_argument('--timeout', type=int, default=AUDIT_TIMEOUT,
+                        help="statement_timeout in seconds for each EXPLAIN (env: AUDIT_TIMEOUT)")
+    parser.add_argument('--output', default='audit.json', help="JSON report file")
+    parser.add_argument('--baseline', help="previous report; exit 1 when an object regresses")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="allowed relative growth of estimated rows transferred")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("🚀 Starting Pushdown Audit...")
+    _, tasks = load_tasks(args)
+    reports = []
+    for db_name, data, context_vars in tasks:
+        if args.database and db_name not in args.database: continue
+        try:
+            conn = connect(db_name)
+        except Exception as e:
+            print(f"\n   {'='*15} DATABASE: {db_name} {'='*15}")
+            # پایگاهی که ممیزی نشده نباید بی‌صدا از گزارش حذف شود؛ به عنوان شکست (و Regression) ثبت می‌شود
+            report = {'database': db_name, 'name': '*', 'kind': 'database', 'remote': [], 'local': [],
+                      'full_remote_scans': [], 'notes': [], 'error': f"connection failed: {str(e).strip().splitlines()[0]}"}
+            print_report(report)
+            reports.append(report)
+            continue
+        conn.autocommit = False
+        cur = conn.cursor()
+        # کوئری Jobها به ستون‌های جدول و پنجره‌ی فعلی job_batch_state در همین پایگاه نیاز دارد
+        targets = audit_targets(cur, collect_sections(data, context_vars), context_vars)
+        print(f"\n   {'='*15} DATABASE: {db_name} ({len(targets)} objects) {'='*15}")
+        for target in targets:
+            # EXPLAIN با row_estimate_method=execute کوئری را روی SQL Server اجرا می‌کند؛ timeout مانع گیر کردن ممیزی است
+            cur.execute("SET statement_timeout = %s", (args.timeout * 1000,))
+            report = explain_target(cur, db_name, target)
+            print_report(report)
+            reports.append(report)
+        conn.close()
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'config_dir': str(args.config_dir)},
+                   'objects': reports}, f, indent=2, default=str)
+    flagged = sum(1 for r in reports if r.get('local') or r.get('full_remote_scans') or 'error' in r)
+    unreachable = [r['database'] for r in reports if r['kind'] == 'database']
+    print(f"\n🧾 {len(reports) - len(unreachable)} object(s) audited, {flagged} flagged; report written to {args.output}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(reports, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"   ❌ Regression {line}")
+        if regressions: sys.exit(1)
+        print(f"   ✅ No regressions against {args.baseline}")
+    if unreachable:
+        print(f"   ❌ Could not connect to: {', '.join(unreachable)}")
+        sys.exit(1)
+    print("\n🎉 AUDIT COMPLETED.")
+
+if __name__ == "__main__": main()
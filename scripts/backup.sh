@@ -1,27 +1,158 @@
 #!/bin/bash
 
+# ==========================================
+# تنظیمات
+# ==========================================
+# مسیر نسبی BACKUP_DIR مانند docker-compose زیر /app ماونت شده است (cron دایرکتوری جاری ندارد)
+BACKUP_ROOT="${BACKUP_DIR:-backups}"
+[[ "${BACKUP_ROOT}" = /* ]] || BACKUP_ROOT="/app/${BACKUP_ROOT}"
+BACKUP_RETENTION_DAYS="${BACKUP_RETENTION_DAYS:-7}"
+# تعداد دیتابیس‌هایی که هم‌زمان dump می‌شوند و تعداد Worker هر pg_dump (-j)
+BACKUP_PARALLEL_DBS="${BACKUP_PARALLEL_DBS:-2}"
+BACKUP_JOBS="${BACKUP_JOBS:-4}"
+# کدک فشرده‌سازی pg_dump: zstd:3 | lz4 | gzip:6 | none
+BACKUP_COMPRESSION="${BACKUP_COMPRESSION:-zstd:3}"
+# الگوی LIKE دیتابیس‌هایی که بکاپ نمی‌گیرند (دیتابیس‌های benchmark.py)
+BACKUP_EXCLUDE="${BACKUP_EXCLUDE:-bench\_%}"
+# restore: بازیابی آزمایشی هر dump در دیتابیس موقت | list: فقط خواندن فهرست آرشیو | none
+BACKUP_VERIFY="${BACKUP_VERIFY:-restore}"
+
 TIMESTAMP=$(date +%Y%m%d_%H%M%S)
-BACKUP_FILE="${BACKUP_DIR}/full_backup_${TIMESTAMP}.dump"
+RUN_DIR="${BACKUP_ROOT}/${TIMESTAMP}"
+MANIFEST="${RUN_DIR}/manifest.tsv"
+
+export PGHOST=localhost PGUSER="${POSTGRES_USER}" PGPASSWORD="${POSTGRES_PASSWORD}"
+export PGOPTIONS="-c client_min_messages=warning"
+
+psql_admin() {
+  psql -X -q -At -d "${POSTGRES_DB}" "$@"
+}
+
+# ==========================================
+# کشف دیتابیس‌ها و نوع بکاپ
+# ==========================================
+# همه‌ی دیتابیس‌های ساخته‌شده توسط process_single_database (brc_db، biiling_26_db، ...) به علاوه‌ی POSTGRES_DB
+discover_databases() {
+  psql_admin -v exclude="${BACKUP_EXCLUDE}" <<'SQL'
+SELECT datname FROM pg_database
+WHERE datallowconn AND NOT datistemplate AND datname <> 'postgres'
+  AND datname NOT LIKE :'exclude'
+ORDER BY datname;
+SQL
+}
+
+# جداول زیرساختی خود Gateway در public که هر دیتابیس Provision‌شده دارد و provision.py دوباره پر می‌کند
+# (auth_policies از کانفیگ، اثرانگشت‌ها، پنجره‌ی تطبیقی Jobها، لاگ حلقوی و دفترچه‌ی Mirror/Snapshot)؛
+# داده‌ی واقعی محلی (جداول Mirror، پارتیشن‌های Snapshot، Materialized View و function_result_cache) در این فهرست نیست
+GATEWAY_INFRA_TABLES="provision_fingerprints auth_policies job_batch_state function_call_log mirror_state period_snapshots period_snapshot_periods"
+
+# دیتابیسی که جز جداول زیرساختی بالا هیچ جدول/Materialized View ماندگار ندارد (فقط جداول خارجی، ویو و تابع) schema-only است؛
+# Mirror و Snapshot جدول ماندگار خودشان را دارند و دیتابیس را full می‌کنند. POSTGRES_DB (provision_runs و ...) همیشه کامل dump می‌شود
+backup_mode() {
+  local has_data
+  if [ "$1" = "${POSTGRES_DB}" ]; then echo "full"; return; fi
+  has_data=$(psql -X -q -At -d "$1" -v infra="${GATEWAY_INFRA_TABLES}" <<'SQL'
+SELECT EXISTS (
+  SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+  WHERE c.relkind IN ('r', 'p', 'm') AND c.relpersistence = 'p' AND NOT c.relispartition
+    AND n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname NOT LIKE 'pg_toast%'
+    AND NOT (n.nspname = 'public' AND c.relname = ANY (string_to_array(:'infra', ' ')))
+);
+SQL
+)
+  [ "${has_data}" = "t" ] && echo "full" || echo "schema"
+}
+
+# ==========================================
+# Dump و بازیابی آزمایشی
+# ==========================================
+dump_database() {
+  local db="$1" mode started status
+  mode=$(backup_mode "${db}")
+  started=$(date +%s)
+  local args=(-d "${db}" -F d -j "${BACKUP_JOBS}" --compress="${BACKUP_COMPRESSION}" -f "${RUN_DIR}/${db}.dir")
+  # داده‌ی جداول خارجی هرگز dump نمی‌شود (بدون --include-foreign-data)؛ داده‌ی جداول UNLOGGED (لاگ حلقوی) هم لازم نیست
+  if [ "${mode}" = "schema" ]; then args+=(--schema-only); else args+=(--no-unlogged-table-data); fi
+  echo "📦 ${db}: ${mode} dump (${BACKUP_JOBS} jobs, ${BACKUP_COMPRESSION})..."
+  if pg_dump "${args[@]}" 2> "${RUN_DIR}/${db}.log"; then
+    status=ok
+    echo "✅ ${db}: $(du -sh "${RUN_DIR}/${db}.dir" | cut -f1) in $(( $(date +%s) - started ))s"
+  else
+    status=failed
+    echo "❌ ${db}: dump failed (see ${RUN_DIR}/${db}.log)"
+  fi
+  printf '%s\t%s\t%s\t%s\n' "${db}" "${mode}" "${status}" "$(( $(date +%s) - started ))" >> "${MANIFEST}"
+  [ "${status}" = ok ]
+}
+
+verify_database() {
+  local db="$1" scratch="backup_verify_${1}"
+  case "${BACKUP_VERIFY}" in
+    none) return 0 ;;
+    list)
+      pg_restore --list "${RUN_DIR}/${db}.dir" > /dev/null 2>> "${RUN_DIR}/${db}.log" \
+        && echo "🔎 ${db}: archive readable" && return 0
+      echo "❌ ${db}: archive unreadable"; return 1 ;;
+  esac
+  psql_admin -c "DROP DATABASE IF EXISTS \"${scratch}\" WITH (FORCE);" -c "CREATE DATABASE \"${scratch}\";" || return 1
+  local status=0
+  if pg_restore -d "${scratch}" -j "${BACKUP_JOBS}" --no-owner --exit-on-error "${RUN_DIR}/${db}.dir" 2>> "${RUN_DIR}/${db}.log"; then
+    echo "🔎 ${db}: verification restore succeeded"
+  else
+    echo "❌ ${db}: verification restore failed (see ${RUN_DIR}/${db}.log)"
+    status=1
+  fi
+  psql_admin -c "DROP DATABASE IF EXISTS \"${scratch}\" WITH (FORCE);"
+  return ${status}
+}
+
+# ==========================================
+# اجرا
+# ==========================================
+mkdir -p "${RUN_DIR}"
+printf 'database\tmode\tstatus\tseconds\n' > "${MANIFEST}"
+echo "📦 Starting backup to ${RUN_DIR}..."
+
+# نقش‌ها و رمزها برای بازیابی کامل روی سرور جدید
+pg_dumpall --globals-only -f "${RUN_DIR}/globals.sql" || echo "⚠️ Could not dump roles (globals.sql)"
+
+mapfile -t DATABASES < <(discover_databases)
+if [ ${#DATABASES[@]} -eq 0 ]; then
+  echo "❌ No databases found to back up!"
+  exit 1
+fi
+echo "🗂️  ${#DATABASES[@]} database(s): ${DATABASES[*]}"
 
-echo "📦 Starting backup to ${BACKUP_FILE}..."
+FAILED=0
+running=0
+for db in "${DATABASES[@]}"; do
+  dump_database "${db}" &
+  running=$((running + 1))
+  if [ "${running}" -ge "${BACKUP_PARALLEL_DBS}" ]; then
+    wait -n || FAILED=$((FAILED + 1))
+    running=$((running - 1))
+  fi
+done
+while [ "${running}" -gt 0 ]; do
+  wait -n || FAILED=$((FAILED + 1))
+  running=$((running - 1))
+done
 
-mkdir -p "${BACKUP_DIR}"
+# بازیابی آزمایشی پس از پایان همه‌ی dumpها اجرا می‌شود تا با پنجره‌ی بکاپ رقابت نکند
+for db in "${DATABASES[@]}"; do
+  awk -F'\t' -v db="${db}" '$1 == db && $3 == "ok" { found = 1 } END { exit !found }' "${MANIFEST}" || continue
+  verify_database "${db}" || FAILED=$((FAILED + 1))
+done
 
-# بکاپ از دیتابیس اصلی (gateway_db)
-PGPASSWORD="${POSTGRES_PASSWORD}" pg_dump \
-  -h localhost \
-  -U "${POSTGRES_USER}" \
-  -d "${POSTGRES_DB}" \
-  -F c \
-  -f "${BACKUP_FILE}"
+if [ "${FAILED}" -eq 0 ]; then
+  echo "✅ Backup successful: ${RUN_DIR}"
 
-if [ $? -eq 0 ]; then
-  echo "✅ Backup successful: ${BACKUP_FILE}"
-  
-  # پاکسازی فایل‌های قدیمی‌تر از retention days
+  # پاکسازی بکاپ‌های قدیمی‌تر از retention days (پوشه‌های اجرا و فایل‌های .dump قدیمی)
   echo "🧹 Cleaning backups older than ${BACKUP_RETENTION_DAYS} days..."
-  find "${BACKUP_DIR}" -type f -name "*.dump" -mtime +${BACKUP_RETENTION_DAYS} -delete
+  find "${BACKUP_ROOT}" -mindepth 1 -maxdepth 1 -type d -name '[0-9]*_[0-9]*' -mtime +"${BACKUP_RETENTION_DAYS}" -exec rm -rf {} +
+  find "${BACKUP_ROOT}" -maxdepth 1 -type f -name "*.dump" -mtime +"${BACKUP_RETENTION_DAYS}" -delete
   echo "✅ Cleanup completed."
 else
-  echo "❌ Backup failed!"
-fi
\ No newline at end of file
+  echo "❌ Backup failed for ${FAILED} step(s)! Old backups were kept. See ${MANIFEST}"
+  exit 1
+fi
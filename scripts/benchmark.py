@@ -0,0 +1,419 @@
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import resource
+import threading
+from itertools import combinations
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2 import sql
+
+from provision import (DB_ADMIN_USER, DB_ADMIN_PASS, DB_DEFAULT_NAME, connect, resolve_config_val,
+                       parse_identifier, collect_domain_databases, process_single_database, fetch_window_end)
+
+# ==========================================
+# تنظیمات سراسری
+# ==========================================
+BENCH_PREFIX = os.environ.get('BENCH_PREFIX', 'bench_')
+BENCH_SEED = 0.42
+
+# مقادیر مصنوعی برای ستون‌های شناخته‌شده‌ی صورت‌حساب؛ سایر ستون‌ها بر اساس نوع پر می‌شوند
+SEED_EXPRESSIONS = {
+    'persianyear': "1400 + g % 4",
+    'persianmonth': "1 + g % 12",
+    'telno': "21000000 + g",
+    'rowversion': "lpad(g::text, 16, '0')",
+}
+
+# ==========================================
+# منبع جایگزین محلی و داده‌ی مصنوعی
+# ==========================================
+
+def collect_sections(data, context_vars):
+    sections = {}
+    for cfg in data['configs']:
+        for section in ['tables', 'views', 'materialized_views', 'mirrors', 'incremental_jobs', 'custom_functions']:
+            for entry in cfg.get(section, []):
+                sections.setdefault(section, {}).setdefault(resolve_config_val(entry['name'], context_vars), entry)
+    return sections
+
+def column_expression(name, col_type, key_columns):
+    t = col_type.lower()
+    if name in key_columns: expr = "g"
+    elif name in SEED_EXPRESSIONS: expr = SEED_EXPRESSIONS[name]
+    elif 'bool' in t: expr = "g % 2 = 0"
+    elif 'int' in t or 'serial' in t: expr = "(random() * 1000)::int"
+    elif any(k in t for k in ('num', 'float', 'double', 'real', 'money')): expr = "round((random() * 100000)::numeric, 2)"
+    elif 'time' in t or 'date' in t: expr = "timestamp '2024-01-01' + g * interval '1 minute'"
+    else: expr = "md5(g::text)"
+    return f"({expr})::{col_type}"
+
+def table_key_columns(table_name, sections, context_vars):
+    keys = set()
+    for job in sections.get('incremental_jobs', {}).values():
+        if resolve_config_val(job['target_table'], context_vars) == table_name: keys.add(job['key_column'])
+    for mirror in sections.get('mirrors', {}).values():
+        if resolve_config_val(mirror['source'], context_vars) == table_name:
+            keys.update(mirror['primary_key'])
+    return keys
+
+def seed_source_database(source_db, sections, context_vars, rows_for, reseed):
+    conn_admin = connect(DB_DEFAULT_NAME)
+    cur = conn_admin.cursor()
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (source_db,))
+    exists = cur.fetchone() is not None
+    if exists and reseed:
+        cur.execute(sql.SQL("DROP DATABASE {} WITH (FORCE);").format(sql.Identifier(source_db)))
+        exists = False
+    if not exists:
+        cur.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(source_db)))
+    conn_admin.close()
+
+    conn = connect(source_db)
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS bench_seed (table_name TEXT PRIMARY KEY, row_count BIGINT)")
+    for tbl_name, tbl in sections.get('tables', {}).items():
+        if tbl.get('type') == 'import' or 'columns' not in tbl: continue
+        remote_schema = tbl.get('remote_schema', 'public')
+        remote_table = tbl.get('remote_table', tbl_name.split('.')[-1])
+        target = sql.Identifier(remote_schema, remote_table)
+        row_count = rows_for(tbl_name)
+        cur.execute("SELECT row_count FROM bench_seed WHERE table_name = %s", (tbl_name,))
+        seeded = cur.fetchone()
+        if seeded and seeded[0] == row_count:
+            print(f"   ♻️  {remote_schema}.{remote_table}: {row_count} rows already seeded")
+            continue
+
+        keys = table_key_columns(tbl_name, sections, context_vars)
+        started = time.monotonic()
+        cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {};").format(sql.Identifier(remote_schema)))
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(target))
+        cur.execute(sql.SQL("CREATE TABLE {} ({});").format(target, sql.SQL(', ').join(
+            [sql.SQL("{} {}").format(sql.Identifier(c['name']), sql.SQL(c['type'])) for c in tbl['columns']])))
+        # setseed در همان Session تضمین می‌کند داده در هر بار ساخت یکسان باشد
+        cur.execute("SELECT setseed(%s)", (BENCH_SEED,))
+        cur.execute(sql.SQL("INSERT INTO {} SELECT {} FROM generate_series(1, %s) g;").format(target, sql.SQL(', ').join(
+            [sql.SQL(column_expression(c['name'], c['type'], keys).replace('%', '%%')) for c in tbl['columns']])), (row_count,))
+        for key in sorted(keys):
+            cur.execute(sql.SQL("CREATE INDEX ON {} ({});").format(target, sql.Identifier(key)))
+        cur.execute(sql.SQL("ANALYZE {};").format(target))
+        cur.execute("INSERT INTO bench_seed VALUES (%s, %s) ON CONFLICT (table_name) DO UPDATE SET row_count = EXCLUDED.row_count",
+                    (tbl_name, row_count))
+        print(f"   🌱 {remote_schema}.{remote_table}: {row_count} rows in {time.monotonic() - started:.1f}s")
+    conn.close()
+
+def build_bench_data(data, source_db):
+    # سرورهای tds/mysql با postgres_fdw به منبع محلی جایگزین می‌شوند؛ گزینه‌های مخصوص tds و دسترسی کاربران حذف می‌شوند
+    data = copy.deepcopy(data)
+    for cfg in data['configs']:
+        cfg['fdws'] = [{'name': f['name'], 'type': 'postgres', 'host': 'localhost', 'port': 5432,
+                        'database': source_db, 'user': DB_ADMIN_USER, 'password': DB_ADMIN_PASS}
+                       for f in cfg.get('fdws', [])]
+        for tbl in cfg.get('tables', []):
+            tbl.pop('options', None)
+        for section in ['incremental_jobs', 'custom_functions']:
+            for entry in cfg.get(section, []):
+                entry['allowed_consumers'] = []
+        cfg.pop('database', None)
+    data['user_permissions'] = []
+    return data
+
+# ==========================================
+# اندازه‌گیری
+# ==========================================
+
+def percentile(values, q):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def summarize(name, group, latencies, rows, seconds, conn, extra=None):
+    cur = conn.cursor()
+    cur.execute("SELECT sum(total_bytes) FROM pg_backend_memory_contexts")
+    backend_bytes = cur.fetchone()[0] or 0
+    result = {
+        'name': name,
+        'group': group,
+        'calls': len(latencies),
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_sec': round(rows / seconds, 1) if seconds > 0 else None,
+        'latency_ms': {q: round(percentile(latencies, p) * 1000, 3) if latencies else None
+                       for q, p in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))},
+        'backend_memory_kb': int(backend_bytes) // 1024,
+        'client_maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    result.update(extra or {})
+    rps = f"{result['rows_per_sec']:.0f} rows/s" if result['rows_per_sec'] is not None else "-"
+    print(f"   ⏱️  {name}: {len(latencies)} calls, {rows} rows, p50 {result['latency_ms']['p50']} ms, "
+          f"p95 {result['latency_ms']['p95']} ms, {rps}")
+    return result
+
+def timed_fetch(cur, statement, params=None):
+    started = time.perf_counter()
+    cur.execute(statement, params)
+    rows = cur.fetchall()
+    return rows, time.perf_counter() - started
+
+def job_pass(conn, func_name, job, limit, filters, start_key, end_key, max_calls):
+    # پیمایش بازه‌ی کلید با تابع Job (حالت range: پنجره‌ی کلید، حالت keyset: ادامه از بیشینه‌ی کلید دریافتی)
+    key_column = job['key_column']
+    keyset = job.get('mode') == 'keyset'
+    cur = conn.cursor()
+    args = [sql.SQL("{} => %s").format(sql.Identifier(f"p_last_{key_column}")), sql.SQL("p_limit => %s")]
+    args += [sql.SQL("{} => %s").format(sql.Identifier(f"p_{k}")) for k in filters]
+    statement = sql.SQL("SELECT * FROM {}({})").format(parse_identifier(func_name), sql.SQL(', ').join(args))
+    latencies, total, last = [], 0, start_key
+    while last < end_key and len(latencies) < max_calls:
+        rows, seconds = timed_fetch(cur, statement, [last, limit] + list(filters.values()))
+        latencies.append(seconds)
+        total += len(rows)
+        if keyset:
+            if not rows: break
+            last = rows[-1][-1]
+        else:
+            # انتهای پنجره‌ی واقعی تابع (پس از محدودسازی با window.max یا حالت تطبیقی)، نه limit درخواستی
+            last = int(fetch_window_end(cur))
+    conn.rollback()
+    return latencies, total
+
+def key_bounds(conn, table_name, key_column):
+    cur = conn.cursor()
+    cur.execute(sql.SQL("SELECT min({0}), max({0}) FROM {1}").format(sql.Identifier(key_column), parse_identifier(table_name)))
+    low, high = cur.fetchone()
+    conn.rollback()
+    return (low - 1 if low is not None else 0), (high or 0)
+
+def sample_filter_values(conn, table_name, filter_columns):
+    cur = conn.cursor()
+    names = [fc['name'] for fc in filter_columns]
+    cur.execute(sql.SQL("SELECT {} FROM {} LIMIT 1").format(
+        sql.SQL(', ').join([sql.Identifier(n) for n in names]), parse_identifier(table_name)))
+    row = cur.fetchone()
+    conn.rollback()
+    return dict(zip(names, row)) if row else {}
+
+# ==========================================
+# سناریوها
+# ==========================================
+
+def scenario_batch_sweep(conn, sections, context_vars, args):
+    results = []
+    for func_name, job in sections.get('incremental_jobs', {}).items():
+        target = resolve_config_val(job['target_table'], context_vars)
+        low, high = key_bounds(conn, target, job['key_column'])
+        for size in args.batch_sizes:
+            latencies, total, started = [], 0, time.perf_counter()
+            for _ in range(args.repeat):
+                l, t = job_pass(conn, func_name, job, size, {}, low, high, args.max_calls)
+                latencies += l; total += t
+            results.append(summarize(f"{func_name}[batch={size}]", 'batch_sweep', latencies, total,
+                                     time.perf_counter() - started, conn, {'batch_size': size}))
+    return results
+
+def scenario_filters(conn, sections, context_vars, args):
+    # همه‌ی ترکیب‌های فیلتر (تا دو ستون) برای Jobها و توابع Generated؛ برای توابع کش‌دار حالت سرد و گرم جدا اندازه‌گیری می‌شود
+    results = []
+    for func_name, job in sections.get('incremental_jobs', {}).items():
+        filter_columns = job.get('filter_columns', [])
+        if not filter_columns: continue
+        target = resolve_config_val(job['target_table'], context_vars)
+        values = sample_filter_values(conn, target, filter_columns)
+        low, high = key_bounds(conn, target, job['key_column'])
+        size = job.get('batch_size', 1000)
+        for n in range(1, min(2, len(filter_columns)) + 1):
+            for combo in combinations(values, n):
+                filters = {k: values[k] for k in combo}
+                latencies, total, started = [], 0, time.perf_counter()
+                for _ in range(args.repeat):
+                    l, t = job_pass(conn, func_name, job, size, filters, low, high, args.max_calls)
+                    latencies += l; total += t
+                results.append(summarize(f"{func_name}[{'+'.join(combo)}]", 'filters', latencies, total,
+                                         time.perf_counter() - started, conn, {'filters': list(combo)}))
+
+    cur = conn.cursor()
+    for func_name, func in sections.get('custom_functions', {}).items():
+        if 'target_table' not in func: continue
+        target = resolve_config_val(func['target_table'], context_vars)
+        filter_columns = [fc for fc in func.get('filter_columns', []) if fc.get('filter_type', '=') == '=']
+        values = sample_filter_values(conn, target, filter_columns)
+        combos = [()] + [c for n in range(1, min(2, len(values)) + 1) for c in combinations(values, n)]
+        for combo in combos:
+            args_sql = sql.SQL(', ').join([sql.SQL("{} => %s").format(sql.Identifier(f"p_{k}")) for k in combo])
+            statement = sql.SQL("SELECT * FROM {}({})").format(parse_identifier(func_name), args_sql)
+            params = [values[k] for k in combo]
+            phases = [('cold', True), ('warm', False)] if func.get('cache') else [('call', False)]
+            for phase, invalidate in phases:
+                latencies, total, started = [], 0, time.perf_counter()
+                for _ in range(args.repeat):
+                    if invalidate:
+                        cur.execute(sql.SQL("SELECT {}()").format(parse_identifier(f"{func_name}_invalidate")))
+                        conn.commit()
+                    rows, seconds = timed_fetch(cur, statement, params)
+                    conn.commit()
+                    latencies.append(seconds); total += len(rows)
+                label = '+'.join(combo) or 'no filter'
+                results.append(summarize(f"{func_name}[{label}]" + (f"[{phase}]" if phase != 'call' else ''), 'filters',
+                                         latencies, total, time.perf_counter() - started, conn, {'filters': list(combo)}))
+    return results
+
+def scenario_views(conn, sections, context_vars, args):
+    results = []
+    cur = conn.cursor()
+    for section in ['views', 'materialized_views']:
+        for view_name in sections.get(section, {}):
+            latencies, total, started = [], 0, time.perf_counter()
+            for _ in range(args.repeat):
+                rows, seconds = timed_fetch(cur, sql.SQL("SELECT * FROM {}").format(parse_identifier(view_name)))
+                latencies.append(seconds); total += len(rows)
+            conn.rollback()
+            results.append(summarize(f"{view_name}[select]", 'views', latencies, total, time.perf_counter() - started, conn))
+
+            if section == 'materialized_views':
+                latencies, started = [], time.perf_counter()
+                for _ in range(args.repeat):
+                    _, seconds = timed_fetch(cur, "SELECT refresh_materialized_view(%s)", (view_name,))
+                    conn.commit()
+                    latencies.append(seconds)
+                results.append(summarize(f"{view_name}[refresh]", 'views', latencies, 0, time.perf_counter() - started, conn))
+    return results
+
+def scenario_concurrency(conn, sections, context_vars, args, database):
+    # هر مصرف‌کننده اتصال جدا و بازه‌ی کلید مجزا دارد؛ توان عملیاتی کل بر اساس زمان دیواری محاسبه می‌شود
+    results = []
+    for func_name, job in sections.get('incremental_jobs', {}).items():
+        target = resolve_config_val(job['target_table'], context_vars)
+        low, high = key_bounds(conn, target, job['key_column'])
+        size = job.get('batch_size', 1000)
+        for consumers in args.concurrency:
+            width = max(1, (high - low) // consumers)
+            ranges = [(low + i * width, high if i == consumers - 1 else low + (i + 1) * width) for i in range(consumers)]
+            lock = threading.Lock()
+            latencies, totals = [], []
+
+            def consume(key_range):
+                worker_conn = connect(database)
+                worker_conn.autocommit = False
+                try:
+                    l, t = job_pass(worker_conn, func_name, job, size, {}, key_range[0], key_range[1], args.max_calls)
+                finally:
+                    worker_conn.close()
+                with lock:
+                    latencies.extend(l); totals.append(t)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=consumers) as pool:
+                list(pool.map(consume, ranges))
+            results.append(summarize(f"{func_name}[consumers={consumers}]", 'concurrency', latencies, sum(totals),
+                                     time.perf_counter() - started, conn, {'consumers': consumers}))
+    return results
+
+# ==========================================
+# مقایسه با Baseline
+# ==========================================
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    with open(baseline_path, 'r') as f:
+        baseline = {r['name']: r for r in json.load(f)['scenarios']}
+    regressions = []
+    for r in results:
+        base = baseline.get(r['name'])
+        if not base: continue
+        base_p95, p95 = base['latency_ms']['p95'], r['latency_ms']['p95']
+        if base_p95 and p95 and p95 > base_p95 * (1 + tolerance):
+            regressions.append(f"{r['name']}: p95 {base_p95} -> {p95} ms")
+        base_rps, rps = base.get('rows_per_sec'), r.get('rows_per_sec')
+        if base_rps and rps is not None and r['rows'] and rps < base_rps * (1 - tolerance):
+            regressions.append(f"{r['name']}: {base_rps} -> {rps} rows/s")
+    return regressions
+
+# ==========================================
+# اجرای اصلی
+# ==========================================
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of generated gateway SQL against a local postgres_fdw stand-in")
+    parser.add_argument('--domain', required=True, help="domain folder, e.g. /app/configs/domains/biiling/26")
+    parser.add_argument('--database', help="database of the domain to benchmark (default: the first one)")
+    parser.add_argument('--rows', type=int, default=100000, help="synthetic rows per foreign table")
+    parser.add_argument('--table-rows', action='append', metavar='TABLE=N', help="row count override for one table (repeatable)")
+    parser.add_argument('--reseed', action='store_true', help="drop and re-create the stand-in source database")
+    parser.add_argument('--scenarios', default='batch_sweep,filters,views,concurrency',
+                        help="comma separated subset of: batch_sweep, filters, views, concurrency")
+    parser.add_argument('--batch-sizes', default='1000,10000,50000', help="p_limit values for the batch sweep")
+    parser.add_argument('--concurrency', default='1,4,8', help="numbers of concurrent consumers")
+    parser.add_argument('--max-calls', type=int, default=20, help="calls per job pass")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions of every scenario")
+    parser.add_argument('--output', default='benchmark.json', help="JSON results file")
+    parser.add_argument('--baseline', help="previous results file; exit 1 when a scenario regresses")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative regression against the baseline")
+    args = parser.parse_args(argv)
+    args.batch_sizes = [int(v) for v in args.batch_sizes.split(',')]
+    args.concurrency = [int(v) for v in args.concurrency.split(',')]
+    args.scenarios = [s.strip() for s in args.scenarios.split(',')]
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("🚀 Starting Gateway Benchmark...")
+    tasks = collect_domain_databases(Path(args.domain))
+    task = next((t for t in tasks if not args.database or t[0] == args.database), None)
+    if not task:
+        raise SystemExit(f"❌ Database '{args.database}' not found in {args.domain}")
+    db_name, data, context_vars = task
+    bench_db, source_db = f"{BENCH_PREFIX}{db_name}", f"{BENCH_PREFIX}{db_name}_source"
+    sections = collect_sections(data, context_vars)
+
+    table_rows = dict(item.split('=', 1) for item in args.table_rows or [])
+    print(f"\n🌱 Seeding stand-in source {source_db}...")
+    seed_source_database(source_db, sections, context_vars,
+                         lambda name: int(table_rows.get(name, args.rows)), args.reseed)
+
+    print(f"\n🧩 Provisioning {bench_db} against {source_db} (postgres_fdw)...")
+    process_single_database(bench_db, build_bench_data(data, source_db), context_vars, force=True)
+
+    conn = connect(bench_db)
+    conn.autocommit = False
+    scenario_runners = {
+        'batch_sweep': lambda: scenario_batch_sweep(conn, sections, context_vars, args),
+        'filters': lambda: scenario_filters(conn, sections, context_vars, args),
+        'views': lambda: scenario_views(conn, sections, context_vars, args),
+        'concurrency': lambda: scenario_concurrency(conn, sections, context_vars, args, bench_db),
+    }
+    results = []
+    for scenario in args.scenarios:
+        print(f"\n📊 Scenario: {scenario}")
+        try:
+            results += scenario_runners[scenario]()
+        except Exception as e:
+            conn.rollback()
+            print(f"   ❌ Scenario {scenario} failed: {e}")
+    cur = conn.cursor()
+    cur.execute("SHOW server_version")
+    server_version = cur.fetchone()[0]
+    conn.close()
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'domain': str(args.domain), 'database': db_name, 'server_version': server_version,
+            'rows': args.rows, 'table_rows': table_rows, 'repeat': args.repeat, 'max_calls': args.max_calls,
+        },
+        'scenarios': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"\n🧾 {len(results)} scenario result(s) written to {args.output}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"   ❌ Regression {line}")
+        if regressions: sys.exit(1)
+        print(f"   ✅ No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    print("\n🎉 BENCHMARK COMPLETED.")
+
+if __name__ == "__main__": main()
@@ -0,0 +1,310 @@
+import os
+import io
+import csv
+import gzip
+import json
+import time
+import struct
+import datetime
+import argparse
+import psycopg2
+from psycopg2 import sql
+from pathlib import Path
+
+from provision import find_config_entry, parse_identifier, fetch_window_end
+
+# ==========================================
+# تنظیمات سراسری
+# ==========================================
+CONFIG_DIR = Path(os.environ.get('GATEWAY_CONFIG_DIR', '/app/configs/domains'))
+EXPORT_CHUNK_MB = int(os.environ.get('EXPORT_CHUNK_MB', '256'))
+
+OBJECT_SECTIONS = ['views', 'materialized_views', 'tables', 'mirrors', 'incremental_jobs', 'custom_functions']
+FUNCTION_SECTIONS = ('incremental_jobs', 'custom_functions')
+BINARY_TRAILER = b'\xff\xff'
+BINARY_HEADER_SIZE = 19
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+# رمزگشایی کلید از فرمت باینری COPY (بر اساس OID نوع): int2، int4، int8، date، timestamp، timestamptz
+BINARY_KEY_DECODERS = {
+    21: lambda b: struct.unpack('>h', b)[0],
+    23: lambda b: struct.unpack('>i', b)[0],
+    20: lambda b: struct.unpack('>q', b)[0],
+    1082: lambda b: (PG_EPOCH + datetime.timedelta(days=struct.unpack('>i', b)[0])).date(),
+    1114: lambda b: PG_EPOCH + datetime.timedelta(microseconds=struct.unpack('>q', b)[0]),
+    1184: lambda b: (PG_EPOCH + datetime.timedelta(microseconds=struct.unpack('>q', b)[0])).replace(tzinfo=datetime.timezone.utc),
+}
+
+# ==========================================
+# نوشتن تکه‌ای و فشرده‌ی خروجی COPY
+# ==========================================
+
+class KeyTracker:
+    # بیشینه‌ی ستون کلید از همان ردیف‌های در حال Stream خوانده می‌شود تا نتیجه‌ی تابع دوباره اجرا یا ذخیره نشود
+    def __init__(self, cur, copy_format, index, type_oid):
+        self.cur = cur
+        self.copy_format = copy_format
+        self.index = index
+        self.type_oid = type_oid
+        self.value = None
+
+    def field(self, row):
+        if self.copy_format == 'binary':
+            offset = 2
+            for _ in range(self.index):
+                size = struct.unpack_from('>i', row, offset)[0]
+                offset += 4 + max(size, 0)
+            size = struct.unpack_from('>i', row, offset)[0]
+            return None if size < 0 else BINARY_KEY_DECODERS[self.type_oid](bytes(row[offset + 4:offset + 4 + size]))
+        line = bytes(row).decode().rstrip('\n')
+        if self.copy_format == 'csv':
+            raw = next(csv.reader(io.StringIO(line)))[self.index]
+            raw = raw if raw != '' else None
+        else:
+            raw = line.split('\t')[self.index]
+            raw = raw if raw != '\\N' else None
+        caster = psycopg2.extensions.string_types.get(self.type_oid)
+        return raw if raw is None or caster is None else caster(raw, self.cur)
+
+    def update(self, row):
+        value = self.field(row)
+        if value is not None and (self.value is None or value > self.value):
+            self.value = value
+
+class ChunkedCopyWriter:
+    # psycopg2 هر پیام CopyData را جداگانه به write می‌دهد و سرور هر ردیف را در یک پیام می‌فرستد؛
+    # بنابراین مرز تکه‌ها همیشه روی مرز ردیف است و حافظه فقط به اندازه‌ی یک ردیف مصرف می‌شود
+    def __init__(self, output_dir, prefix, copy_format, compression, chunk_bytes, level):
+        self.output_dir = Path(output_dir)
+        self.prefix = prefix
+        self.copy_format = copy_format
+        self.compression = compression
+        self.chunk_bytes = chunk_bytes
+        self.level = level
+        self.binary_header = None
+        self.file = None
+        self.chunks = []
+        self.key_tracker = None
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def open_chunk(self):
+        ext = {'text': 'tsv', 'csv': 'csv', 'binary': 'bin'}[self.copy_format]
+        name = f"{self.prefix}.{len(self.chunks) + 1:05d}.{ext}" + ('.gz' if self.compression == 'gzip' else '')
+        path = self.output_dir / name
+        self.file = gzip.open(path, 'wb', compresslevel=self.level) if self.compression == 'gzip' else open(path, 'wb')
+        self.chunks.append({'file': name, 'rows': 0, 'raw_bytes': 0})
+        if self.binary_header:
+            self.file.write(self.binary_header)
+
+    def close_chunk(self):
+        if self.copy_format == 'binary':
+            self.file.write(BINARY_TRAILER)
+        self.file.close()
+        chunk = self.chunks[-1]
+        chunk['bytes'] = (self.output_dir / chunk['file']).stat().st_size
+        self.file = None
+
+    def write(self, data):
+        if self.copy_format == 'binary':
+            if data == BINARY_TRAILER:
+                return
+            if self.binary_header is None:
+                # هدر فرمت باینری همراه اولین ردیف می‌آید و در ابتدای هر تکه تکرار می‌شود تا هر فایل مستقلاً قابل COPY FROM باشد
+                self.binary_header, data = bytes(data[:BINARY_HEADER_SIZE]), data[BINARY_HEADER_SIZE:]
+                # خروجی بدون ردیف: هدر و تریلر در یک پیام می‌آیند و فایلی ساخته نمی‌شود (مانند text/csv)
+                if bytes(data) in (b'', BINARY_TRAILER):
+                    return
+                self.open_chunk()
+        if self.file is None:
+            self.open_chunk()
+        elif self.chunks[-1]['raw_bytes'] >= self.chunk_bytes:
+            self.close_chunk()
+            self.open_chunk()
+        self.file.write(data)
+        if self.key_tracker:
+            self.key_tracker.update(data)
+        chunk = self.chunks[-1]
+        chunk['rows'] += 1
+        chunk['raw_bytes'] += len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.close_chunk()
+
+# ==========================================
+# ساخت کوئری خروجی
+# ==========================================
+
+def parse_call_args(arg_list):
+    args = {}
+    for item in arg_list or []:
+        name, _, value = item.partition('=')
+        args[name] = value
+    return args
+
+def function_call(func_name, args):
+    parts = [sql.SQL("{} => {}").format(sql.Identifier(k), sql.Literal(v)) for k, v in args.items()]
+    return sql.SQL("SELECT * FROM {}({})").format(parse_identifier(func_name), sql.SQL(', ').join(parts))
+
+def function_output_columns(cur, func_name):
+    # ستون‌های خروجی (RETURNS TABLE یا RETURNS SETOF جدول) از کاتالوگ خوانده می‌شوند؛ تابع برای کشف ستون‌ها اجرا نمی‌شود
+    cur.execute("""
+        SELECT a.name, a.type_oid
+        FROM pg_proc p,
+             unnest(p.proargnames, p.proallargtypes::oid[], p.proargmodes::text[]) WITH ORDINALITY AS a(name, type_oid, mode, n)
+        WHERE p.oid = %s::regproc AND a.mode = 't'
+        ORDER BY a.n;
+    """, (func_name,))
+    columns = cur.fetchall()
+    if columns:
+        return columns
+    cur.execute("""
+        SELECT att.attname, att.atttypid
+        FROM pg_proc p JOIN pg_type t ON t.oid = p.prorettype
+        JOIN pg_attribute att ON att.attrelid = t.typrelid AND att.attnum > 0 AND NOT att.attisdropped
+        WHERE p.oid = %s::regproc
+        ORDER BY att.attnum;
+    """, (func_name,))
+    return cur.fetchall()
+
+# watermark جاب‌های range پس از COPY از انتهای پنجره‌ای که تابع واقعاً پیمایش کرده خوانده می‌شود
+WINDOW_END = object()
+
+def prepare_source(cur, section, entry, name, args, watermark_column, since, copy_format):
+    # خروجی: (کوئری داخل COPY، ستون watermark، مقدار watermark، KeyTracker که حین COPY پر می‌شود یا WINDOW_END)
+    if section in FUNCTION_SECTIONS:
+        # فراخوانی تابع مستقیماً داخل COPY قرار می‌گیرد (بدون جدول موقت)
+        key_column = entry.get('key_column') if section == 'incremental_jobs' else None
+        if key_column and since is not None:
+            args.setdefault(f"p_last_{key_column}", since)
+        query = function_call(name, args)
+        if not key_column:
+            return query, None, None
+        if entry.get('mode') != 'keyset':
+            # range: پنجره‌ی بدون ردیف هم باید watermark را جلو ببرد، پس بیشینه‌ی کلید ردیف‌ها کافی نیست
+            return query, key_column, WINDOW_END
+        # keyset: watermark بیشینه‌ی ستون کلید در ردیف‌های Streamشده است
+        columns = [c for c in function_output_columns(cur, name) if c[0] != 'next_watermark']
+        key_oid = next((oid for col, oid in columns if col == key_column), None)
+        if key_oid is None:
+            raise SystemExit(f"❌ {name} does not return key column {key_column}")
+        if copy_format == 'binary' and key_oid not in BINARY_KEY_DECODERS:
+            raise SystemExit(f"❌ {key_column}: binary exports track integer, date and timestamp keys only (use --format csv)")
+        query = sql.SQL("SELECT {} FROM ({}) f").format(
+            sql.SQL(', ').join([sql.Identifier(col) for col, _ in columns]), query)
+        tracker = KeyTracker(cur, copy_format, [col for col, _ in columns].index(key_column), key_oid)
+        return query, key_column, tracker
+
+    relation = parse_identifier(name)
+    if not watermark_column:
+        return sql.SQL("SELECT * FROM {}").format(relation), None, None
+
+    # بازه‌ی خروجی پیش از COPY بسته می‌شود (since < col <= upper) تا watermark ثبت‌شده دقیقاً با داده‌ی فایل‌ها یکی باشد
+    wm = sql.Identifier(watermark_column)
+    since_sql = sql.SQL(" WHERE {} > {}").format(wm, sql.Literal(since)) if since is not None else sql.SQL("")
+    cur.execute(sql.SQL("SELECT max({}) FROM {}{};").format(wm, relation, since_sql))
+    upper = cur.fetchone()[0]
+    if upper is None:
+        return None, watermark_column, since
+    bound_sql = sql.SQL("{} {} <= {}").format(sql.SQL(" AND" if since is not None else " WHERE"), wm, sql.Literal(upper))
+    return (sql.SQL("SELECT * FROM {}{}{} ORDER BY {}").format(relation, since_sql, bound_sql, wm),
+            watermark_column, upper)
+
+# ==========================================
+# اجرای خروجی و Manifest
+# ==========================================
+
+def run_export(args):
+    section, entry, db_name = find_config_entry(Path(args.config_dir), OBJECT_SECTIONS, args.object)
+    if not entry:
+        raise SystemExit(f"❌ '{args.object}' is not a configured view, table, mirror or function under {args.config_dir}")
+    database = args.database or db_name
+    call_args = parse_call_args(args.arg)
+
+    since = args.since
+    if args.since_manifest:
+        with open(args.since_manifest, 'r') as f:
+            since = json.load(f).get('watermark', {}).get('value')
+        print(f"♻️  Continuing after watermark {since} from {args.since_manifest}")
+
+    prefix = args.prefix or f"{args.object.replace('.', '_')}_{time.strftime('%Y%m%d_%H%M%S')}"
+    writer = ChunkedCopyWriter(args.output_dir, prefix, args.format, args.compress,
+                               args.chunk_mb * 1024 * 1024, args.compress_level)
+    manifest = {
+        'object': args.object, 'kind': section, 'database': database,
+        'format': args.format, 'compression': args.compress, 'arguments': call_args,
+        'started_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+    started = time.monotonic()
+    conn = psycopg2.connect(args.dsn, dbname=database)
+    try:
+        with conn.cursor() as cur:
+            query, wm_column, wm_value = prepare_source(cur, section, entry, args.object, call_args,
+                                                        args.watermark_column, since, args.format)
+            if isinstance(wm_value, KeyTracker):
+                writer.key_tracker = wm_value
+            rows = 0
+            if section in FUNCTION_SECTIONS:
+                manifest['call'] = function_call(args.object, call_args).as_string(conn)
+            if query is not None:
+                manifest['query'] = query.as_string(conn)
+                options = sql.SQL("FORMAT {}").format(sql.SQL(args.format))
+                if args.format == 'csv': options = sql.SQL("{}, HEADER false").format(options)
+                print(f"📤 COPY {args.object} ({args.format}, {args.compress}) -> {args.output_dir}")
+                cur.copy_expert(sql.SQL("COPY ({}) TO STDOUT WITH ({})").format(query, options).as_string(conn), writer)
+                rows = cur.rowcount
+            else:
+                print(f"ℹ️  No rows after watermark {since}.")
+            if isinstance(wm_value, KeyTracker):
+                wm_value = wm_value.value
+            elif wm_value is WINDOW_END:
+                # gateway.window_end محلی تراکنش است؛ در همان تراکنش COPY خوانده می‌شود
+                wm_value = fetch_window_end(cur)
+            manifest['watermark'] = {'column': wm_column, 'since': since,
+                                     'value': str(wm_value) if wm_value is not None else since}
+        conn.commit()
+    finally:
+        writer.close()
+        conn.close()
+
+    manifest['rows'] = rows
+    manifest['seconds'] = round(time.monotonic() - started, 3)
+    manifest['finished_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    manifest['chunks'] = writer.chunks
+    if args.format == 'binary' and writer.chunks:
+        manifest['binary_note'] = "each chunk is a complete COPY binary file (header + trailer)"
+    manifest_path = Path(args.output_dir) / f"{prefix}.manifest.json"
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+
+    total_bytes = sum(c['bytes'] for c in writer.chunks)
+    print(f"🧾 {rows} rows, {len(writer.chunks)} chunk(s), {total_bytes / 1024 / 1024:.1f} MiB in {manifest['seconds']:.1f}s")
+    print(f"   Manifest: {manifest_path}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a configured view, table or function to compressed files with COPY")
+    parser.add_argument('object', help="configured object, e.g. analytics.vw_anomaly_features or hot_26.fetch_billparts_batch")
+    parser.add_argument('--arg', action='append', metavar='NAME=VALUE',
+                        help="named argument for function calls, e.g. p_persianyear=1403 (repeatable)")
+    parser.add_argument('--format', choices=['text', 'csv', 'binary'], default='csv')
+    parser.add_argument('--compress', choices=['gzip', 'none'], default='gzip')
+    parser.add_argument('--compress-level', type=int, default=3, help="gzip level 1-9 (default: 3, favours speed)")
+    parser.add_argument('--chunk-mb', type=int, default=EXPORT_CHUNK_MB,
+                        help="uncompressed size of each chunk file (env: EXPORT_CHUNK_MB)")
+    parser.add_argument('--watermark-column', help="export only rows above the previous watermark of this column (views/tables)")
+    parser.add_argument('--since', help="lower watermark bound (exclusive)")
+    parser.add_argument('--since-manifest', help="take --since from the watermark of a previous manifest")
+    parser.add_argument('--output-dir', default='.', help="directory for chunk files and the manifest")
+    parser.add_argument('--prefix', help="chunk file prefix (default: <object>_<timestamp>)")
+    parser.add_argument('--dsn', default='', help="libpq connection string of the gateway (default: PG* environment)")
+    parser.add_argument('--database', help="gateway database (default: the object's database in the config)")
+    parser.add_argument('--config-dir', default=CONFIG_DIR, help="domain configs directory (env: GATEWAY_CONFIG_DIR)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("🚀 Starting COPY Export...")
+    run_export(args)
+    print("\n🎉 EXPORT COMPLETED.")
+
+if __name__ == "__main__": main()
@@ -0,0 +1,378 @@
+import os
+import re
+import time
+import argparse
+import threading
+import psycopg2
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ==========================================
+# تنظیمات سراسری
+# ==========================================
+DB_HOST = os.environ.get('EXPORTER_DB_HOST', 'localhost')
+DB_PORT = os.environ.get('EXPORTER_DB_PORT', '5432')
+DB_ADMIN_USER = os.environ.get('POSTGRES_USER')
+DB_ADMIN_PASS = os.environ.get('POSTGRES_PASSWORD')
+DB_DEFAULT_NAME = os.environ.get('POSTGRES_DB')
+EXPORTER_PORT = int(os.environ.get('EXPORTER_PORT', '9187'))
+EXPORTER_CACHE_SECONDS = float(os.environ.get('EXPORTER_CACHE_SECONDS', '5'))
+EXPORTER_TOP_STATEMENTS = int(os.environ.get('EXPORTER_TOP_STATEMENTS', '50'))
+EXPORTER_CALL_WINDOW_SECONDS = int(os.environ.get('EXPORTER_CALL_WINDOW_SECONDS', '600'))
+
+def connect(db):
+    conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, user=DB_ADMIN_USER, password=DB_ADMIN_PASS,
+                            database=db, application_name='gateway_exporter', connect_timeout=5)
+    conn.autocommit = True
+    return conn
+
+# ==========================================
+# قالب متنی Prometheus
+# ==========================================
+
+class MetricSet:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, metric_type, help_text, labels, value):
+        if value is None: return
+        metric = self.metrics.setdefault(name, {'type': metric_type, 'help': help_text, 'samples': []})
+        metric['samples'].append((labels, value))
+
+    def render(self):
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for labels, value in metric['samples']:
+                sample_name = labels.pop('__name__', name)
+                label_sql = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                lines.append(f"{sample_name}{{{label_sql}}} {float(value)}" if labels else f"{sample_name} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', ' ').replace('"', '\\"')
+
+# ==========================================
+# تاخیر Statementها از pg_stat_statements
+# ==========================================
+
+class StatementLatency:
+    # pg_stat_statements توزیع تک‌تک فراخوانی‌ها را ندارد؛ پس هیستوگرام ساخته نمی‌شود و فقط میانگین بازه‌ی بین دو Scrape
+    # و بیشترین max_exec_time بین Statementهایی که در همان بازه اجرا شده‌اند (Gauge) به همراه مجموع تجمعی زمان و تعداد
+    # گزارش می‌شود؛ صدک واقعی فقط برای توابع Instrumentشده از function_call_log محاسبه می‌شود
+    def __init__(self):
+        self.previous = {}
+        self.sums = {}
+        self.counts = {}
+        self.interval = {}
+
+    def observe(self, datname, queryid, calls, total_ms, max_ms):
+        key = (datname, queryid)
+        prev_calls, prev_total = self.previous.get(key, (0, 0.0))
+        self.previous[key] = (calls, total_ms)
+        if calls < prev_calls:
+            prev_calls, prev_total = 0, 0.0
+        delta_calls = calls - prev_calls
+        if delta_calls <= 0: return
+        delta_seconds = (total_ms - prev_total) / 1000.0
+        interval = self.interval.setdefault(datname, {'calls': 0, 'seconds': 0.0, 'max': 0.0})
+        interval['calls'] += delta_calls
+        interval['seconds'] += delta_seconds
+        interval['max'] = max(interval['max'], max_ms / 1000.0)
+        self.sums[datname] = self.sums.get(datname, 0.0) + delta_seconds
+        self.counts[datname] = self.counts.get(datname, 0) + delta_calls
+
+    def export(self, metrics):
+        for datname in self.counts:
+            labels = {'datname': datname}
+            interval = self.interval.get(datname)
+            metrics.add('gateway_query_seconds_total', 'counter', 'Statement execution time per database (pg_stat_statements deltas)',
+                        labels, self.sums[datname])
+            metrics.add('gateway_query_calls_total', 'counter', 'Statement calls per database (pg_stat_statements deltas)',
+                        labels, self.counts[datname])
+            metrics.add('gateway_query_mean_seconds', 'gauge', 'Mean statement latency since the previous scrape',
+                        labels, interval['seconds'] / interval['calls'] if interval else 0.0)
+            metrics.add('gateway_query_max_seconds', 'gauge',
+                        'Largest max_exec_time among statements executed since the previous scrape',
+                        labels, interval['max'] if interval else 0.0)
+        self.interval = {}
+
+# ==========================================
+# جمع‌آوری متریک‌ها
+# ==========================================
+
+def list_databases(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT datname FROM pg_database
+        WHERE datallowconn AND NOT datistemplate AND datname <> 'postgres'
+        ORDER BY datname
+    """)
+    return [r[0] for r in cur.fetchall()]
+
+def has_relation(cur, name):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    return cur.fetchone()[0]
+
+def collect_database(datname, latency, metrics):
+    conn = connect(datname)
+    cur = conn.cursor()
+    labels = {'datname': datname}
+
+    cur.execute("SELECT blks_hit, blks_read, xact_commit, xact_rollback, numbackends FROM pg_stat_database WHERE datname = %s", (datname,))
+    hit, read, commits, rollbacks, backends = cur.fetchone()
+    metrics.add('gateway_cache_hit_ratio', 'gauge', 'Shared buffer hit ratio per database', labels,
+                hit / (hit + read) if hit + read else 1.0)
+    metrics.add('gateway_backends', 'gauge', 'Connected backends per database', labels, backends)
+    metrics.add('gateway_xact_commit_total', 'counter', 'Committed transactions per database', labels, commits)
+    metrics.add('gateway_xact_rollback_total', 'counter', 'Rolled back transactions per database', labels, rollbacks)
+
+    # جداول خارجی هر سرور و توابعی که در بدنه‌ی خود به آن‌ها ارجاع می‌دهند
+    cur.execute("""
+        SELECT s.srvname, n.nspname || '.' || c.relname
+        FROM pg_foreign_table ft
+        JOIN pg_class c ON c.oid = ft.ftrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_foreign_server s ON s.oid = ft.ftserver
+    """)
+    foreign_tables = cur.fetchall()
+    cur.execute("""
+        SELECT n.nspname || '.' || p.proname, p.prosrc
+        FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace
+        WHERE n.nspname NOT IN ('pg_catalog', 'information_schema') AND p.prolang <> 13
+    """)
+    functions = cur.fetchall()
+    server_names = {}
+    for server, table in foreign_tables:
+        server_names.setdefault(server, set()).add(table)
+        server_names[server].update(f for f, src in functions if table in (src or ''))
+
+    cur.execute("SELECT query FROM pg_stat_activity WHERE datname = %s AND state = 'active' AND pid <> pg_backend_pid()", (datname,))
+    active_queries = [r[0] or '' for r in cur.fetchall()]
+    for server, names in server_names.items():
+        pattern = re.compile('|'.join(re.escape(n) for n in sorted(names)))
+        metrics.add('gateway_fdw_active_connections', 'gauge',
+                    'Active backends currently reading through a foreign server (by query text)',
+                    {'datname': datname, 'server': server}, sum(1 for q in active_queries if pattern.search(q)))
+
+    if has_relation(cur, 'pg_stat_statements'):
+        try:
+            cur.execute("""
+                SELECT queryid, calls, total_exec_time, rows, mean_exec_time, max_exec_time, query
+                FROM pg_stat_statements
+                WHERE dbid = (SELECT oid FROM pg_database WHERE datname = %s)
+            """, (datname,))
+            statements = cur.fetchall()
+        except psycopg2.Error:
+            statements = []
+        for queryid, calls, total_ms, rows, mean_ms, max_ms, query in statements:
+            latency.observe(datname, queryid, calls, total_ms, max_ms)
+        for server, table in foreign_tables:
+            matching = [s for s in statements if table in (s[6] or '')]
+            t_labels = {'datname': datname, 'server': server, 'table': table}
+            metrics.add('gateway_foreign_table_rows_total', 'counter',
+                        'Rows returned by statements reading a foreign table (pg_stat_statements)',
+                        t_labels, sum(s[3] for s in matching))
+            metrics.add('gateway_foreign_table_calls_total', 'counter',
+                        'Statements executed against a foreign table (pg_stat_statements)', t_labels, sum(s[1] for s in matching))
+        for queryid, calls, total_ms, rows, mean_ms, max_ms, query in sorted(statements, key=lambda s: -s[2])[:EXPORTER_TOP_STATEMENTS]:
+            s_labels = {'datname': datname, 'queryid': queryid}
+            metrics.add('gateway_statement_calls_total', 'counter', 'Calls of the top statements by total time', s_labels, calls)
+            metrics.add('gateway_statement_seconds_total', 'counter', 'Execution time of the top statements', s_labels, total_ms / 1000.0)
+            metrics.add('gateway_statement_max_seconds', 'gauge', 'Slowest execution of the top statements', s_labels, max_ms / 1000.0)
+
+    # فراخوانی توابع (نیازمند track_functions = pl)
+    cur.execute("""
+        SELECT schemaname || '.' || funcname, calls, total_time, self_time
+        FROM pg_stat_user_functions
+    """)
+    for func_name, calls, total_ms, self_ms in cur.fetchall():
+        f_labels = {'datname': datname, 'function': func_name}
+        metrics.add('gateway_function_calls_total', 'counter', 'Calls per function (pg_stat_user_functions)', f_labels, calls)
+        metrics.add('gateway_function_seconds_total', 'counter', 'Total time per function (pg_stat_user_functions)',
+                    f_labels, total_ms / 1000.0)
+
+    if has_relation(cur, 'function_call_stats'):
+        # صدک‌ها از تک‌تک فراخوانی‌های پنجره‌ی اخیر حلقه محاسبه می‌شوند (نه کل حلقه) تا هشدار تاخیر دنباله را نشان دهد
+        cur.execute("""
+            SELECT function_name,
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY wall_ms),
+                   percentile_cont(0.95) WITHIN GROUP (ORDER BY wall_ms),
+                   percentile_cont(0.99) WITHIN GROUP (ORDER BY wall_ms)
+            FROM function_call_log
+            WHERE called_at > now() - make_interval(secs => %s)
+            GROUP BY function_name
+        """, (EXPORTER_CALL_WINDOW_SECONDS,))
+        for func_name, p50, p95, p99 in cur.fetchall():
+            f_labels = {'datname': datname, 'function': func_name}
+            for quantile, value in (('0.5', p50), ('0.95', p95), ('0.99', p99)):
+                metrics.add('gateway_function_call_latency_seconds', 'gauge',
+                            'Latency quantiles of instrumented function calls in the recent window (function_call_log)',
+                            {**f_labels, 'quantile': quantile}, value / 1000.0 if value is not None else None)
+        cur.execute("SELECT function_name, calls, rows_returned, scan_share FROM function_call_stats")
+        for func_name, calls, rows, scan_share in cur.fetchall():
+            f_labels = {'datname': datname, 'function': func_name}
+            metrics.add('gateway_function_call_rows', 'gauge', 'Rows returned by calls in the call log ring', f_labels, rows)
+            metrics.add('gateway_function_scan_share', 'gauge', 'Share of call time spent scanning', f_labels, scan_share)
+
+    if has_relation(cur, 'mirror_state'):
+        cur.execute("SELECT mirror_name, total_rows, extract(epoch FROM last_duration), extract(epoch FROM last_run_at) FROM mirror_state")
+        for mirror, total_rows, last_seconds, last_run in cur.fetchall():
+            m_labels = {'datname': datname, 'mirror': mirror}
+            metrics.add('gateway_mirror_rows_total', 'counter', 'Rows copied into a mirror', m_labels, total_rows)
+            metrics.add('gateway_mirror_last_duration_seconds', 'gauge', 'Duration of the last mirror sync', m_labels, last_seconds)
+            metrics.add('gateway_mirror_last_run_timestamp_seconds', 'gauge', 'Time of the last mirror sync', m_labels, last_run)
+    conn.close()
+
+def collect_provision_runs(metrics):
+    conn = connect(DB_DEFAULT_NAME)
+    cur = conn.cursor()
+    if has_relation(cur, 'provision_runs'):
+        cur.execute("SELECT database_name, domain, status, errors, seconds, extract(epoch FROM finished_at) FROM provision_runs")
+        domains = {}
+        for datname, domain, status, errors, seconds, finished in cur.fetchall():
+            labels = {'datname': datname, 'domain': domain}
+            metrics.add('gateway_provision_duration_seconds', 'gauge', 'Duration of the last provisioning run per database', labels, seconds)
+            metrics.add('gateway_provision_errors', 'gauge', 'Errors in the last provisioning run per database', labels, errors)
+            metrics.add('gateway_provision_last_run_timestamp_seconds', 'gauge', 'Finish time of the last provisioning run',
+                        labels, finished)
+            domains[domain] = domains.get(domain, 0.0) + seconds
+        for domain, seconds in domains.items():
+            metrics.add('gateway_provision_domain_duration_seconds', 'gauge',
+                        'Summed database provisioning time per domain', {'domain': domain}, seconds)
+    conn.close()
+
+class Collector:
+    def __init__(self):
+        self.latency = StatementLatency()
+        self.lock = threading.Lock()
+        self.cached_at = 0.0
+        self.cached = ""
+
+    def collect(self):
+        # چند Scraper همزمان فقط یک بار دیتابیس را می‌خوانند
+        with self.lock:
+            if time.monotonic() - self.cached_at < EXPORTER_CACHE_SECONDS:
+                return self.cached
+            started = time.monotonic()
+            metrics = MetricSet()
+            admin = connect(DB_DEFAULT_NAME)
+            databases = list_databases(admin)
+            admin.close()
+            for datname in databases:
+                try:
+                    collect_database(datname, self.latency, metrics)
+                    metrics.add('gateway_scrape_success', 'gauge', 'Whether the database was scraped', {'datname': datname}, 1)
+                except Exception as e:
+                    print(f"⚠️ Scrape of {datname} failed: {e}")
+                    metrics.add('gateway_scrape_success', 'gauge', 'Whether the database was scraped', {'datname': datname}, 0)
+            try:
+                collect_provision_runs(metrics)
+            except Exception as e:
+                print(f"⚠️ Reading provision_runs failed: {e}")
+            self.latency.export(metrics)
+            metrics.add('gateway_scrape_duration_seconds', 'gauge', 'Time spent collecting metrics', {}, time.monotonic() - started)
+            self.cached, self.cached_at = metrics.render(), time.monotonic()
+            return self.cached
+
+# ==========================================
+# پیکربندی Prometheus
+# ==========================================
+
+def write_prometheus_config(path, target, interval):
+    config = f"""# generated by scripts/exporter.py --write-prometheus-config
+global:
+  scrape_interval: {interval}
+  evaluation_interval: {interval}
+
+rule_files:
+  - /etc/prometheus/gateway-alerts.yml
+
+scrape_configs:
+  - job_name: gateway
+    static_configs:
+      - targets: ['{target}']
+"""
+    rules = """# generated by scripts/exporter.py --write-prometheus-config
+groups:
+  - name: gateway
+    rules:
+      - alert: GatewayForeignThroughputDrop
+        expr: |
+          sum by (datname, server) (rate(gateway_foreign_table_rows_total[15m]))
+            < 0.5 * sum by (datname, server) (rate(gateway_foreign_table_rows_total[15m] offset 1d))
+        for: 30m
+        labels: {severity: warning}
+        annotations:
+          summary: "Rows fetched through {{ $labels.server }} in {{ $labels.datname }} dropped below half of yesterday"
+      - alert: GatewayQueryLatencyHigh
+        expr: |
+          sum by (datname) (rate(gateway_query_seconds_total[10m]))
+            / sum by (datname) (rate(gateway_query_calls_total[10m])) > 5
+        for: 15m
+        labels: {severity: warning}
+        annotations:
+          summary: "Mean statement latency in {{ $labels.datname }} is above 5s"
+      - alert: GatewayFunctionTailLatencyHigh
+        expr: gateway_function_call_latency_seconds{quantile="0.95"} > 5
+        for: 15m
+        labels: {severity: warning}
+        annotations:
+          summary: "p95 latency of {{ $labels.function }} in {{ $labels.datname }} is above 5s (function_call_log)"
+      - alert: GatewayScrapeFailed
+        expr: gateway_scrape_success == 0
+        for: 10m
+        labels: {severity: critical}
+        annotations:
+          summary: "Exporter cannot read database {{ $labels.datname }}"
+"""
+    path = os.path.abspath(path)
+    with open(path, 'w') as f:
+        f.write(config)
+    with open(os.path.join(os.path.dirname(path), 'gateway-alerts.yml'), 'w') as f:
+        f.write(rules)
+    print(f"📝 Prometheus config written to {path} (target {target})")
+
+# ==========================================
+# سرور HTTP
+# ==========================================
+
+def make_handler(collector):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404); self.end_headers(); return
+            try:
+                body = collector.collect().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            except Exception as e:
+                body = f"# scrape failed: {e}\n".encode()
+                self.send_response(500)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return MetricsHandler
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Prometheus exporter for the database gateway")
+    parser.add_argument('--port', type=int, default=EXPORTER_PORT, help="listen port (env: EXPORTER_PORT)")
+    parser.add_argument('--write-prometheus-config', metavar='PATH',
+                        help="write a Prometheus scrape config (and gateway-alerts.yml next to it) and exit")
+    parser.add_argument('--target', default=f"exporter:{EXPORTER_PORT}", help="scrape target for the generated config")
+    parser.add_argument('--scrape-interval', default='15s', help="scrape interval for the generated config")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.write_prometheus_config:
+        write_prometheus_config(args.write_prometheus_config, args.target, args.scrape_interval)
+        return
+    print(f"🚀 Gateway exporter listening on :{args.port}/metrics")
+    server = ThreadingHTTPServer(('', args.port), make_handler(Collector()))
+    server.serve_forever()
+
+if __name__ == "__main__": main()
@@ -0,0 +1,341 @@
+import os
+import io
+import sys
+import csv
+import json
+import time
+import argparse
+import threading
+import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from provision import find_config_entry, parse_identifier, fetch_window_end
+
+# ==========================================
+# تنظیمات سراسری
+# ==========================================
+CONFIG_DIR = Path(os.environ.get('GATEWAY_CONFIG_DIR', '/app/configs/domains'))
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', '4'))
+EXTRACT_RETRIES = int(os.environ.get('EXTRACT_RETRIES', '3'))
+
+# ==========================================
+# آرگومان‌های Job
+# ==========================================
+
+def parse_filters(filter_args, job):
+    filter_types = {fc['name']: fc['type'] for fc in job.get('filter_columns', [])}
+    filters = {}
+    for item in filter_args or []:
+        name, _, value = item.partition('=')
+        if name not in filter_types:
+            raise ValueError(f"'{name}' is not a filter column of {job['name']} ({', '.join(filter_types) or 'none'})")
+        filters[name] = value
+    return filters, filter_types
+
+def call_sql(func_name, args, types):
+    # فراخوانی با Named Notation تا ترتیب آرگومان‌های تابع تولیدشده اهمیتی نداشته باشد
+    parts = [sql.SQL("{} => %s::{}").format(sql.Identifier(name), sql.SQL(types[name])) for name in args]
+    return sql.SQL("SELECT * FROM {}({})").format(parse_identifier(func_name), sql.SQL(', ').join(parts))
+
+# ==========================================
+# تقسیم فضای کلید و Checkpoint
+# ==========================================
+
+def fetch_key_stats(conn, stats_name, filters, filter_types):
+    args = {f"p_{k}": v for k, v in filters.items()}
+    types = {f"p_{k}": filter_types[k] for k in filters}
+    with conn.cursor() as cur:
+        cur.execute(call_sql(stats_name, args, types), list(args.values()))
+        row = cur.fetchone()
+        columns = [d.name for d in cur.description]
+    conn.rollback()
+    stats = dict(zip(columns, row)) if row else {}
+    return stats.get('min_id'), stats.get('max_id'), stats.get('total_count')
+
+def split_key_space(min_key, max_key, ranges):
+    # بازه‌ها نیمه‌باز (start, end] هستند تا با منطق key > last توابع افزایشی هم‌خوان باشند
+    start = min_key - 1
+    width = max(1, -(-(max_key - start) // ranges))
+    result = []
+    while start < max_key:
+        end = min(start + width, max_key)
+        result.append({'start': start, 'end': end, 'last': start, 'rows': 0, 'offset': 0, 'done': False})
+        start = end
+    return result
+
+class Checkpoint:
+    # وضعیت هر بازه پس از هر Batch موفق به صورت اتمیک (write + rename) روی دیسک نوشته می‌شود
+    def __init__(self, path, state):
+        self.path = Path(path)
+        self.state = state
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load_or_create(cls, path, identity, make_ranges):
+        path = Path(path)
+        if path.exists():
+            with open(path, 'r') as f:
+                state = json.load(f)
+            if state.get('identity') == identity:
+                done = sum(1 for r in state['ranges'] if r['done'])
+                print(f"♻️  Resuming from checkpoint {path}: {done}/{len(state['ranges'])} ranges done")
+                return cls(path, state)
+            print(f"⚠️ Checkpoint {path} belongs to a different extraction, starting over.")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        checkpoint = cls(path, {'identity': identity, 'ranges': make_ranges()})
+        checkpoint.save()
+        return checkpoint
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self.state, f, indent=2, default=str)
+            os.replace(tmp_path, self.path)
+
+# ==========================================
+# مقصدهای خروجی (فایل / جدول محلی)
+# ==========================================
+
+class FileSink:
+    # هر بازه یک فایل CSV دارد؛ هنگام ادامه، فایل تا offset ثبت‌شده در Checkpoint کوتاه می‌شود
+    def __init__(self, output_dir, prefix):
+        self.output_dir = Path(output_dir)
+        self.prefix = prefix
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def write(self, range_state, columns, rows, key_column, batch_last):
+        path = self.output_dir / f"{self.prefix}_{range_state['start'] + 1}_{range_state['end']}.csv"
+        with open(path, 'a+b') as f:
+            f.truncate(range_state['offset'])
+            f.seek(range_state['offset'])
+            text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            writer = csv.writer(text)
+            if range_state['offset'] == 0: writer.writerow(columns)
+            writer.writerows(rows)
+            text.flush()
+            os.fsync(f.fileno())
+            range_state['offset'] = f.tell()
+            text.detach()
+
+    def close(self):
+        pass
+
+class TableSink:
+    # هر Batch در یک تراکنش ابتدا بازه‌ی کلید خودش را حذف و سپس با COPY درج می‌کند؛ تکرار Batch بی‌اثر است
+    def __init__(self, pool, table_name, filters, source_conn, source_columns):
+        self.table_name = table_name
+        self.filters = filters
+        self.pool = pool
+        self.ensure_table(source_conn, source_columns)
+
+    def ensure_table(self, source_conn, source_columns):
+        with source_conn.cursor() as cur:
+            cur.execute("SELECT oid, format_type(oid, NULL) FROM pg_type WHERE oid = ANY(%s)",
+                        ([c[1] for c in source_columns],))
+            type_names = dict(cur.fetchall())
+        source_conn.rollback()
+        cols = sql.SQL(', ').join([sql.SQL("{} {}").format(sql.Identifier(name), sql.SQL(type_names.get(oid, 'text')))
+                                   for name, oid in source_columns])
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} ({});").format(parse_identifier(self.table_name), cols))
+            conn.commit()
+        finally:
+            self.pool.putconn(conn)
+
+    def write(self, range_state, columns, rows, key_column, batch_last):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                conditions = [sql.SQL("{0} > %s AND {0} <= %s").format(sql.Identifier(key_column))]
+                params = [range_state['last'], batch_last]
+                for name, value in self.filters.items():
+                    conditions.append(sql.SQL("{}::text = %s").format(sql.Identifier(name)))
+                    params.append(value)
+                cur.execute(sql.SQL("DELETE FROM {} WHERE {};").format(
+                    parse_identifier(self.table_name), sql.SQL(' AND ').join(conditions)), params)
+                cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+                    parse_identifier(self.table_name), sql.SQL(', ').join([sql.Identifier(c) for c in columns])
+                ).as_string(conn), buffer)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def close(self):
+        self.pool.closeall()
+
+# ==========================================
+# استخراج موازی بازه‌ها
+# ==========================================
+
+def fetch_batch(pool, job, range_state, filters, filter_types, retries):
+    key_column = job['key_column']
+    mode = job.get('mode', 'range')
+    max_limit = job.get('max_limit', job.get('batch_size', 1000) * 10)
+    remaining = range_state['end'] - range_state['last']
+    # حالت range پنجره‌ای به عرض limit روی کلید است؛ حالت keyset حداکثر limit ردیف بعدی را برمی‌گرداند
+    limit = min(max_limit, remaining) if mode == 'range' else max_limit
+
+    args = {f"p_last_{key_column}": range_state['last'], 'p_limit': limit}
+    types = {f"p_last_{key_column}": job['key_type'], 'p_limit': 'integer'}
+    for name, value in filters.items():
+        args[f"p_{name}"] = value
+        types[f"p_{name}"] = filter_types[name]
+
+    for attempt in range(1, retries + 2):
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(call_sql(job['name'], args, types), list(args.values()))
+                rows = cur.fetchall()
+                columns = [d.name for d in cur.description]
+                window_end = int(fetch_window_end(cur)) if mode == 'range' else None
+            conn.rollback()
+            pool.putconn(conn)
+            break
+        except psycopg2.Error as e:
+            # اتصال خراب به Pool برنمی‌گردد تا تلاش بعدی روی اتصال تازه انجام شود
+            broken = conn.closed != 0 or isinstance(e, psycopg2.OperationalError)
+            if not broken: conn.rollback()
+            pool.putconn(conn, close=broken)
+            if attempt > retries: raise
+            delay = 2 ** attempt
+            print(f"   ⚠️ Range ({range_state['start']}, {range_state['end']}] attempt {attempt} failed, "
+                  f"retrying in {delay}s: {str(e).strip()}")
+            time.sleep(delay)
+
+    if mode == 'keyset' and columns and columns[-1] == 'next_watermark':
+        columns = columns[:-1]
+        rows = [r[:-1] for r in rows]
+    key_idx = columns.index(key_column)
+    rows = [r for r in rows if r[key_idx] <= range_state['end']]
+
+    if mode == 'range':
+        # تابع ممکن است پنجره را کوچک‌تر از limit کرده باشد (window.max یا حالت تطبیقی)؛ ادامه از انتهای واقعی پنجره
+        batch_last = min(window_end, range_state['end'])
+    elif rows and len(rows) == limit and rows[-1][key_idx] < range_state['end']:
+        batch_last = rows[-1][key_idx]
+    else:
+        batch_last = range_state['end']
+    return columns, rows, batch_last
+
+def extract_range(pool, job, range_state, filters, filter_types, sink, checkpoint, retries):
+    started = time.monotonic()
+    while not range_state['done']:
+        columns, rows, batch_last = fetch_batch(pool, job, range_state, filters, filter_types, retries)
+        if rows:
+            sink.write(range_state, columns, rows, job['key_column'], batch_last)
+        range_state['rows'] += len(rows)
+        range_state['last'] = batch_last
+        range_state['done'] = batch_last >= range_state['end']
+        checkpoint.save()
+    return range_state, time.monotonic() - started
+
+def run_extraction(args):
+    _, job, db_name = find_config_entry(Path(args.config_dir), ['incremental_jobs'], args.job)
+    if not job:
+        raise SystemExit(f"❌ Incremental job '{args.job}' not found under {args.config_dir}")
+    key_type = job['key_type'].lower()
+    if not any(t in key_type for t in ('int', 'num', 'serial')):
+        raise SystemExit(f"❌ {args.job}: range splitting needs a numeric key, got '{job['key_type']}'")
+    stats_name = args.stats or job.get('stats_function')
+    if not stats_name:
+        raise SystemExit(f"❌ {args.job}: pass --stats or set stats_function in the job config")
+
+    filters, filter_types = parse_filters(args.filter, job)
+    database = args.database or db_name
+    pool = ThreadedConnectionPool(1, args.workers, args.dsn, dbname=database)
+    conn = pool.getconn()
+    try:
+        min_key, max_key, total = fetch_key_stats(conn, stats_name, filters, filter_types)
+        if min_key is None:
+            print("ℹ️  No rows match the given filters.")
+            return
+        print(f"📏 {args.job}: keys {min_key}..{max_key} ({total} rows) on {database}")
+
+        identity = {'job': args.job, 'database': database, 'filters': filters,
+                    'output': args.output_table or str(Path(args.output_dir).resolve())}
+        ranges = args.ranges or args.workers * 4
+        # پیش‌فرض کنار فایل‌های خروجی (نه دایرکتوری جاری، که ممکن است درخت کد باشد)
+        checkpoint_path = args.checkpoint or Path(args.output_dir) / f"{args.job}.checkpoint.json"
+        checkpoint = Checkpoint.load_or_create(checkpoint_path, identity,
+                                               lambda: split_key_space(int(min_key), int(max_key), ranges))
+
+        if args.output_table:
+            with conn.cursor() as cur:
+                cur.execute(call_sql(job['name'], {'p_limit': 0}, {'p_limit': 'integer'}), [0])
+                source_columns = [(d.name, d.type_code) for d in cur.description if d.name != 'next_watermark']
+            conn.rollback()
+            target_pool = (ThreadedConnectionPool(1, args.workers, args.target_dsn) if args.target_dsn
+                           else ThreadedConnectionPool(1, args.workers, args.dsn, dbname=database))
+            sink = TableSink(target_pool, args.output_table, filters, conn, source_columns)
+        else:
+            sink = FileSink(args.output_dir, args.job.replace('.', '_'))
+    finally:
+        pool.putconn(conn)
+
+    pending = [r for r in checkpoint.state['ranges'] if not r['done']]
+    print(f"⚡ Extracting {len(pending)} range(s) with {args.workers} worker(s)...")
+    started = time.monotonic()
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(extract_range, pool, job, r, filters, filter_types, sink, checkpoint, args.retries): r
+                       for r in pending}
+            for future in as_completed(futures):
+                r = futures[future]
+                try:
+                    _, seconds = future.result()
+                    print(f"   ✅ Range ({r['start']}, {r['end']}]: {r['rows']} rows in {seconds:.1f}s")
+                except Exception as e:
+                    failed += 1
+                    print(f"   ❌ Range ({r['start']}, {r['end']}] failed: {e}")
+    finally:
+        sink.close()
+        pool.closeall()
+
+    total_rows = sum(r['rows'] for r in checkpoint.state['ranges'])
+    print(f"\n🧾 {total_rows} rows in {time.monotonic() - started:.1f}s, {failed} range(s) failed")
+    if failed:
+        print(f"   Re-run the same command to resume from {checkpoint.path}")
+        sys.exit(1)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Parallel range-partitioned extraction of incremental jobs")
+    parser.add_argument('job', help="incremental job function, e.g. hot_26.fetch_billparts_batch")
+    parser.add_argument('--filter', action='append', metavar='COLUMN=VALUE',
+                        help="value for one of the job's filter_columns (repeatable)")
+    parser.add_argument('--stats', help="stats function returning min_id/max_id/total_count (default: job's stats_function)")
+    parser.add_argument('--dsn', default='', help="libpq connection string of the gateway (default: PG* environment)")
+    parser.add_argument('--database', help="gateway database (default: the job's database in the config)")
+    parser.add_argument('--config-dir', default=CONFIG_DIR, help="domain configs directory (env: GATEWAY_CONFIG_DIR)")
+    parser.add_argument('--workers', '-j', type=int, default=EXTRACT_WORKERS,
+                        help="concurrent connections to the gateway (env: EXTRACT_WORKERS)")
+    parser.add_argument('--ranges', type=int, help="number of key ranges (default: 4 x workers)")
+    parser.add_argument('--retries', type=int, default=EXTRACT_RETRIES, help="retries per batch (env: EXTRACT_RETRIES)")
+    parser.add_argument('--checkpoint', help="checkpoint file (default: <output-dir>/<job>.checkpoint.json)")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--output-dir', default='.', help="write one CSV file per range into this directory")
+    output.add_argument('--output-table', help="load rows into this table instead of files")
+    parser.add_argument('--target-dsn', help="libpq connection string for --output-table (default: the gateway database)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.workers = max(1, args.workers)
+    print("🚀 Starting Parallel Extraction...")
+    run_extraction(args)
+    print("\n🎉 EXTRACTION COMPLETED.")
+
+if __name__ == "__main__": main()
@@ -0,0 +1,267 @@
+import os
+import sys
+import csv
+import json
+import time
+import asyncio
+import argparse
+import fnmatch
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+from pathlib import Path
+
+from provision import compile_config, domain_tasks, resolve_config_val, parse_identifier
+
+# ==========================================
+# تنظیمات سراسری
+# ==========================================
+CONFIG_DIR = Path(os.environ.get('GATEWAY_CONFIG_DIR', '/app/configs/domains'))
+FANOUT_MAX_CONNECTIONS = int(os.environ.get('FANOUT_MAX_CONNECTIONS', '16'))
+FANOUT_PER_DOMAIN = int(os.environ.get('FANOUT_PER_DOMAIN', '2'))
+FANOUT_FETCH_ROWS = int(os.environ.get('FANOUT_FETCH_ROWS', '5000'))
+
+OBJECT_SECTIONS = ['views', 'materialized_views', 'tables', 'mirrors', 'incremental_jobs', 'custom_functions']
+FUNCTION_SECTIONS = ('incremental_jobs', 'custom_functions')
+
+# ==========================================
+# انتخاب دامنه‌ها و شیء هدف
+# ==========================================
+
+def find_targets(config_dir, object_template, domain_patterns):
+    # نام شیء با متغیرهای دامنه Resolve می‌شود: hot_${__current__}.get_billparts_stats -> hot_26.get_billparts_stats
+    compiled = compile_config(Path(config_dir))
+    for error in compiled['errors']:
+        print(f"   ❌ Config: {error}")
+    targets = []
+    for domain in compiled['domains']:
+        context_vars = domain['context_vars']
+        label = f"{context_vars['__parent__']}/{context_vars['__current__']}"
+        if domain_patterns and not any(fnmatch.fnmatch(label, p) for p in domain_patterns):
+            continue
+        name = resolve_config_val(object_template, context_vars)
+        for db_name, data, _ in domain_tasks(domain):
+            section = next((s for cfg in data['configs'] for s in OBJECT_SECTIONS
+                            for entry in cfg.get(s, []) if resolve_config_val(entry['name'], context_vars) == name), None)
+            if section:
+                targets.append({'domain': label, 'database': db_name, 'object': name, 'section': section})
+    return targets
+
+def parse_arg_sets(arg_sets):
+    # هر --args یک فراخوانی است: "p_persianyear=1403,p_persianmonth=1"
+    calls = []
+    for item in arg_sets or ['']:
+        args = {}
+        for pair in filter(None, item.split(',')):
+            name, _, value = pair.partition('=')
+            args[name.strip()] = value
+        calls.append(args)
+    return calls
+
+def target_query(target, args):
+    if target['section'] in FUNCTION_SECTIONS:
+        parts = [sql.SQL("{} => {}").format(sql.Identifier(k), sql.Literal(v)) for k, v in args.items()]
+        return sql.SQL("SELECT * FROM {}({})").format(parse_identifier(target['object']), sql.SQL(', ').join(parts))
+    return sql.SQL("SELECT * FROM {}").format(parse_identifier(target['object']))
+
+# ==========================================
+# کلاینت asyncio روی اتصال async در psycopg2
+# ==========================================
+
+async def wait_ready(conn):
+    # poll() اتصال async را جلو می‌برد؛ تا آماده شدن سوکت روی Event Loop منتظر می‌مانیم (بدون Thread)
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        future = loop.create_future()
+        fd = conn.fileno()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, future.set_result, None)
+            try: await future
+            finally: loop.remove_reader(fd)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, future.set_result, None)
+            try: await future
+            finally: loop.remove_writer(fd)
+        else:
+            raise psycopg2.OperationalError(f"unexpected poll state {state}")
+
+async def execute(conn, statement, fetch=False):
+    cur = conn.cursor()
+    cur.execute(statement)
+    await wait_ready(conn)
+    if fetch:
+        return cur.fetchall(), [d.name for d in cur.description or []]
+    return None, None
+
+async def stream_target(unit, target, args, dsn, timeout, fetch_rows, queue):
+    # اتصال async در حالت autocommit است؛ Cursor سمت سرور با BEGIN/DECLARE صریح ساخته و تکه‌تکه FETCH می‌شود
+    conn = psycopg2.connect(dsn, dbname=target['database'], async_=True)
+    try:
+        await wait_ready(conn)
+        query = target_query(target, args).as_string(conn)
+        await execute(conn, f"BEGIN; SET LOCAL statement_timeout = {int(timeout * 1000)};")
+        await execute(conn, f"DECLARE fanout_cursor NO SCROLL CURSOR FOR {query}")
+        rows_total = 0
+        while True:
+            rows, columns = await execute(conn, f"FETCH {int(fetch_rows)} FROM fanout_cursor", fetch=True)
+            if rows:
+                await queue.put(('rows', unit, target, columns, rows))
+                rows_total += len(rows)
+            if len(rows) < fetch_rows:
+                break
+        await execute(conn, "COMMIT")
+        return rows_total
+    finally:
+        conn.close()
+
+async def run_unit(unit, target, args, limits, dsn, timeout, fetch_rows, queue):
+    # خطای هر دامنه فقط همان دامنه را از کار می‌اندازد؛ سایر دامنه‌ها ادامه می‌دهند.
+    # ابتدا سهمیه‌ی دامنه و سپس سهمیه‌ی سراسری گرفته می‌شود تا واحدهای منتظر یک دامنه‌ی شلوغ اسلات سراسری را اشغال نکنند
+    started = time.monotonic()
+    async with limits['domain'][target['domain']], limits['global']:
+        try:
+            rows = await stream_target(unit, target, args, dsn, timeout, fetch_rows, queue)
+            result = {'status': 'ok', 'rows': rows}
+        except Exception as e:
+            result = {'status': 'failed', 'rows': 0, 'error': str(e).strip().splitlines()[0] if str(e).strip() else repr(e)}
+    result.update({'domain': target['domain'], 'database': target['database'], 'object': target['object'],
+                   'arguments': args, 'seconds': round(time.monotonic() - started, 3)})
+    await queue.put(('done', unit, result))
+    return result
+
+# ==========================================
+# ادغام جریان نتایج
+# ==========================================
+
+class StreamWriter:
+    # هر ردیف با منبع خود (_domain، _database) برچسب می‌خورد؛ ترتیب بین دامنه‌ها ترتیب رسیدن است.
+    # ردیف‌ها بدون بافر نوشته می‌شوند، پس فراخوانی‌ای که وسط جریان شکست بخورد خروجی ناقص دارد
+    def __init__(self, path, fmt):
+        self.file = sys.stdout if path == '-' else open(path, 'w', newline='')
+        self.fmt = fmt
+        self.csv = None
+        self.columns = None
+
+    def write(self, target, columns, rows):
+        if self.fmt == 'ndjson':
+            for row in rows:
+                record = {'_domain': target['domain'], '_database': target['database']}
+                record.update(zip(columns, row))
+                self.file.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+            return
+        if self.csv is None:
+            self.columns = columns
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(['_domain', '_database'] + columns)
+        elif columns != self.columns:
+            raise ValueError(f"{target['domain']}: columns {columns} differ from {self.columns}")
+        self.csv.writerows([target['domain'], target['database']] + list(row) for row in rows)
+
+    def mark_failed(self, target, error, rows):
+        # در ndjson یک رکورد نشانگر پس از ردیف‌های ناقص نوشته می‌شود؛ در csv (ستون‌های ثابت) فقط خلاصه و stderr
+        if self.fmt == 'ndjson':
+            self.file.write(json.dumps({'_domain': target['domain'], '_database': target['database'], '_status': 'failed',
+                                        '_error': error, '_rows': rows}, ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self.file is not sys.stdout: self.file.close()
+        else: self.file.flush()
+
+async def fan_out(targets, calls, args):
+    queue = asyncio.Queue(maxsize=args.max_connections * 2)
+    limits = {'global': asyncio.Semaphore(args.max_connections),
+              'domain': {t['domain']: asyncio.Semaphore(args.per_domain) for t in targets}}
+    units = [asyncio.create_task(run_unit(i, t, call, limits, args.dsn, args.timeout, args.fetch_rows, queue))
+             for i, (t, call) in enumerate((t, call) for t in targets for call in calls)]
+    writer = StreamWriter(args.output, args.format)
+    results, pending, written = [], len(units), {}
+    try:
+        while pending:
+            event = await queue.get()
+            if event[0] == 'rows':
+                try:
+                    writer.write(*event[2:])
+                    written[event[1]] = written.get(event[1], 0) + len(event[4])
+                except ValueError as e:
+                    print(f"   ❌ {e}", file=sys.stderr)
+                continue
+            unit, result = event[1:]
+            pending -= 1
+            results.append(result)
+            if result['status'] != 'ok' and written.get(unit):
+                # ردیف‌های پیش از شکست نوشته شده‌اند؛ در جریان و خلاصه به عنوان خروجی ناقص علامت می‌خورند
+                result.update({'rows': written[unit], 'partial': True})
+                writer.mark_failed(result, result['error'], written[unit])
+            icon = "✅" if result['status'] == 'ok' else "❌"
+            detail = f"{result['rows']} rows" if result['status'] == 'ok' else result['error']
+            if result.get('partial'): detail += f" (after {result['rows']} partial rows were written)"
+            print(f"   {icon} {result['domain']} ({result['database']}): {detail} in {result['seconds']:.1f}s", file=sys.stderr)
+    finally:
+        writer.close()
+    await asyncio.gather(*units)
+    return results
+
+# ==========================================
+# اجرای اصلی
+# ==========================================
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the same job, function or view across provincial domain databases concurrently")
+    parser.add_argument('object', help="object name; ${__current__} / ${__parent__} resolve per domain, "
+                                       "e.g. 'hot_${__current__}.get_billparts_stats'")
+    parser.add_argument('--domain', action='append', metavar='PATTERN',
+                        help="domain filter as parent/current glob, e.g. 'biiling/*' (repeatable; default: all)")
+    parser.add_argument('--args', action='append', metavar='NAME=VALUE[,NAME=VALUE]',
+                        help="one call per occurrence, e.g. p_persianyear=1403 (functions and jobs)")
+    parser.add_argument('--max-connections', type=int, default=FANOUT_MAX_CONNECTIONS,
+                        help="concurrent connections overall (env: FANOUT_MAX_CONNECTIONS)")
+    parser.add_argument('--per-domain', type=int, default=FANOUT_PER_DOMAIN,
+                        help="concurrent connections per domain (env: FANOUT_PER_DOMAIN)")
+    parser.add_argument('--fetch-rows', type=int, default=FANOUT_FETCH_ROWS, help="rows per FETCH from each domain")
+    parser.add_argument('--timeout', type=float, default=600, help="statement_timeout per domain query in seconds")
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson',
+                        help="ndjson follows rows of a call that failed mid-stream with a {\"_status\": \"failed\"} record")
+    parser.add_argument('--output', default='-', help="merged result file (default: stdout)")
+    parser.add_argument('--summary', help="write per-domain status, row counts and timings as JSON")
+    parser.add_argument('--dsn', default='', help="libpq connection string of the gateway (default: PG* environment)")
+    parser.add_argument('--config-dir', default=CONFIG_DIR, help="domain configs directory (env: GATEWAY_CONFIG_DIR)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("🚀 Starting Domain Fan-out...", file=sys.stderr)
+    # خروجی LOADING کامپایل کانفیگ با داده‌ی stdout مخلوط نمی‌شود
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        targets = find_targets(args.config_dir, args.object, args.domain)
+    finally:
+        sys.stdout = stdout
+    if not targets:
+        raise SystemExit(f"❌ '{args.object}' is not configured in any selected domain under {args.config_dir}")
+    calls = parse_arg_sets(args.args)
+    print(f"\n🌐 {args.object}: {len(targets)} domain database(s) x {len(calls)} call(s), "
+          f"max {args.max_connections} connections ({args.per_domain} per domain)", file=sys.stderr)
+
+    started = time.monotonic()
+    results = asyncio.run(fan_out(targets, calls, args))
+    wall = time.monotonic() - started
+    failed = [r for r in results if r['status'] != 'ok']
+    slowest = max((r['seconds'] for r in results), default=0)
+    print(f"\n🧾 {sum(r['rows'] for r in results)} rows from {len(results) - len(failed)}/{len(results)} call(s) "
+          f"in {wall:.1f}s (slowest domain {slowest:.1f}s, sum {sum(r['seconds'] for r in results):.1f}s)", file=sys.stderr)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump({'object': args.object, 'seconds': round(wall, 3), 'calls': results}, f, indent=2, default=str)
+    if failed:
+        partial = [r for r in failed if r.get('partial')]
+        print(f"   ⚠️ {len(failed)} call(s) failed; rows of the successful calls were written.", file=sys.stderr)
+        for r in partial:
+            print(f"   ⚠️ {r['domain']} ({r['database']}): {r['rows']} rows written before the failure are incomplete",
+                  file=sys.stderr)
+        sys.exit(1)
+    print("\n🎉 FAN-OUT COMPLETED.", file=sys.stderr)
+
+if __name__ == "__main__": main()
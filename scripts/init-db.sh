@@ -10,6 +10,9 @@ echo "🚀 Starting PostgreSQL Gateway Initialization..."
 # اگر فایل وجود نداشته باشد، رد می‌شود (Skip) اما دیتابیس بالا می‌آید
 PYTHON_SCRIPT_PATH="/app/scripts/provision.py"
 
+# ماژول‌های آماری مورد نیاز Exporter (pg_stat_statements و آمار توابع)
+POSTGRES_OPTS=(-c shared_preload_libraries=pg_stat_statements -c pg_stat_statements.track=all -c track_functions=pl)
+
 # 1. شروع سرویس Cron
 echo "🕒 Starting Cron Service..."
 service cron start
@@ -19,38 +22,49 @@ mkdir -p /var/run/postgresql
 chown postgres:postgres /var/run/postgresql
 chmod 775 /var/run/postgresql
 
-# 3. اجرای دیتابیس در پس‌زمینه (Background)
-echo "⏳ Starting PostgreSQL in background..."
-docker-entrypoint.sh postgres &
+# تنظیمات PgBouncer در هر راه‌اندازی از نو تولید می‌شود؛ فایل قدیمی حذف می‌شود تا Healthcheck منتظر نسخه‌ی تازه بماند
+rm -f "${PGBOUNCER_CONFIG:-/app/configs/pgbouncer/pgbouncer.ini}"
+
+# 3. اجرای دیتابیس (فقط یک بار؛ بدون چرخه‌ی توقف و شروع مجدد)
+echo "🚀 Starting PostgreSQL..."
+docker-entrypoint.sh postgres "${POSTGRES_OPTS[@]}" &
 POSTGRES_PID=$!
 
-# 4. صبر کردن تا زمانی که دیتابیس کاملاً آماده شود
-sleep 2
+# توقف کانتینر به PostgreSQL (و Watcher) منتقل می‌شود تا خاموشی تمیز باشد
+WATCH_PID=""
+trap 'kill -TERM $POSTGRES_PID 2>/dev/null || true; [ -n "$WATCH_PID" ] && kill -TERM $WATCH_PID 2>/dev/null || true' TERM INT
 
+# 4. صبر کردن تا زمانی که دیتابیس روی TCP آماده شود
+# (سرور موقت مرحله‌ی initdb فقط روی سوکت گوش می‌دهد و نباید Provision شود)
 echo "⏳ Waiting for PostgreSQL to accept connections..."
-until pg_isready -U "$POSTGRES_USER" -d "$POSTGRES_DB"; do
-  echo "Waiting for database... (sleep 1s)"
+until pg_isready -h localhost -U "$POSTGRES_USER" -d "$POSTGRES_DB" >/dev/null 2>&1; do
+  if ! kill -0 $POSTGRES_PID 2>/dev/null; then
+    echo "❌ PostgreSQL exited during startup."
+    wait $POSTGRES_PID || true
+    exit 1
+  fi
   sleep 1
 done
 echo "✅ PostgreSQL is ready."
 
-# 5. اجرای فایل پایتون
+# 5. اجرای فایل پایتون در کنار دیتابیس در حال اجرا؛ در حالت Watch تغییرات کانفیگ بدون ری‌استارت اعمال می‌شوند
 if [ -f "$PYTHON_SCRIPT_PATH" ]; then
-    echo "🐍 Running Python initialization script: $PYTHON_SCRIPT_PATH ..."
+    WATCH_FLAG=""
+    case "${PROVISION_WATCH:-true}" in
+        1|true|yes) WATCH_FLAG="--watch" ;;
+    esac
+    echo "🐍 Running Python provisioning script: $PYTHON_SCRIPT_PATH $WATCH_FLAG ..."
     # استفاده از gosu برای اجرا با دسترسی کاربر postgres
-    gosu postgres python3 "$PYTHON_SCRIPT_PATH"
-    echo "✅ Python script executed successfully."
+    gosu postgres python3 "$PYTHON_SCRIPT_PATH" $WATCH_FLAG &
+    WATCH_PID=$!
 else
     echo "⚠️  Python script not found at: $PYTHON_SCRIPT_PATH (Skipping initialization logic)"
 fi
 
-# 6. متوقف کردن دیتابیس پس‌زمینه
-echo "🛑 Stopping temporary PostgreSQL process..."
-# استفاده از gosu برای توقف تمیز دیتابیس
-gosu postgres pg_ctl -D "$PGDATA" -m fast stop
-# منتظر ماندن برای خروج کامل پروسه
-wait $POSTGRES_PID 2>/dev/null || true
-
-# 7. اجرای نهایی دیتابیس در حالت پیش‌زمینه (Foreground)
-echo "🚀 Starting PostgreSQL in foreground mode..."
-exec docker-entrypoint.sh postgres
\ No newline at end of file
+# 6. ماندن در پیش‌زمینه تا پایان PostgreSQL (wait با سیگنال قطع می‌شود، پس دوباره صبر می‌کنیم)
+STATUS=0
+while kill -0 $POSTGRES_PID 2>/dev/null; do
+    wait $POSTGRES_PID && STATUS=0 || STATUS=$?
+done
+[ -n "$WATCH_PID" ] && kill -TERM $WATCH_PID 2>/dev/null || true
+exit $STATUS
@@ -1,9 +1,19 @@
 import os
+import io
+import re
+import sys
+import json
+import time
+import argparse
+import hashlib
+import threading
+import subprocess
 import psycopg2
 from psycopg2 import sql
 import yaml
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ==========================================
 # تنظیمات سراسری
@@ -11,6 +21,21 @@ from collections import defaultdict
 DB_ADMIN_USER = os.environ.get('POSTGRES_USER')
 DB_ADMIN_PASS = os.environ.get('POSTGRES_PASSWORD')
 DB_DEFAULT_NAME = os.environ.get('POSTGRES_DB')
+PROVISION_JOBS = int(os.environ.get('PROVISION_JOBS', '4'))
+PROVISION_FORCE = os.environ.get('PROVISION_FORCE', '').lower() in ('1', 'true', 'yes')
+PROVISION_TRANSACTIONAL = os.environ.get('PROVISION_TRANSACTIONAL', '').lower() in ('1', 'true', 'yes')
+PROVISION_BATCH_SIZE = int(os.environ.get('PROVISION_BATCH_SIZE', '200'))
+PROVISION_REFRESH_SNAPSHOTS = os.environ.get('PROVISION_REFRESH_SNAPSHOTS', '').lower() in ('1', 'true', 'yes')
+CONFIG_DIR = Path(os.environ.get('GATEWAY_CONFIG_DIR', '/app/configs/domains'))
+PLAN_CACHE_FILE = Path(os.environ.get('PROVISION_PLAN_CACHE', '/app/configs/.provision-plan.json'))
+PROVISION_WATCH_INTERVAL = float(os.environ.get('PROVISION_WATCH_INTERVAL', '2'))
+PROVISION_WATCH_DEBOUNCE = float(os.environ.get('PROVISION_WATCH_DEBOUNCE', '3'))
+PGBOUNCER_CONFIG_FILE = Path(os.environ.get('PGBOUNCER_CONFIG', '/app/configs/pgbouncer/pgbouncer.ini'))
+PGBOUNCER_DB_HOST = os.environ.get('PGBOUNCER_DB_HOST', 'postgres')
+PGBOUNCER_HOST = os.environ.get('PGBOUNCER_HOST', 'pgbouncer')
+PGBOUNCER_DEFAULT_POOL_SIZE = int(os.environ.get('PGBOUNCER_DEFAULT_POOL_SIZE', '20'))
+PGBOUNCER_MAX_CLIENT_CONN = int(os.environ.get('PGBOUNCER_MAX_CLIENT_CONN', '500'))
+PGBOUNCER_POOL_MODE = os.environ.get('PGBOUNCER_POOL_MODE', 'transaction')
 
 def connect(db='postgres'):
     try:
@@ -26,6 +51,14 @@ def connect(db='postgres'):
         print(f"❌ Connection failed to {db}: {e}")
         raise
 
+# خطاهای زمان ساخت Plan (کانفیگ نامعتبر برای یک شیء) برای هر Thread شمرده می‌شوند تا
+# process_single_database تعداد خطای دیتابیس را بدون تجزیه‌ی خروجی چاپی گزارش کند
+PLAN_ERRORS = threading.local()
+
+def plan_error(message):
+    print(f"      ❌ {message}")
+    PLAN_ERRORS.count = getattr(PLAN_ERRORS, 'count', 0) + 1
+
 def resolve_global_env(val):
     if not isinstance(val, str): return val
     if val.startswith('${') and val.endswith('}'):
@@ -36,7 +69,7 @@ def resolve_global_env(val):
     return val
 
 def resolve_config_val(val, context_vars):
-    if not isinstance(val, str): return val
+    if not isinstance(val, str) or '${' not in val: return val
     for key, value in context_vars.items():
         val = val.replace(f"${{{key}}}", value)
     if val.startswith('${') and val.endswith('}'):
@@ -51,105 +84,730 @@ def parse_identifier(name_str):
     return sql.Identifier(*parts)
 
 # ==========================================
-# زیرساخت امنیتی
+# برنامه اجرا و اثر انگشت اشیا (Plan & Fingerprints)
 # ==========================================
 
-def setup_security_infrastructure(conn_db):
-    cur = conn_db.cursor()
+def plan_item(kind, name, statements, depends_on=None, label=None, quiet=False, cron=None, grant=None):
+    # هر شیء (جدول، ویو، تابع، GRANT و ...) یک آیتم با دستورات رندر شده‌ی خودش است
+    # depends_on: نام اشیایی که اگر در این اجرا دوباره ساخته شوند، این آیتم هم باید دوباره اجرا شود
+    return {
+        'kind': kind,
+        'name': name,
+        'statements': [st if isinstance(st, tuple) else (st, None) for st in statements],
+        'depends_on': depends_on or [],
+        'label': label,
+        'quiet': quiet,
+        'cron': cron,
+        'grant': grant,
+    }
+
+def render_statement(cur, statement, params=None):
+    if cur is None: return render_offline(statement, params)
+    rendered = cur.mogrify(statement, params) if params is not None else (
+        statement.as_string(cur) if isinstance(statement, sql.Composable) else statement)
+    return rendered.decode() if isinstance(rendered, bytes) else rendered
+
+def quote_literal(value):
+    # معادل خروجی psycopg2 با standard_conforming_strings = on (پیش‌فرض PostgreSQL)
+    if value is None: return 'NULL'
+    if isinstance(value, bool): return 'true' if value else 'false'
+    if isinstance(value, (int, float)): return repr(value)
+    if isinstance(value, (list, tuple)):
+        return f"ARRAY[{', '.join(quote_literal(v) for v in value)}]" if value else "'{}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+def render_offline(statement, params=None):
+    # رندر بدون اتصال برای --plan؛ sql.Composed مستقیماً پیمایش می‌شود
+    def compose(obj):
+        if isinstance(obj, sql.Composed): return "".join(compose(part) for part in obj.seq)
+        if isinstance(obj, sql.SQL): return obj.string
+        if isinstance(obj, sql.Identifier): return ".".join('"' + s.replace('"', '""') + '"' for s in obj.strings)
+        if isinstance(obj, sql.Literal): return quote_literal(obj.wrapped)
+        if isinstance(obj, sql.Placeholder): return f"%({obj.name})s" if obj.name else "%s"
+        return obj
+    rendered = compose(statement)
+    if params is None: return rendered
+    if isinstance(params, dict): return rendered % {k: quote_literal(v) for k, v in params.items()}
+    return rendered % tuple(quote_literal(v) for v in params)
+
+def setup_fingerprint_table(cur):
     cur.execute("""
+        CREATE TABLE IF NOT EXISTS provision_fingerprints (
+            object_kind VARCHAR(64),
+            object_name TEXT,
+            fingerprint CHAR(64) NOT NULL,
+            applied_at TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (object_kind, object_name)
+        );
+    """)
+    cur.execute("SELECT object_kind, object_name, fingerprint FROM provision_fingerprints;")
+    return {(k, n): f for k, n, f in cur.fetchall()}
+
+def coalesce_grants(entries):
+    # GRANTهای هم‌نوع برای یک نقش در یک دستور ادغام می‌شوند: GRANT SELECT ON a, b, c TO role
+    units = []
+    grant_units = {}
+    for entry in entries:
+        grant = entry['item']['grant']
+        if not grant:
+            units.append([entry])
+            continue
+        privilege, on_class, _, role = grant
+        group_key = (privilege, on_class, role)
+        if group_key not in grant_units:
+            grant_units[group_key] = []
+            units.append(grant_units[group_key])
+        grant_units[group_key].append(entry)
+    return units
+
+def unit_sql(unit):
+    if len(unit) == 1:
+        return unit[0]['sql']
+    privilege, on_class, _, role = unit[0]['item']['grant']
+    targets = ", ".join(entry['item']['grant'][2] for entry in unit)
+    return f"GRANT {privilege} ON {on_class}{targets} TO {role};"
+
+def execute_entry(cur, entry, savepoint=False):
+    try:
+        if savepoint: cur.execute("SAVEPOINT provision_object;")
+        cur.execute(entry['sql'])
+        if savepoint: cur.execute("RELEASE SAVEPOINT provision_object;")
+        return True
+    except Exception as e:
+        if savepoint: cur.execute("ROLLBACK TO SAVEPOINT provision_object;")
+        if not entry['item']['quiet']:
+            print(f"      ❌ {entry['item']['kind']} Error {entry['item']['name']}: {e}")
+        return False
+
+def execute_autocommit(cur, entries):
+    return [entry for entry in entries if execute_entry(cur, entry)]
+
+def execute_transactional(cur, entries):
+    # همه یا هیچ: دستورات در دسته‌های چندتایی در یک تراکنش ارسال می‌شوند؛ اگر دسته‌ای شکست بخورد
+    # اشیای آن دسته تک‌تک (با Savepoint) اجرا می‌شوند تا شیء خراب مشخص شود و سپس کل تراکنش Rollback می‌شود
+    applied = []
+    units = coalesce_grants(entries)
+    for start in range(0, len(units), PROVISION_BATCH_SIZE):
+        batch = units[start:start + PROVISION_BATCH_SIZE]
+        try:
+            cur.execute("SAVEPOINT provision_batch;\n" + "\n".join(unit_sql(u) for u in batch) +
+                        "\nRELEASE SAVEPOINT provision_batch;")
+            applied += [entry for unit in batch for entry in unit]
+            continue
+        except Exception:
+            cur.execute("ROLLBACK TO SAVEPOINT provision_batch;")
+        for entry in (entry for unit in batch for entry in unit):
+            if not execute_entry(cur, entry, savepoint=True):
+                raise RuntimeError(f"{entry['item']['kind']} {entry['item']['name']} failed; "
+                                   f"none of the {len(entries)} pending object(s) were applied")
+    return applied
+
+def apply_plan(conn_db, plan, force=False, transactional=False):
+    cur = conn_db.cursor()
+    stored = setup_fingerprint_table(cur)
+    report = {'added': [], 'changed': [], 'unchanged': 0, 'failed': [], 'removed': []}
+    dirty_names = set()
+    seen = set()
+    pending = []
+
+    for item in plan:
+        key = (item['kind'], item['name'])
+        if key in seen: continue
+        seen.add(key)
+        rendered = "\n".join(render_statement(cur, st, params) for st, params in item['statements'])
+        fingerprint = hashlib.sha256(rendered.encode()).hexdigest()
+        dirty = (force or stored.get(key) != fingerprint
+                 or any(dep in dirty_names for dep in item['depends_on']))
+        if not dirty:
+            report['unchanged'] += 1
+            continue
+        dirty_names.add(item['name'])
+        pending.append({'item': item, 'key': key, 'fingerprint': fingerprint, 'sql': rendered})
+
+    if transactional:
+        conn_db.autocommit = False
+        applied = execute_transactional(cur, pending)
+    else:
+        applied = execute_autocommit(cur, pending)
+
+    applied_keys = set()
+    for entry in applied:
+        applied_keys.add(entry['key'])
+        report['changed' if entry['key'] in stored else 'added'].append(entry['key'])
+        if entry['item']['label'] and not entry['item']['quiet']:
+            print(f"      {entry['item']['label']}: {entry['item']['name']}")
+    report['failed'] = [entry['key'] for entry in pending if entry['key'] not in applied_keys]
+    report['errors'] = sum(1 for entry in pending if entry['key'] not in applied_keys and not entry['item']['quiet'])
+
+    if applied:
+        args = [(e['key'][0], e['key'][1], e['fingerprint']) for e in applied]
+        values_sql = ", ".join(["(%s, %s, %s, now())"] * len(args))
+        cur.execute(f"""
+            INSERT INTO provision_fingerprints (object_kind, object_name, fingerprint, applied_at)
+            VALUES {values_sql}
+            ON CONFLICT (object_kind, object_name) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, applied_at = now();
+        """, [v for row in args for v in row])
+
+    # اشیایی که از کانفیگ حذف شده‌اند فقط گزارش می‌شوند؛ خود شیء در دیتابیس دست نمی‌خورد
+    for key in sorted(set(stored) - seen):
+        cur.execute("DELETE FROM provision_fingerprints WHERE object_kind = %s AND object_name = %s;", key)
+        report['removed'].append(key)
+        print(f"      🗑️  Removed from config (left in database): {key[0]} {key[1]}")
+
+    if transactional:
+        conn_db.commit()
+        conn_db.autocommit = True
+
+    print(f"      🧾 Objects: {len(report['added'])} added, {len(report['changed'])} changed, "
+          f"{report['unchanged']} unchanged, {len(report['removed'])} removed, {len(report['failed'])} failed")
+    cur.close()
+    return report
+
+# ==========================================
+# تنظیمات کارایی FDW (Server/Table Options)
+# ==========================================
+
+# نوع مقدار هر گزینه: bool (true/false)، 'flag' (0/1 در tds_fdw)، int، float یا لیست مقادیر مجاز
+FDW_OPTION_TYPES = {
+    'tds': {
+        'server': {
+            'row_estimate_method': ('execute', 'showplan_all'),
+            'use_remote_estimate': 'flag',
+            'fdw_startup_cost': float,
+            'fdw_tuple_cost': float,
+            'msg_handler': ('notice', 'blackhole'),
+            'sqlserver_ansi_mode': bool,
+            'character_set': str,
+            'language': str,
+        },
+        'table': {
+            'row_estimate_method': ('execute', 'showplan_all'),
+            'match_column_names': 'flag',
+            'use_remote_estimate': 'flag',
+            'local_tuple_estimate': int,
+        },
+    },
+    'mysql': {
+        'server': {
+            'fetch_size': int,
+            'use_remote_estimate': bool,
+            'reconnect': bool,
+            'character_set': str,
+            'fdw_startup_cost': float,
+            'fdw_tuple_cost': float,
+        },
+        'table': {
+            'fetch_size': int,
+            'max_blob_size': int,
+        },
+    },
+    'postgres': {
+        'server': {
+            'use_remote_estimate': bool,
+            'fetch_size': int,
+            'fdw_startup_cost': float,
+            'fdw_tuple_cost': float,
+            'async_capable': bool,
+            'extensions': str,
+        },
+        'table': {
+            'use_remote_estimate': bool,
+            'fetch_size': int,
+            'async_capable': bool,
+        },
+    },
+}
+
+def format_fdw_option(value, expected):
+    if isinstance(expected, tuple):
+        if value not in expected: raise ValueError(f"must be one of: {', '.join(expected)}")
+        return value
+    if expected in ('flag', bool):
+        if not isinstance(value, bool): raise ValueError("must be true or false")
+        if expected == 'flag': return '1' if value else '0'
+        return 'true' if value else 'false'
+    if expected is int:
+        if isinstance(value, bool) or not isinstance(value, int): raise ValueError("must be an integer")
+        return str(value)
+    if expected is float:
+        if isinstance(value, bool) or not isinstance(value, (int, float)): raise ValueError("must be a number")
+        return str(value)
+    return str(value)
+
+def validate_fdw_options(fdw_type, level, options, owner_name):
+    allowed = FDW_OPTION_TYPES.get(fdw_type, {}).get(level, {})
+    validated = {}
+    for key, value in (options or {}).items():
+        if key not in allowed:
+            plan_error(f"Option Error {owner_name}: '{key}' is not a {fdw_type}_fdw {level} option")
+            continue
+        try:
+            validated[key] = format_fdw_option(value, allowed[key])
+        except ValueError as e:
+            plan_error(f"Option Error {owner_name}: {key} {e}")
+    return validated
+
+def plan_sync_options(cur, kind, name, target_sql, alter_clause, current_options_sql, options, drop=()):
+    # در اجرای مجدد، برای هر گزینه بر اساس کاتالوگ تصمیم گرفته می‌شود که ADD باشد یا SET
+    # گزینه‌های drop (مثلاً table_name پس از تبدیل جدول به query) در صورت وجود حذف می‌شوند
+    target = render_statement(cur, target_sql)
+    lines = []
+    for key in drop:
+        lines.append(sql.SQL("""
+            IF {} = ANY(v_keys) THEN EXECUTE format('{} %s OPTIONS (DROP %I)', {}, {}); END IF;""").format(
+            sql.Literal(key), sql.SQL(alter_clause), sql.Literal(target), sql.Literal(key)))
+    for key, value in options.items():
+        lines.append(sql.SQL("""
+            EXECUTE format('{} %s OPTIONS (%s %I %L)', {}, CASE WHEN {} = ANY(v_keys) THEN 'SET' ELSE 'ADD' END, {}, {});""").format(
+            sql.SQL(alter_clause), sql.Literal(target), sql.Literal(key), sql.Literal(key), sql.Literal(value)))
+    stmt = sql.SQL("""
+        DO $$         DECLARE v_keys TEXT[];
+        BEGIN
+            v_keys := ARRAY(SELECT option_name FROM pg_options_to_table(({})));{}
+        END; $$;
+    """).format(sql.SQL(current_options_sql).format(sql.Literal(name)), sql.Composed(lines))
+    return plan_item(kind, name, [stmt], depends_on=[name])
+
+# ==========================================
+# زیرساخت امنیتی
+# ==========================================
+
+def plan_security_infrastructure():
+    items = []
+    items.append(plan_item('infrastructure', 'auth_policies', ["""
         CREATE TABLE IF NOT EXISTS auth_policies (
             username VARCHAR(255) PRIMARY KEY, 
             allowed_start TIME, 
             allowed_end TIME, 
             description TEXT
         );
-    """)
-    cur.execute("""
+    """, "ALTER TABLE auth_policies ADD COLUMN IF NOT EXISTS time_zone TEXT;"]))
+
+    # بازه‌ای که از نیمه‌شب عبور می‌کند (مثلاً 22:00 تا 06:00) هم پشتیبانی می‌شود
+    items.append(plan_item('infrastructure', 'access_window_open', ["""
+        CREATE OR REPLACE FUNCTION access_window_open(p_start TIME, p_end TIME, p_time_zone TEXT) RETURNS BOOLEAN AS $$             SELECT CASE
+                WHEN p_start IS NULL OR p_end IS NULL THEN TRUE
+                WHEN p_start <= p_end THEN (now() AT TIME ZONE coalesce(p_time_zone, 'UTC'))::time BETWEEN p_start AND p_end
+                ELSE (now() AT TIME ZONE coalesce(p_time_zone, 'UTC'))::time NOT BETWEEN p_end AND p_start
+            END;
+        $$ LANGUAGE sql STABLE;
+    """], depends_on=['auth_policies']))
+
+    items.append(plan_item('infrastructure', 'enforce_access_policy', ["""
         CREATE OR REPLACE FUNCTION enforce_access_policy() RETURNS VOID AS $$         DECLARE rec RECORD; 
         BEGIN
             SELECT * INTO rec FROM auth_policies WHERE username = current_user;
-            IF FOUND AND rec.allowed_start IS NOT NULL AND rec.allowed_end IS NOT NULL THEN
-                IF current_time < rec.allowed_start OR current_time > rec.allowed_end THEN
-                    RAISE EXCEPTION 'Access DENIED for % outside allowed hours', current_user;
-                END IF;
+            IF FOUND AND NOT access_window_open(rec.allowed_start, rec.allowed_end, rec.time_zone) THEN
+                RAISE EXCEPTION 'Access DENIED for % outside allowed hours', current_user;
             END IF;
         END; $$ LANGUAGE plpgsql;
-    """)
-    cur.close()
+    """], depends_on=['access_window_open']))
+
+    # سیاست فقط یک بار در شروع هر Session بررسی می‌شود (Login Event Trigger، PostgreSQL 17+)؛
+    # منطقه‌ی زمانی از جدول خوانده می‌شود چون TimeZone و تنظیمات Session را کلاینت هنگام اتصال می‌تواند تغییر دهد
+    items.append(plan_item('infrastructure', 'enforce_login_policy', ["""
+        CREATE OR REPLACE FUNCTION enforce_login_policy() RETURNS event_trigger AS $$         DECLARE rec RECORD;
+        BEGIN
+            SELECT * INTO rec FROM public.auth_policies WHERE username = session_user;
+            IF FOUND AND NOT public.access_window_open(rec.allowed_start, rec.allowed_end, rec.time_zone) THEN
+                RAISE EXCEPTION 'Access DENIED for % outside allowed hours (% - % %)',
+                    session_user, rec.allowed_start, rec.allowed_end, coalesce(rec.time_zone, 'UTC');
+            END IF;
+        END; $$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = pg_catalog, public;
+    """, """
+        DO $$         BEGIN
+            IF current_setting('server_version_num')::int < 170000 THEN
+                RAISE NOTICE 'Login event triggers need PostgreSQL 17+; access_time is only enforced by terminate_expired_sessions()';
+            ELSIF NOT EXISTS (SELECT 1 FROM pg_event_trigger WHERE evtname = 'gateway_login_policy') THEN
+                CREATE EVENT TRIGGER gateway_login_policy ON login EXECUTE FUNCTION enforce_login_policy();
+            END IF;
+        END; $$;
+    """], depends_on=['access_window_open']))
+
+    # Sessionهایی که پس از پایان بازه‌ی مجاز باز مانده‌اند توسط Cron بسته می‌شوند
+    items.append(plan_item('infrastructure', 'terminate_expired_sessions', ["""
+        CREATE OR REPLACE FUNCTION terminate_expired_sessions() RETURNS INTEGER AS $$             SELECT count(pg_terminate_backend(a.pid))::int
+            FROM pg_stat_activity a
+            JOIN auth_policies p ON p.username = a.usename
+            JOIN pg_roles r ON r.rolname = a.usename
+            WHERE a.datname = current_database()
+              AND a.pid <> pg_backend_pid()
+              AND NOT r.rolsuper
+              AND NOT access_window_open(p.allowed_start, p.allowed_end, p.time_zone);
+        $$ LANGUAGE sql;
+    """], depends_on=['access_window_open']))
+    return items
+
+# ==========================================
+# ثبت فراخوانی توابع تولیدشده (Instrumentation)
+# ==========================================
+
+INSTRUMENT_DECLARE = """
+            v_call_started TIMESTAMPTZ := clock_timestamp();
+            v_scan_started TIMESTAMPTZ;
+            v_scan_ms FLOAT8 := 0;
+            v_rows BIGINT := 0;"""
+
+def plan_instrumentation_infrastructure(ring_size):
+    # جدول حلقوی UNLOGGED: بدون WAL و با اندازه‌ی ثابت؛ هر فراخوانی خانه‌ی nextval % ring_size را بازنویسی می‌کند
+    items = []
+    items.append(plan_item('infrastructure', 'function_call_log', ["""
+        CREATE UNLOGGED TABLE IF NOT EXISTS function_call_log (
+            slot INTEGER PRIMARY KEY,
+            function_name VARCHAR(255),
+            caller NAME,
+            application_name TEXT,
+            arguments JSONB,
+            rows_returned BIGINT,
+            wall_ms FLOAT8,
+            scan_ms FLOAT8,
+            called_at TIMESTAMPTZ
+        );
+    """, "CREATE SEQUENCE IF NOT EXISTS function_call_log_seq;"]))
+
+    # ثبت همزمان (داخل فراخوانی) و عمداً غیرمعوق است: یک UPSERT روی جدول UNLOGGED بدون WAL و fsync در حد چند ده
+    # میکروثانیه است، در حالی که راه‌های معوق‌کردن در PostgreSQL بدون Extension گران‌ترند (NOTIFY همه‌ی Commitهای
+    # اعلان‌دهنده را با یک قفل سراسری سریال می‌کند و بافر نشست هم باز داخل یک فراخوانی Flush می‌شود و با قطع اتصال گم می‌شود).
+    # در تراکنش فقط‌خواندنی / Hot Standby ثبت از ابتدا رد می‌شود و هر خطای دیگر فراخوانی اصلی را از کار نمی‌اندازد
+    items.append(plan_item('infrastructure', 'log_function_call', [f"""
+        CREATE OR REPLACE FUNCTION log_function_call(
+            p_function TEXT, p_arguments JSONB, p_rows BIGINT, p_wall_ms FLOAT8, p_scan_ms FLOAT8
+        ) RETURNS VOID AS $$         BEGIN
+            IF current_setting('transaction_read_only')::boolean THEN
+                RETURN;
+            END IF;
+            INSERT INTO function_call_log AS l
+                (slot, function_name, caller, application_name, arguments, rows_returned, wall_ms, scan_ms, called_at)
+            VALUES ((nextval('function_call_log_seq') % {int(ring_size)})::int, p_function, session_user,
+                    current_setting('application_name', true), p_arguments, p_rows, p_wall_ms, p_scan_ms, clock_timestamp())
+            ON CONFLICT (slot) DO UPDATE SET
+                function_name = EXCLUDED.function_name, caller = EXCLUDED.caller,
+                application_name = EXCLUDED.application_name, arguments = EXCLUDED.arguments,
+                rows_returned = EXCLUDED.rows_returned, wall_ms = EXCLUDED.wall_ms,
+                scan_ms = EXCLUDED.scan_ms, called_at = EXCLUDED.called_at;
+        EXCEPTION WHEN OTHERS THEN
+            NULL;
+        END;
+        $$ LANGUAGE plpgsql SECURITY DEFINER;
+    """], depends_on=['function_call_log']))
+
+    stats_sql = """
+            count(*) AS calls,
+            sum(rows_returned) AS rows_returned,
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY wall_ms) AS p50_ms,
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY wall_ms) AS p95_ms,
+            percentile_cont(0.99) WITHIN GROUP (ORDER BY wall_ms) AS p99_ms,
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY scan_ms) AS scan_p95_ms,
+            round((sum(scan_ms) / NULLIF(sum(wall_ms), 0))::numeric, 3) AS scan_share,
+            max(called_at) AS last_call"""
+    items.append(plan_item('view', 'function_call_stats', [f"""
+        CREATE OR REPLACE VIEW function_call_stats AS
+        SELECT function_name,{stats_sql}
+        FROM function_call_log GROUP BY function_name;
+    """, f"""
+        CREATE OR REPLACE VIEW function_call_stats_by_consumer AS
+        SELECT function_name, caller,{stats_sql}
+        FROM function_call_log GROUP BY function_name, caller;
+    """], depends_on=['function_call_log'], label="📈 Instrumentation views"))
+    return items
+
+def instrument_scan(statement):
+    # زمان اسکن = اجرای کوئری (Remote Scan) تا پایان نوشتن در Tuplestore تابع
+    return f"""
+            v_scan_started := clock_timestamp();
+            {statement}
+            GET DIAGNOSTICS v_rows = ROW_COUNT;
+            v_scan_ms := v_scan_ms + 1000 * extract(epoch FROM clock_timestamp() - v_scan_started);"""
+
+def instrument_finish(func_name_str, arg_names):
+    args_sql = ", ".join(f"'{a}', {a}" for a in arg_names)
+    return f"""
+            PERFORM log_function_call('{func_name_str}', jsonb_build_object({args_sql}), v_rows,
+                                      1000 * extract(epoch FROM clock_timestamp() - v_call_started), v_scan_ms);"""
 
 # ==========================================
 # توابع افزایشی (Incremental Jobs)
 # ==========================================
 
-def create_incremental_job_functions(conn_db, jobs_config, context_vars):
-    cur = conn_db.cursor()
+def get_relation_columns(cur, rel_name):
+    if cur is None: return []
+    cur.execute("""
+        SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum;
+    """, (rel_name,))
+    return [{'name': r[0], 'type': r[1]} for r in cur.fetchall()]
+
+JOB_WINDOW_UNITS = ('seconds', 'minutes', 'hours', 'days', 'weeks', 'months')
+# انتهای پنجره‌ای که تابع range واقعاً خوانده (پس از محدودسازی با window.max / حالت تطبیقی) در همین تنظیم
+# محلی تراکنش گذاشته می‌شود تا کلاینت‌ها (extract.py، benchmark.py، export.py) دقیقاً از همان نقطه ادامه دهند.
+# قرارداد: مقدار فقط تا پایان تراکنش فراخوانی معتبر است؛ کلاینت باید آن را در همان تراکنش (نه در حالت autocommit
+# و نه در تراکنش بعدی) با current_setting('gateway.window_end', true) بخواند. همین متن در COMMENT تابع ثبت می‌شود
+JOB_WINDOW_END_SETTING = 'gateway.window_end'
+
+def fetch_window_end(cur):
+    cur.execute("SELECT current_setting(%s, true);", (JOB_WINDOW_END_SETTING,))
+    value = cur.fetchone()[0]
+    if not value:
+        raise RuntimeError("range job did not report its window end; re-run provision.py to regenerate the function")
+    return value
+
+ADAPTIVE_DECLARE = """
+            v_window NUMERIC;
+            v_batch_rows BIGINT;
+            v_batch_started TIMESTAMPTZ;"""
+
+def plan_job_batch_state():
+    # حالت تطبیقی: اندازه‌ی پنجره‌ی بعدی هر Job از تعداد ردیف و زمان دسته‌ی قبلی محاسبه و اینجا نگه داشته می‌شود
+    items = []
+    items.append(plan_item('infrastructure', 'job_batch_state', ["""
+        CREATE TABLE IF NOT EXISTS job_batch_state (
+            job_name VARCHAR(255) PRIMARY KEY,
+            next_window NUMERIC NOT NULL,
+            last_window NUMERIC,
+            last_rows BIGINT,
+            last_ms FLOAT8,
+            batches BIGINT DEFAULT 0,
+            updated_at TIMESTAMPTZ
+        );
+    """]))
+    # نسبت هدف به مقدار مشاهده‌شده در هر دور حداکثر ۴ برابر (یا یک‌چهارم) اعمال می‌شود تا پنجره نوسان نکند
+    items.append(plan_item('infrastructure', 'record_job_batch', ["""
+        CREATE OR REPLACE FUNCTION record_job_batch(
+            p_job TEXT, p_window NUMERIC, p_rows BIGINT, p_ms FLOAT8,
+            p_target_rows BIGINT, p_target_ms FLOAT8, p_min NUMERIC, p_max NUMERIC
+        ) RETURNS NUMERIC AS $$         DECLARE
+            v_ratio FLOAT8;
+            v_next NUMERIC;
+        BEGIN
+            v_ratio := LEAST(p_target_rows::float8 / GREATEST(p_rows, 1), p_target_ms / GREATEST(p_ms, 1));
+            v_next := LEAST(GREATEST(p_window * LEAST(GREATEST(COALESCE(v_ratio, 1), 0.25), 4)::numeric, p_min), p_max);
+            INSERT INTO job_batch_state (job_name, next_window, last_window, last_rows, last_ms, batches, updated_at)
+            VALUES (p_job, v_next, p_window, p_rows, p_ms, 1, now())
+            ON CONFLICT (job_name) DO UPDATE SET
+                next_window = EXCLUDED.next_window, last_window = EXCLUDED.last_window,
+                last_rows = EXCLUDED.last_rows, last_ms = EXCLUDED.last_ms,
+                batches = job_batch_state.batches + 1, updated_at = EXCLUDED.updated_at;
+            RETURN v_next;
+        EXCEPTION WHEN OTHERS THEN
+            RETURN p_window;
+        END; $$ LANGUAGE plpgsql SECURITY DEFINER;
+    """], depends_on=['job_batch_state']))
+    return items
+
+def job_adaptive_settings(job, func_name_str, min_default, max_window):
+    adaptive = job.get('adaptive')
+    if not adaptive: return None
+    if not isinstance(adaptive, dict) or not (adaptive.get('target_rows') or adaptive.get('target_ms')):
+        print(f"      ⚠️ {func_name_str}: adaptive needs target_rows and/or target_ms; using fixed windows.")
+        return None
+    return {
+        'target_rows': adaptive.get('target_rows'),
+        'target_ms': adaptive.get('target_ms'),
+        'min': adaptive.get('min_window', min_default),
+        'max': max_window,
+    }
+
+def adaptive_window_sql(func_name_str, size, adaptive):
+    # p_limit صریح همیشه برنده است؛ با p_limit = NULL پنجره از job_batch_state خوانده می‌شود
+    return f"""
+            IF p_limit IS NULL THEN
+                SELECT next_window INTO v_window FROM job_batch_state WHERE job_name = '{func_name_str}';
+            ELSE
+                v_window := p_limit;
+            END IF;
+            v_window := LEAST(GREATEST(COALESCE(v_window, {size}), {adaptive['min']}), {adaptive['max']});"""
+
+def adaptive_scan(statement):
+    return f"""
+            v_batch_started := clock_timestamp();
+            {statement}
+            GET DIAGNOSTICS v_batch_rows = ROW_COUNT;"""
+
+def adaptive_record_sql(func_name_str, adaptive, rows_var='v_batch_rows', started_var='v_batch_started'):
+    # با Instrumentation فعال، شمارش و زمان‌سنجی اسکن از متغیرهای همان بخش خوانده می‌شود
+    return f"""
+            IF p_limit IS NULL THEN
+                PERFORM record_job_batch('{func_name_str}', v_window, {rows_var},
+                                         1000 * extract(epoch FROM clock_timestamp() - {started_var}),
+                                         {adaptive['target_rows'] or 'NULL'}, {adaptive['target_ms'] or 'NULL'},
+                                         {adaptive['min']}, {adaptive['max']});
+            END IF;"""
+
+def keyset_scan_sql(target_table_str, key_column, columns, filters_sql='', last='$1', limit='$2'):
+    # متن اسکن keyset که تابع اجرا می‌کند؛ audit.py همین متن را با مقادیر نمونه EXPLAIN می‌کند
+    col_names_sql = ", ".join(c['name'] for c in columns)
+    return (f"SELECT b.*, max(b.{key_column}) OVER () FROM ("
+            f"SELECT {col_names_sql} FROM {target_table_str} WHERE {key_column} > {last}{filters_sql} "
+            f"ORDER BY {key_column} LIMIT {limit}) b ORDER BY b.{key_column}")
+
+def range_scan_sql(target_table_str, key_column, start, end):
+    # متن اسکن range (بازه‌ی کلید در WHERE)؛ فیلترها پس از آن اضافه می‌شوند
+    return f"SELECT * FROM {target_table_str} WHERE {key_column} > {start} AND {key_column} <= {end}"
+
+def range_job_window(job, func_name_str):
+    # پنجره‌ی هر فراخوانی: برای کلید عددی تعداد مقدار کلید (unit = None)، برای کلید زمانی window.size واحد از window.unit
+    key_type = job['key_type'].lower()
+    batch_size = job.get('batch_size', 1000)
+    window = job.get('window') or {}
+    if 'int' in key_type or 'num' in key_type or 'serial' in key_type:
+        max_window = window.get('max', job.get('max_limit', batch_size * 10))
+        return {'unit': None, 'size': window.get('size', batch_size), 'max': max_window,
+                'adaptive': job_adaptive_settings(job, func_name_str, 1, max_window)}
+    if 'time' in key_type or 'date' in key_type:
+        unit = window.get('unit', 'days')
+        if unit not in JOB_WINDOW_UNITS:
+            raise ValueError(f"window unit '{unit}' (use {', '.join(JOB_WINDOW_UNITS)})")
+        if not window:
+            # batch_size تعداد ردیف است و برای کلید زمانی معنی ندارد (قبلاً به اشتباه تعداد روز تفسیر می‌شد)
+            print(f"      ⚠️ {func_name_str}: time key without window; using 1-day windows.")
+        size = window.get('size', 1)
+        max_window = window.get('max', size * 10)
+        return {'unit': unit, 'size': size, 'max': max_window,
+                'adaptive': job_adaptive_settings(job, func_name_str, size / 100, max_window)}
+    raise ValueError(f"key type '{key_type}' not supported")
+
+def build_keyset_job_sql(job, func_name_str, target_table_str, columns, instrument=False):
+    # حالت keyset: دریافت N ردیف بعدی به ترتیب کلید به جای بازه (key > last AND key <= last + limit)
+    # ORDER BY و LIMIT روی یک اسکن ساده از جدول خارجی در زیرکوئری قرار می‌گیرند و پارامترها با USING ارسال می‌شوند.
+    # زیرکوئری دارای LIMIT جداگانه برنامه‌ریزی می‌شود و max() OVER () بیرونی فقط روی حداکثر N ردیف خروجی آن اجرا می‌شود
+    # (WindowAgg -> Limit -> Scan)؛ پس FDWهایی که ORDER BY/LIMIT را Push Down می‌کنند (postgres_fdw، mysql_fdw) همچنان
+    # آن را به سرور راه دور می‌فرستند. tds_fdw فقط شرط WHERE را Push Down می‌کند: روی سرور tds هر دسته همه‌ی ردیف‌های
+    # key > last را منتقل می‌کند و برای جداول بزرگ SQL Server حالت range (بازه‌ی کلید در WHERE) مناسب است
+    key_column = job['key_column']
+    key_type_raw = job['key_type']
+    key_type = key_type_raw.lower()
+    batch_size = job.get('batch_size', 1000)
+    max_limit = job.get('max_limit', batch_size * 10)
+    filter_columns = job.get('filter_columns', [])
+    # در keyset تعداد ردیف دقیق است؛ حالت تطبیقی LIMIT را برای رسیدن به target_ms تنظیم می‌کند
+    adaptive = job_adaptive_settings(job, func_name_str, 1, max_limit)
+
+    if 'time' in key_type or 'date' in key_type:
+        default_val = f"'1900-01-01 00:00:00'::{key_type_raw}"
+    else:
+        default_val = "0"
+
+    func_args_list = [
+        f"p_last_{key_column} {key_type_raw} DEFAULT {default_val}",
+        f"p_limit INTEGER DEFAULT {'NULL' if adaptive else batch_size}"
+    ]
+    using_list = [f"p_last_{key_column}", "v_limit"]
+    filter_logic_block = []
+    for idx, fc in enumerate(filter_columns, start=3):
+        fc_name = fc['name']
+        func_args_list.append(f"p_{fc_name} {fc['type']} DEFAULT NULL")
+        using_list.append(f"p_{fc_name}")
+        filter_logic_block.append(f"""
+            IF p_{fc_name} IS NOT NULL THEN
+                v_filters := v_filters || ' AND {fc_name} = ${idx}';
+            END IF;""")
+
+    return_sql = f"RETURN QUERY EXECUTE v_query USING {', '.join(using_list)};"
+    arg_names = [a.split()[0] for a in func_args_list]
+    scan_query_sql = keyset_scan_sql(target_table_str, key_column, columns, filters_sql="' || v_filters || '")
+    ret_def_sql = ", ".join(f"{c['name']} {c['type']}" for c in columns)
+    drop_types_sql = ", ".join([key_type_raw, "INTEGER"] + [fc['type'] for fc in filter_columns])
+
+    limit_sql = f"v_limit := LEAST(COALESCE(p_limit, {batch_size}), {max_limit});"
+    if adaptive:
+        limit_sql = adaptive_window_sql(func_name_str, batch_size, adaptive) + "\n            v_limit := ceil(v_window);"
+    scan_sql = instrument_scan(return_sql) if instrument else adaptive_scan(return_sql) if adaptive else return_sql
+    if adaptive:
+        scan_sql += adaptive_record_sql(func_name_str, adaptive, *(('v_rows', 'v_scan_started') if instrument else ()))
+
+    return f"""
+        DROP FUNCTION IF EXISTS {func_name_str}({drop_types_sql});
+
+        CREATE OR REPLACE FUNCTION {func_name_str}(
+            {", ".join(func_args_list)}
+        )
+        RETURNS TABLE({ret_def_sql}, next_watermark {key_type_raw})
+        LANGUAGE plpgsql
+        SECURITY DEFINER
+        AS $$         DECLARE
+            v_limit INTEGER;
+            v_filters TEXT := '';
+            v_query TEXT;{ADAPTIVE_DECLARE if adaptive else ""}{INSTRUMENT_DECLARE if instrument else ""}
+        BEGIN
+            {limit_sql}
+            {"".join(filter_logic_block)}
+            v_query := '{scan_query_sql}';
+
+            {scan_sql}{instrument_finish(func_name_str, arg_names) if instrument else ""}
+        END;
+        $$;
+        """
+
+def plan_incremental_job_functions(cur, jobs_config, context_vars, table_columns=None, instrument=False):
+    items = []
+    table_columns = table_columns or {}
+    if any(job.get('adaptive') for job in jobs_config):
+        items += plan_job_batch_state()
     for job in jobs_config:
         func_name_str = resolve_config_val(job['name'], context_vars)
         target_table_str = resolve_config_val(job['target_table'], context_vars)
         key_column = job['key_column']
         key_type_raw = job['key_type']
-        key_type = key_type_raw.lower()
-        
-        batch_size = job.get('batch_size', 1000)
-        max_limit = job.get('max_limit', batch_size * 10) 
         filter_columns = job.get('filter_columns', [])
+
+        mode = job.get('mode', 'range')
+        job_instrument = job.get('instrument', instrument)
+        if mode == 'keyset':
+            columns = table_columns.get(target_table_str) or get_relation_columns(cur, target_table_str)
+            if not columns:
+                print(f"      ⚠️ Skipping {func_name_str}: columns of {target_table_str} unknown.")
+                continue
+            items.append(plan_item('function', func_name_str,
+                                   [build_keyset_job_sql(job, func_name_str, target_table_str, columns, job_instrument)],
+                                   depends_on=[target_table_str], label="⚙️  Created Incremental Function (Keyset)"))
+            continue
+        elif mode != 'range':
+            print(f"      ⚠️ Job mode '{mode}' not supported.")
+            continue
         
-        default_val = "0"
-        declare_section = ""
-        logic_section = ""
-        
+        try:
+            window = range_job_window(job, func_name_str)
+        except ValueError as e:
+            print(f"      ⚠️ Skipping {func_name_str}: {e}.")
+            continue
+        size, max_window, adaptive = window['size'], window['max'], window['adaptive']
+        if window['unit'] is None:
+            default_val = "0"
+            value_type = "BIGINT"
+            end_sql = "v_start_val + GREATEST(round(v_window), 1)::bigint"
+            bound_sql = "{}::text"
+        else:
+            default_val = f"'1900-01-01 00:00:00'::{key_type_raw}"
+            value_type = key_type_raw
+            end_sql = f"v_start_val + v_window * INTERVAL '1 {window['unit']}'"
+            bound_sql = "quote_literal({})"
+
         func_args_list = [
             f"p_last_{key_column} {key_type_raw} DEFAULT {default_val}",
-            "p_limit INTEGER DEFAULT {}".format(batch_size)
+            f"p_limit INTEGER DEFAULT {'NULL' if adaptive else size}"
         ]
-        
         for fc in filter_columns:
-            fc_name = fc['name']
-            fc_type = fc['type']
-            func_args_list.append(f"p_{fc_name} {fc_type} DEFAULT NULL")
-        
+            func_args_list.append(f"p_{fc['name']} {fc['type']} DEFAULT NULL")
         func_args_sql = ", ".join(func_args_list)
-        
-        if 'int' in key_type or 'num' in key_type or 'serial' in key_type:
-            default_val = "0"
-            declare_section = f"""
-                v_limit INTEGER;
-                v_start_val BIGINT;
-                v_end_val BIGINT;
-                v_query TEXT;
-                r RECORD;
-            """
-            logic_section = f"""
-                v_limit := LEAST(COALESCE(p_limit, {batch_size}), {max_limit});
-                v_start_val := p_last_{key_column};
-                v_end_val := p_last_{key_column} + v_limit;
-                
-                v_query := 'SELECT * FROM {target_table_str} ' ||
-                           'WHERE {key_column} > ' || v_start_val::text || 
-                           ' AND {key_column} <= ' || v_end_val::text;
-            """
-            
-        elif 'time' in key_type or 'date' in key_type:
-            default_val = "'1900-01-01 00:00:00'::timestamp"
-            declare_section = f"""
-                v_limit INTEGER;
-                v_start_val TIMESTAMP;
-                v_end_val TIMESTAMP;
-                v_query TEXT;
-                r RECORD;
+
+        window_declare = ADAPTIVE_DECLARE if adaptive else "\n                v_window NUMERIC;"
+        declare_section = f"""
+                v_start_val {value_type};
+                v_end_val {value_type};
+                v_query TEXT;{window_declare}
             """
-            logic_section = f"""
-                v_limit := LEAST(COALESCE(p_limit, {batch_size}), {max_limit});
+        window_sql = adaptive_window_sql(func_name_str, size, adaptive) if adaptive else f"""
+                v_window := LEAST(COALESCE(p_limit, {size}), {max_window});"""
+        logic_section = f"""{window_sql}
                 v_start_val := p_last_{key_column};
-                v_end_val := p_last_{key_column} + make_interval(days => v_limit);
+                v_end_val := {end_sql};
+                PERFORM set_config('{JOB_WINDOW_END_SETTING}', v_end_val::text, true);
                 
-                v_query := 'SELECT * FROM {target_table_str} ' ||
-                           'WHERE {key_column} > ' || quote_literal(v_start_val) || 
-                           ' AND {key_column} <= ' || quote_literal(v_end_val);
+                v_query := '{range_scan_sql(target_table_str, key_column, "' || " + bound_sql.format('v_start_val') + " || '",
+                                            "' || " + bound_sql.format('v_end_val'))};
             """
-        else:
-            print(f"      ⚠️ Key type '{key_type}' not supported.")
-            continue
 
         filter_logic_block = []
         for fc in filter_columns:
@@ -172,14 +830,26 @@ def create_incremental_job_functions(conn_db, jobs_config, context_vars):
 
         filter_logic_sql = "\n".join(filter_logic_block)
 
+        return_sql = "RETURN QUERY EXECUTE v_query;"
+        if job_instrument:
+            declare_section += INSTRUMENT_DECLARE
+            scan_sql = instrument_scan(return_sql)
+        else:
+            scan_sql = adaptive_scan(return_sql) if adaptive else return_sql
+        if adaptive:
+            scan_sql += adaptive_record_sql(func_name_str, adaptive, *(('v_rows', 'v_scan_started') if job_instrument else ()))
+        if job_instrument:
+            scan_sql += instrument_finish(func_name_str, [a.split()[0] for a in func_args_list])
         execution_block = f"""
             {filter_logic_sql}
-            FOR r IN EXECUTE v_query LOOP
-                RETURN NEXT r;
-            END LOOP;
+            {scan_sql}
         """
 
+        # تغییر حالت keyset -> range نوع خروجی را عوض می‌کند و CREATE OR REPLACE کافی نیست
+        drop_types_sql = ", ".join([key_type_raw, "INTEGER"] + [fc['type'] for fc in filter_columns])
         func_sql = f"""
+        DROP FUNCTION IF EXISTS {func_name_str}({drop_types_sql});
+
         CREATE OR REPLACE FUNCTION {func_name_str}(
             {func_args_sql}
         )
@@ -194,21 +864,95 @@ def create_incremental_job_functions(conn_db, jobs_config, context_vars):
             RETURN;
         END;
         $$;
+
+        COMMENT ON FUNCTION {func_name_str}({drop_types_sql}) IS
+            'Range batch: next p_last_{key_column} = current_setting(''{JOB_WINDOW_END_SETTING}'', true), read in the same '
+            'transaction as the call (transaction-local; lost in autocommit or a later transaction). '
+            'Do not use the max key of the returned rows: the window may be empty or clamped.';
         """
         
-        try:
-            cur.execute(func_sql)
-            print(f"      ⚙️  Created Incremental Function: {func_name_str}")
-        except Exception as e:
-            print(f"      ❌ Function Error: {e}")
-    cur.close()
+        items.append(plan_item('function', func_name_str, [func_sql],
+                               depends_on=[target_table_str], label="⚙️  Created Incremental Function"))
+    return items
 
 # ==========================================
 # توابع سفارشی (Custom Functions)
 # ==========================================
 
-def create_custom_functions(conn_db, functions_config, context_vars):
-    cur = conn_db.cursor()
+def ttl_to_interval(val):
+    val = str(val).strip()
+    if val.isdigit(): return f"{val} seconds"
+    units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+    num, unit = val[:-1], val[-1].lower()
+    if not num.isdigit() or unit not in units:
+        raise ValueError(f"invalid ttl '{val}' (use 30s, 15m, 2h, 1d or seconds)")
+    return f"{num} {units[unit]}"
+
+def build_cached_body(func_name_str, build_sql, using_sql, return_columns, filter_columns, cache_cfg, instrument=False):
+    # کلید کش تاپل آرگومان‌هاست؛ در Hit نتیجه از jsonb ذخیره‌شده بازسازی می‌شود و کوئری راه دور اجرا نمی‌شود.
+    # در Miss ورودی‌های منقضی و مازاد بر max_entries (قدیمی‌ترین‌ها) همان تابع حذف می‌شوند؛
+    # در تراکنش فقط‌خواندنی یا Hot Standby نوشتن کش ممکن نیست و نتیجه بدون کش برگردانده می‌شود
+    ttl = ttl_to_interval(cache_cfg.get('ttl', '15m'))
+    max_entries = int(cache_cfg.get('max_entries', 1000))
+    key_sql = f"ROW({', '.join('p_' + fc['name'] for fc in filter_columns)})::text"
+    record_def = ", ".join(f"{rc['name']} {rc['type']}" for rc in return_columns)
+    miss_sql = f"""{build_sql}
+                EXECUTE 'SELECT COALESCE(jsonb_agg(to_jsonb(q)), ''[]''::jsonb) FROM (' || v_query || ') q'
+                INTO v_result{using_sql};"""
+    return_sql = f"RETURN QUERY SELECT * FROM jsonb_to_recordset(v_result) AS r({record_def});"
+    if instrument:
+        # در Hit زمان اسکن صفر ثبت می‌شود
+        miss_sql = f"""v_scan_started := clock_timestamp();
+                {miss_sql}
+                v_scan_ms := 1000 * extract(epoch FROM clock_timestamp() - v_scan_started);"""
+        return_sql = f"""{return_sql}
+            GET DIAGNOSTICS v_rows = ROW_COUNT;{instrument_finish(func_name_str, ['p_' + fc['name'] for fc in filter_columns])}"""
+    return f"""
+        DECLARE
+            v_key TEXT := {key_sql};
+            v_query TEXT;
+            v_result JSONB;{INSTRUMENT_DECLARE if instrument else ""}
+        BEGIN
+            SELECT c.result INTO v_result FROM function_result_cache c
+            WHERE c.function_name = '{func_name_str}' AND c.cache_key = v_key
+              AND c.cached_at > now() - interval '{ttl}';
+
+            IF v_result IS NULL THEN
+                {miss_sql}
+
+                BEGIN
+                    INSERT INTO function_result_cache AS c (function_name, cache_key, result, cached_at)
+                    VALUES ('{func_name_str}', v_key, v_result, now())
+                    ON CONFLICT (function_name, cache_key) DO UPDATE SET result = EXCLUDED.result, cached_at = EXCLUDED.cached_at;
+
+                    DELETE FROM function_result_cache c
+                    WHERE c.function_name = '{func_name_str}'
+                      AND (c.cached_at <= now() - interval '{ttl}'
+                           OR c.cache_key IN (SELECT k.cache_key FROM function_result_cache k
+                                              WHERE k.function_name = '{func_name_str}'
+                                              ORDER BY k.cached_at DESC OFFSET {max_entries}));
+                EXCEPTION WHEN read_only_sql_transaction THEN
+                    NULL;
+                END;
+            END IF;
+
+            {return_sql}
+        END;"""
+
+def plan_custom_functions(functions_config, context_vars, instrument=False):
+    items = []
+
+    if any(f.get('cache') for f in functions_config):
+        items.append(plan_item('infrastructure', 'function_result_cache', ["""
+            CREATE TABLE IF NOT EXISTS function_result_cache (
+                function_name VARCHAR(255),
+                cache_key TEXT,
+                result JSONB NOT NULL,
+                cached_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (function_name, cache_key)
+            );
+        """]))
+
     for func in functions_config:
         func_name_str = resolve_config_val(func['name'], context_vars)
         
@@ -234,11 +978,7 @@ def create_custom_functions(conn_db, functions_config, context_vars):
             $$;
             """
             
-            try:
-                cur.execute(func_sql)
-                print(f"      ⚙️  Created Structured Function: {func_name_str}")
-            except Exception as e:
-                print(f"      ❌ Structured Function Error {func_name_str}: {e}")
+            items.append(plan_item('function', func_name_str, [func_sql], label="⚙️  Created Structured Function"))
             continue
 
         # -------------------------------------------------------
@@ -247,15 +987,11 @@ def create_custom_functions(conn_db, functions_config, context_vars):
         if 'sql' in func:
             raw_sql = func['sql']
             raw_sql_resolved = resolve_config_val(raw_sql, context_vars)
-            try:
-                cur.execute(sql.SQL(raw_sql_resolved))
-                print(f"      ⚙️  Created Raw SQL Function: {func_name_str}")
-            except Exception as e:
-                print(f"      ❌ Raw SQL Function Error {func_name_str}: {e}")
+            items.append(plan_item('function', func_name_str, [sql.SQL(raw_sql_resolved)], label="⚙️  Created Raw SQL Function"))
             continue
 
         # -------------------------------------------------------
-        # حالت ۳: تولید خودکار تابع (Generated) - اصلاح شده با Static SQL
+        # حالت ۳: تولید خودکار تابع (Generated) - کوئری پویا با EXECUTE ... USING
         # -------------------------------------------------------
         target_table_str = resolve_config_val(func['target_table'], context_vars)
         
@@ -275,29 +1011,49 @@ def create_custom_functions(conn_db, functions_config, context_vars):
         args_list = [f"p_{fc['name']} {fc['type']} DEFAULT NULL" for fc in filter_columns]
         args_sql = ", ".join(args_list)
         
-        # 🟢 تولید شرط‌های WHERE با منطق Static SQL
-        # فرمت: (p_col IS NULL OR col op p_col)
-        where_parts = []
-        for fc in filter_columns:
+        # 🟢 تولید کوئری پویا: فقط شرط آرگومان‌های غیر NULL به متن کوئری اضافه می‌شود
+        # شرط (col op p_col OR p_col IS NULL) به tds_fdw قابل ارسال نیست و کل جدول راه دور اسکن می‌شد؛
+        # با EXECUTE ... USING مقدار پارامترها در برنامه‌ی یک‌باره ثابت است و شرط به سرور راه دور می‌رود
+        build_lines = []
+        for i, fc in enumerate(filter_columns, start=1):
             fc_name = fc['name']
             fc_op = fc.get('filter_type', '=') # پیش‌فرض =
-            
-            # ساخت شرط امن برای NULL: اگر ورودی نال باشد، شرط نادیده گرفته می‌شود
-            # در غیر این صورت شرط اعمال می‌شود
-            cond = f"({fc_name} {fc_op} p_{fc_name} OR p_{fc_name} IS NULL)"
-            where_parts.append(cond)
-            
-        where_clause = " AND ".join(where_parts)
-        if not where_clause:
-            where_clause = "TRUE"
+            build_lines.append(f"""
+            IF p_{fc_name} IS NOT NULL THEN
+                v_query := v_query || {quote_literal(f" AND {fc_name} {fc_op} ${i}")};
+            END IF;""")
+        build_sql = f"""
+            v_query := {quote_literal(f"SELECT {select_expr_sql} FROM {target_table_str} WHERE TRUE")};{''.join(build_lines)}"""
+        using_sql = f" USING {', '.join('p_' + fc['name'] for fc in filter_columns)}" if filter_columns else ""
 
         # ساخت دستور DROP
         drop_types_list = [fc['type'] for fc in filter_columns]
         drop_types_sql = ", ".join(drop_types_list)
         drop_sql = f"DROP FUNCTION IF EXISTS {func_name_str}({drop_types_sql});"
-        
-        # 🟢 تابع نهایی با RETURN QUERY (بدون حلقه و EXECUTE)
-        # این روش برای FDW بسیار پایدارتر است
+
+        cache_cfg = func.get('cache')
+        func_instrument = func.get('instrument', instrument)
+        return_sql = f"RETURN QUERY EXECUTE v_query{using_sql};"
+        if cache_cfg:
+            try:
+                body_sql = build_cached_body(func_name_str, build_sql, using_sql, return_columns, filter_columns, cache_cfg, func_instrument)
+            except ValueError as e:
+                print(f"      ⚠️ Skipping {func_name_str}: {e}")
+                continue
+        elif func_instrument:
+            body_sql = f"""
+        DECLARE
+            v_query TEXT;{INSTRUMENT_DECLARE}
+        BEGIN{build_sql}{instrument_scan(return_sql)}{instrument_finish(func_name_str, ['p_' + fc['name'] for fc in filter_columns])}
+        END;"""
+        else:
+            body_sql = f"""
+        DECLARE
+            v_query TEXT;
+        BEGIN{build_sql}
+            {return_sql}
+        END;"""
+
         func_sql = f"""
         {drop_sql}
         
@@ -305,21 +1061,581 @@ def create_custom_functions(conn_db, functions_config, context_vars):
         RETURNS TABLE({ret_def_sql})
         LANGUAGE plpgsql
         SECURITY DEFINER
-        AS $$         BEGIN
-            RETURN QUERY
-            SELECT {select_expr_sql} 
-            FROM {target_table_str} 
-            WHERE {where_clause};
-        END;
+        AS $$ {body_sql}
         $$;
         """
         
+        statements = [func_sql]
+        label = "⚙️  Created Generated Function (Dynamic SQL)"
+        if cache_cfg:
+            # نتایج کش‌شده با تعریف قبلی تابع معتبر نیستند
+            statements.append(sql.SQL("DELETE FROM function_result_cache WHERE function_name = {};").format(sql.Literal(func_name_str)))
+            statements.append(f"""
+        CREATE OR REPLACE FUNCTION {func_name_str}_invalidate()
+        RETURNS BIGINT
+        LANGUAGE sql
+        SECURITY DEFINER
+        AS $$             WITH removed AS (
+                DELETE FROM function_result_cache WHERE function_name = '{func_name_str}' RETURNING 1
+            )
+            SELECT count(*) FROM removed;
+        $$;
+        """)
+            label += f" (cached, invalidate: {func_name_str}_invalidate())"
+        items.append(plan_item('function', func_name_str, statements,
+                               depends_on=[target_table_str], label=label))
+    return items
+
+# ==========================================
+# کش محلی (Materialized Views)
+# ==========================================
+
+CRON_BLOCK_BEGIN = "# >>> gateway provisioned jobs >>>"
+CRON_BLOCK_END = "# <<< gateway provisioned jobs <<<"
+CRON_LOG_FILE = "/var/log/gateway-cron.log"
+
+def interval_to_cron(val):
+    val = str(val).strip()
+    if len(val.split()) == 5: return val
+    try:
+        num, unit = int(val[:-1]), val[-1].lower()
+    except ValueError:
+        num, unit = 0, ''
+    # */N فقط وقتی فاصله‌ی یکنواخت می‌دهد که N واحد بعدی را بشمارد (90m ساعتی اجرا می‌شود، 45m ناهموار است،
+    # */N روی روز ماه اول هر ماه از نو شروع می‌شود)؛ سایر فواصل باید به صورت عبارت cron نوشته شوند
+    if unit == 'm' and num > 0 and 60 % num == 0: return f"*/{num} * * * *"
+    if unit == 'h' and num > 0 and 24 % num == 0: return f"0 */{num} * * *"
+    if unit == 'd' and num == 1: return "0 0 * * *"
+    raise ValueError(f"invalid interval '{val}' (use minutes dividing 60, hours dividing 24, 1d or a cron expression)")
+
+def make_cron_entry(schedule, db_name, statement):
+    return (f"{schedule} psql -X -q -U {DB_ADMIN_USER} -d {db_name} "
+            f"-c \"{statement}\" >> {CRON_LOG_FILE} 2>&1")
+
+def install_cron_jobs(entries):
+    # بلوک مربوط به Gateway در crontab کاربر جاری بازنویسی می‌شود و سایر خطوط دست نمی‌خورند
+    print(f"🕒 Registering {len(entries)} cron job(s)...")
+    try:
+        current = subprocess.run(['crontab', '-l'], capture_output=True, text=True)
+        lines = current.stdout.splitlines() if current.returncode == 0 else []
+        kept = []
+        inside = False
+        for line in lines:
+            if line == CRON_BLOCK_BEGIN: inside = True; continue
+            if line == CRON_BLOCK_END: inside = False; continue
+            if not inside: kept.append(line)
+        if entries:
+            kept += [CRON_BLOCK_BEGIN, f"PATH={os.environ.get('PATH', '/usr/bin:/bin')}"] + entries + [CRON_BLOCK_END]
+        subprocess.run(['crontab', '-'], input="\n".join(kept) + "\n", text=True, check=True)
+    except Exception as e:
+        print(f"   ❌ Cron registration error: {e}")
+
+def plan_materialized_views(mviews_config, context_vars, db_name):
+    items = []
+
+    # در اولین اجرا ویو هنوز پر نشده و REFRESH CONCURRENTLY ممکن نیست
+    items.append(plan_item('infrastructure', 'refresh_materialized_view', ["""
+        CREATE OR REPLACE FUNCTION refresh_materialized_view(p_name TEXT) RETURNS VOID AS $$         BEGIN
+            IF (SELECT relispopulated FROM pg_class WHERE oid = p_name::regclass) THEN
+                EXECUTE format('REFRESH MATERIALIZED VIEW CONCURRENTLY %s', p_name::regclass);
+            ELSE
+                EXECUTE format('REFRESH MATERIALIZED VIEW %s', p_name::regclass);
+            END IF;
+        END; $$ LANGUAGE plpgsql;
+    """]))
+
+    for mv in mviews_config:
+        mv_name = resolve_config_val(mv['name'], context_vars)
+        mv_sql = resolve_config_val(mv['sql'], context_vars)
+        unique_key = mv.get('unique_key', [])
+        if not unique_key:
+            print(f"      ⚠️ Skipping {mv_name}: unique_key is required for concurrent refresh.")
+            continue
+
+        # ویو فقط وقتی تعریف آن تغییر کند (اثر انگشت جدید) حذف و از نو ساخته می‌شود
+        index_name = mv_name.split('.')[-1] + "_unique_key"
+        statements = [
+            sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {};").format(parse_identifier(mv_name)),
+            sql.SQL("CREATE MATERIALIZED VIEW {} AS {} WITH NO DATA;").format(parse_identifier(mv_name), sql.SQL(mv_sql)),
+            sql.SQL("CREATE UNIQUE INDEX {} ON {} ({});").format(
+                sql.Identifier(index_name), parse_identifier(mv_name),
+                sql.SQL(', ').join([sql.Identifier(c) for c in unique_key])),
+        ]
+        if mv.get('initial_refresh', True):
+            statements.append(sql.SQL("SELECT refresh_materialized_view({});").format(sql.Literal(mv_name)))
+
+        cron_entry = None
+        if 'refresh_interval' in mv:
+            try:
+                schedule = interval_to_cron(mv['refresh_interval'])
+                cron_entry = make_cron_entry(schedule, db_name, f"SELECT refresh_materialized_view('{mv_name}');")
+            except ValueError as e:
+                print(f"      ⚠️ {mv_name}: {e}")
+        items.append(plan_item('materialized_view', mv_name, statements,
+                               label="🧊 Materialized view", cron=cron_entry))
+    return items
+
+# ==========================================
+# آینه‌های محلی (Change-Capture Mirrors)
+# ==========================================
+
+def plan_mirrors(cur, mirrors_config, context_vars, db_name, table_columns):
+    items = []
+
+    items.append(plan_item('infrastructure', 'mirror_state', ["""
+        CREATE TABLE IF NOT EXISTS mirror_state (
+            mirror_name VARCHAR(255) PRIMARY KEY,
+            watermark TEXT,
+            last_run_at TIMESTAMPTZ,
+            last_rows BIGINT,
+            last_duration INTERVAL,
+            total_rows BIGINT DEFAULT 0,
+            runs BIGINT DEFAULT 0
+        );
+    """]))
+
+    for mirror in mirrors_config:
+        mirror_name = resolve_config_val(mirror['name'], context_vars)
+        source_str = resolve_config_val(mirror['source'], context_vars)
+        primary_key = mirror['primary_key']
+        wm_column = mirror['watermark_column']
+        batch_size = mirror.get('batch_size', 10000)
+        schema_name, table_name = mirror_name.split('.') if '.' in mirror_name else ('public', mirror_name)
+        sync_name = resolve_config_val(mirror.get('sync_function', f"{schema_name}.sync_{table_name}"), context_vars)
+
+        columns = table_columns.get(source_str) or get_relation_columns(cur, source_str)
+        wm_type = next((c['type'] for c in columns if c['name'] == wm_column), None)
+        if not wm_type:
+            print(f"      ⚠️ Skipping {mirror_name}: watermark column '{wm_column}' not found in {source_str}.")
+            continue
+
+        pk_sql = ", ".join(primary_key)
+        update_sql = ", ".join(f"{c['name']} = EXCLUDED.{c['name']}" for c in columns if c['name'] not in primary_key)
+        conflict_sql = f"DO UPDATE SET {update_sql}" if update_sql else "DO NOTHING"
+
+        # ردیف‌های با watermark بزرگ‌تر از مقدار ذخیره‌شده در یک اسکن راه دور (فقط شرط WHERE؛ tds_fdw
+        # ORDER BY/LIMIT را Push Down نمی‌کند و دسته‌بندی روی منبع هر بار کل باقی‌مانده را منتقل می‌کرد) به جدول موقت
+        # Session خوانده می‌شوند و سپس دسته‌دسته به ترتیب watermark از همان جدول محلی Upsert و Commit می‌شوند.
+        # ستون watermark باید یکتا و صعودی باشد (مانند rowversion). حذف‌ها در مبدا منتقل نمی‌شوند.
+        stage_name = f"{schema_name}_{table_name}_sync_stage"
+        proc_sql = f"""
+        CREATE OR REPLACE PROCEDURE {sync_name}(p_max_batches INTEGER DEFAULT NULL)
+        LANGUAGE plpgsql
+        AS $$         DECLARE
+            v_wm {wm_type};
+            v_batch_wm {wm_type};
+            v_rows BIGINT;
+            v_total BIGINT := 0;
+            v_batches INTEGER := 0;
+            v_started TIMESTAMPTZ := clock_timestamp();
+            v_query TEXT;
+        BEGIN
+            SELECT watermark::{wm_type} INTO v_wm FROM mirror_state WHERE mirror_name = '{mirror_name}';
+            CREATE TEMP TABLE IF NOT EXISTS {stage_name} (LIKE {source_str});
+            TRUNCATE pg_temp.{stage_name};
+            EXECUTE 'INSERT INTO pg_temp.{stage_name} SELECT * FROM {source_str}' ||
+                    CASE WHEN v_wm IS NULL THEN '' ELSE ' WHERE {wm_column} > $1' END USING v_wm;
+            CREATE INDEX IF NOT EXISTS {stage_name}_wm_idx ON pg_temp.{stage_name} ({wm_column});
+            ANALYZE pg_temp.{stage_name};
+
+            LOOP
+                v_query := 'WITH batch AS (SELECT * FROM pg_temp.{stage_name}' ||
+                           CASE WHEN v_wm IS NULL THEN '' ELSE ' WHERE {wm_column} > $1' END ||
+                           ' ORDER BY {wm_column} LIMIT {batch_size}), ' ||
+                           'upsert AS (INSERT INTO {mirror_name} SELECT * FROM batch ' ||
+                           'ON CONFLICT ({pk_sql}) {conflict_sql}) ' ||
+                           'SELECT count(*), max({wm_column}) FROM batch';
+                EXECUTE v_query INTO v_rows, v_batch_wm USING v_wm;
+                EXIT WHEN v_rows = 0;
+
+                v_wm := v_batch_wm;
+                v_total := v_total + v_rows;
+                v_batches := v_batches + 1;
+                INSERT INTO mirror_state (mirror_name, watermark) VALUES ('{mirror_name}', v_wm::text)
+                ON CONFLICT (mirror_name) DO UPDATE SET watermark = EXCLUDED.watermark;
+                COMMIT;
+
+                EXIT WHEN v_rows < {batch_size} OR v_batches >= p_max_batches;
+            END LOOP;
+            DROP TABLE pg_temp.{stage_name};
+
+            INSERT INTO mirror_state (mirror_name, last_run_at, last_rows, last_duration, total_rows, runs)
+            VALUES ('{mirror_name}', now(), v_total, clock_timestamp() - v_started, v_total, 1)
+            ON CONFLICT (mirror_name) DO UPDATE SET
+                last_run_at = EXCLUDED.last_run_at,
+                last_rows = EXCLUDED.last_rows,
+                last_duration = EXCLUDED.last_duration,
+                total_rows = mirror_state.total_rows + EXCLUDED.total_rows,
+                runs = mirror_state.runs + 1;
+        END;
+        $$;
+        """
+
+        statements = [
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} (LIKE {});").format(
+                parse_identifier(mirror_name), parse_identifier(source_str)),
+            sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({});").format(
+                sql.Identifier(f"{table_name}_pk"), parse_identifier(mirror_name),
+                sql.SQL(', ').join([sql.Identifier(c) for c in primary_key])),
+            sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({});").format(
+                sql.Identifier(f"{table_name}_{wm_column}_idx"), parse_identifier(mirror_name), sql.Identifier(wm_column)),
+        ]
+        for idx_cols in mirror.get('indexes', []):
+            if isinstance(idx_cols, str): idx_cols = [idx_cols]
+            statements.append(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({});").format(
+                sql.Identifier(f"{table_name}_{'_'.join(idx_cols)}_idx"), parse_identifier(mirror_name),
+                sql.SQL(', ').join([sql.Identifier(c) for c in idx_cols])))
+        statements.append(proc_sql)
+
+        cron_entry = None
+        if 'sync_interval' in mirror:
+            try:
+                schedule = interval_to_cron(mirror['sync_interval'])
+                cron_entry = make_cron_entry(schedule, db_name, f"CALL {sync_name}();")
+            except ValueError as e:
+                print(f"      ⚠️ {mirror_name}: {e}")
+        items.append(plan_item('mirror', mirror_name, statements, depends_on=[source_str],
+                               label=f"🪞 Mirror ({source_str}, sync: CALL {sync_name}())", cron=cron_entry))
+    return items
+
+# ==========================================
+# اسنپ‌شات دوره‌های بسته (Period Snapshots)
+# ==========================================
+
+def plan_period_snapshot_infrastructure():
+    items = []
+    items.append(plan_item('infrastructure', 'period_snapshots', ["""
+        CREATE TABLE IF NOT EXISTS period_snapshots (
+            snapshot_name VARCHAR(255) PRIMARY KEY,
+            source TEXT NOT NULL,
+            route_view TEXT NOT NULL,
+            year_column TEXT NOT NULL,
+            month_column TEXT NOT NULL,
+            open_periods INTEGER NOT NULL DEFAULT 1,
+            boundary_year INTEGER,
+            boundary_month INTEGER,
+            last_frozen_at TIMESTAMPTZ,
+            bounds_source TEXT
+        );
+    """, "ALTER TABLE period_snapshots ADD COLUMN IF NOT EXISTS bounds_source TEXT;", """
+        CREATE TABLE IF NOT EXISTS period_snapshot_periods (
+            snapshot_name VARCHAR(255),
+            period_year INTEGER,
+            period_month INTEGER,
+            rows BIGINT,
+            seconds FLOAT8,
+            frozen_at TIMESTAMPTZ,
+            PRIMARY KEY (snapshot_name, period_year, period_month)
+        );
+    """]))
+
+    # مرز به صورت مقدار ثابت در ویو نوشته می‌شود تا Planner شاخه‌ی FDW را برای فیلتر روی دوره‌های بسته
+    # (مثلاً persianyear = 1402) حذف کند و از سمت محلی فقط پارتیشن همان دوره خوانده شود
+    items.append(plan_item('infrastructure', 'route_period_snapshot', ["""
+        CREATE OR REPLACE FUNCTION route_period_snapshot(p_name TEXT) RETURNS VOID AS $$         DECLARE
+            s RECORD;
+            v_open TEXT := 'true';
+        BEGIN
+            SELECT * INTO s FROM period_snapshots WHERE snapshot_name = p_name;
+            IF s.boundary_year IS NOT NULL THEN
+                v_open := format('%1$I > %3$s OR (%1$I = %3$s AND %2$I >= %4$s)',
+                                 s.year_column, s.month_column, s.boundary_year, s.boundary_month);
+            END IF;
+            EXECUTE format('CREATE OR REPLACE VIEW %s AS SELECT * FROM %s UNION ALL SELECT * FROM %s WHERE %s',
+                           s.route_view, p_name, s.source, v_open);
+        END; $$ LANGUAGE plpgsql;
+    """], depends_on=['period_snapshots']))
+
+    # هر دوره یک بار با فیلتر تساوی (قابل Push Down) کپی و در تراکنش جداگانه Commit می‌شود؛
+    # دوره‌ها اندیس ماهانه‌ی year * 12 + month - 1 دارند و از قدیمی‌ترین دوره‌ی منبع (یا پس از آخرین دوره‌ی منجمد) پیش می‌روند.
+    # قدیمی‌ترین/جدیدترین دوره‌ی منبع با یک تجمیع راه دور خوانده می‌شود: برای tds_fdw (که ORDER BY/LIMIT/تجمیع را
+    # Push Down نمی‌کند) جدول query جداگانه‌ی bounds_source، و برای سایر FDWها min/max مستقیم روی منبع
+    items.append(plan_item('infrastructure', 'freeze_period_snapshot', ["""
+        CREATE OR REPLACE PROCEDURE freeze_period_snapshot(p_name TEXT, p_max_periods INTEGER DEFAULT NULL)
+        LANGUAGE plpgsql
+        AS $$         DECLARE
+            s RECORD;
+            v_year INTEGER;
+            v_month INTEGER;
+            v_min_period INTEGER;
+            v_max_period INTEGER;
+            v_idx INTEGER;
+            v_open_idx INTEGER;
+            v_rows BIGINT;
+            v_done INTEGER := 0;
+            v_started TIMESTAMPTZ;
+            v_partition TEXT;
+        BEGIN
+            SELECT * INTO s FROM period_snapshots WHERE snapshot_name = p_name;
+            IF NOT FOUND THEN
+                RAISE EXCEPTION 'Unknown period snapshot %', p_name;
+            END IF;
+
+            IF s.bounds_source IS NOT NULL THEN
+                EXECUTE format('SELECT min_period, max_period FROM %s', s.bounds_source) INTO v_min_period, v_max_period;
+            ELSE
+                EXECUTE format('SELECT min(%1$I * 100 + %2$I), max(%1$I * 100 + %2$I) FROM %3$s',
+                               s.year_column, s.month_column, s.source) INTO v_min_period, v_max_period;
+            END IF;
+            IF v_max_period IS NULL THEN RETURN; END IF;
+            v_open_idx := (v_max_period / 100) * 12 + v_max_period % 100 - 1 - (s.open_periods - 1);
+
+            SELECT max(period_year * 12 + period_month - 1) + 1 INTO v_idx
+            FROM period_snapshot_periods WHERE snapshot_name = p_name;
+            IF v_idx IS NULL THEN
+                v_idx := (v_min_period / 100) * 12 + v_min_period % 100 - 1;
+            END IF;
+
+            WHILE v_idx < v_open_idx AND (p_max_periods IS NULL OR v_done < p_max_periods) LOOP
+                v_year := v_idx / 12;
+                v_month := v_idx % 12 + 1;
+                v_started := clock_timestamp();
+                v_partition := format('%s_%s_%s', p_name, v_year, lpad(v_month::text, 2, '0'));
+                EXECUTE format('CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%s, %s) TO (%s, %s)',
+                               v_partition, p_name, v_year, v_month, (v_idx + 1) / 12, (v_idx + 1) % 12 + 1);
+                EXECUTE format('INSERT INTO %s SELECT * FROM %s WHERE %I = %s AND %I = %s',
+                               v_partition, s.source, s.year_column, v_year, s.month_column, v_month);
+                GET DIAGNOSTICS v_rows = ROW_COUNT;
+                EXECUTE format('ANALYZE %s', v_partition);
+
+                INSERT INTO period_snapshot_periods (snapshot_name, period_year, period_month, rows, seconds, frozen_at)
+                VALUES (p_name, v_year, v_month, v_rows, extract(epoch FROM clock_timestamp() - v_started), now());
+                UPDATE period_snapshots
+                SET boundary_year = (v_idx + 1) / 12, boundary_month = (v_idx + 1) % 12 + 1, last_frozen_at = now()
+                WHERE snapshot_name = p_name;
+                PERFORM route_period_snapshot(p_name);
+                COMMIT;
+                RAISE NOTICE 'Frozen %/% of %: % rows', v_year, v_month, p_name, v_rows;
+
+                v_idx := v_idx + 1;
+                v_done := v_done + 1;
+            END LOOP;
+        END;
+        $$;
+    """], depends_on=['route_period_snapshot']))
+    return items
+
+def plan_drop_query_table_function(tbl_name, tbl, context_vars):
+    # تابع fetch_* نسخه‌های قبلی (ALTER FOREIGN TABLE در هر فراخوانی) روی استقرارهای موجود مانده است.
+    # امضای آن از نوع پارامترها ساخته می‌شد که دیگر در کانفیگ نیست؛ پس همه‌ی هم‌نام‌هایی حذف می‌شوند که
+    # SETOF همین جدول برمی‌گردانند و بدنه‌شان کوئری جدول را بازنویسی می‌کند. کلید اثرانگشت همان کلید تابع قدیمی است.
+    schema_name, table_name = tbl_name.split('.') if '.' in tbl_name else ('public', tbl_name)
+    func_name = resolve_config_val(tbl.get('function', f"{schema_name}.fetch_{table_name}"), context_vars)
+    func_schema, func_short = func_name.split('.') if '.' in func_name else ('public', func_name)
+    return plan_item('function', func_name, [f"""
+        DO $$
+        DECLARE
+            v_func regprocedure;
+        BEGIN
+            FOR v_func IN
+                SELECT p.oid::regprocedure FROM pg_proc p
+                JOIN pg_namespace n ON n.oid = p.pronamespace
+                WHERE n.nspname = {quote_literal(func_schema)} AND p.proname = {quote_literal(func_short)}
+                  AND p.proretset AND p.prorettype = (SELECT reltype FROM pg_class WHERE oid = to_regclass({quote_literal(tbl_name)}))
+                  AND p.prosrc LIKE '%ALTER FOREIGN TABLE%'
+            LOOP
+                EXECUTE format('DROP FUNCTION %s', v_func);
+            END LOOP;
+        END;
+        $$;
+    """], depends_on=[tbl_name], label=f"🗑️  Dropped legacy query function ({func_name})")
+
+def plan_period_snapshot_bounds(bounds_name, source, year_column, month_column):
+    # source: (سرور tds، عبارت FROM راه دور)؛ جدول فقط یک ردیف (کمینه و بیشینه‌ی year * 100 + month) برمی‌گرداند
+    server_name, remote_from = source
+    period_sql = f"[{year_column}] * 100 + [{month_column}]"
+    query = f"SELECT MIN({period_sql}) AS min_period, MAX({period_sql}) AS max_period FROM {remote_from}"
+    return plan_item('foreign_table', bounds_name, [
+        sql.SQL("DROP FOREIGN TABLE IF EXISTS {};").format(parse_identifier(bounds_name)),
+        sql.SQL("CREATE FOREIGN TABLE {} (min_period integer, max_period integer) SERVER {} OPTIONS (query {});").format(
+            parse_identifier(bounds_name), sql.Identifier(server_name), sql.Literal(query)),
+    ], depends_on=[server_name], label="📏 Period bounds (remote aggregate)")
+
+def plan_period_snapshots(snapshots_config, context_vars, db_name, remote_sources=None):
+    items = plan_period_snapshot_infrastructure()
+    remote_sources = remote_sources or {}
+    for snap in snapshots_config:
+        snap_name = resolve_config_val(snap['name'], context_vars)
+        source_str = resolve_config_val(snap['source'], context_vars)
+        view_str = resolve_config_val(snap['view'], context_vars)
+        year_column = snap.get('year_column', 'persianyear')
+        month_column = snap.get('month_column', 'persianmonth')
+        table_name = snap_name.split('.')[-1]
+
+        bounds_name = None
+        if source_str in remote_sources:
+            bounds_name = f"{snap_name}_bounds"
+            items.append(plan_period_snapshot_bounds(bounds_name, remote_sources[source_str], year_column, month_column))
+
+        statements = [
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} (LIKE {}) PARTITION BY RANGE ({}, {});").format(
+                parse_identifier(snap_name), parse_identifier(source_str), sql.Identifier(year_column), sql.Identifier(month_column)),
+        ]
+        # ایندکس روی جدول پارتیشن‌بندی‌شده به همه‌ی پارتیشن‌های فعلی و آینده اعمال می‌شود
+        for idx_cols in snap.get('indexes', []):
+            if isinstance(idx_cols, str): idx_cols = [idx_cols]
+            statements.append(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({});").format(
+                sql.Identifier(f"{table_name}_{'_'.join(idx_cols)}_idx"), parse_identifier(snap_name),
+                sql.SQL(', ').join([sql.Identifier(c) for c in idx_cols])))
+        statements.append((
+            """INSERT INTO period_snapshots (snapshot_name, source, route_view, year_column, month_column, open_periods, bounds_source)
+               VALUES (%s, %s, %s, %s, %s, %s, %s)
+               ON CONFLICT (snapshot_name) DO UPDATE SET source = EXCLUDED.source, route_view = EXCLUDED.route_view,
+                   year_column = EXCLUDED.year_column, month_column = EXCLUDED.month_column, open_periods = EXCLUDED.open_periods,
+                   bounds_source = EXCLUDED.bounds_source;""",
+            (snap_name, source_str, view_str, year_column, month_column, snap.get('open_periods', 1), bounds_name)))
+
+        cron_entry = None
+        if 'freeze_interval' in snap:
+            try:
+                schedule = interval_to_cron(snap['freeze_interval'])
+                cron_entry = make_cron_entry(schedule, db_name, f"CALL freeze_period_snapshot('{snap_name}');")
+            except ValueError as e:
+                print(f"      ⚠️ {snap_name}: {e}")
+        items.append(plan_item('period_snapshot', snap_name, statements,
+                               depends_on=[source_str, 'period_snapshots'] + ([bounds_name] if bounds_name else []),
+                               label=f"🗄️  Period snapshot (freeze: CALL freeze_period_snapshot('{snap_name}'))", cron=cron_entry))
+        items.append(plan_item('view', view_str, [sql.SQL("SELECT route_period_snapshot({});").format(sql.Literal(snap_name))],
+                               depends_on=[snap_name, 'route_period_snapshot'], label="🔀 Routing view"))
+
+    # با مقدار پیش‌فرض (partition) شرط مرز در شاخه‌ی UNION ALL با فیلتر کوئری مقایسه نمی‌شود و شاخه‌ی FDW حذف نمی‌شود
+    items.append(plan_item('database_setting', 'constraint_exclusion', [
+        sql.SQL("ALTER DATABASE {} SET constraint_exclusion = on;").format(sql.Identifier(db_name))]))
+    return items
+
+# ==========================================
+# جداول مبتنی بر کوئری راه دور (Remote Query Tables)
+# ==========================================
+
+QUERY_PARAM_PATTERN = re.compile(r'\{\{(\w+)\}\}')
+
+def query_template(tbl, context_vars):
+    # متن کوئری T-SQL بدون ; پایانی (tds_fdw آن را به عنوان زیرکوئری اجرا می‌کند)
+    return resolve_config_val(tbl['query'], context_vars).strip().rstrip(';').strip()
+
+def render_remote_query(template, parameters):
+    # هر جدول یک کوئری ثابت است: {{name}} یک بار هنگام Provision با عبارت T-SQL همان پارامتر
+    # (مثلاً DATEADD(day, -30, CAST(GETDATE() AS date))) جایگزین می‌شود و در هر اسکن روی SQL Server ارزیابی می‌شود.
+    # گزینه‌های جدول خارجی هرگز در زمان اجرا بازنویسی نمی‌شوند؛ بازه‌ی راه دور دیگر یعنی جدول query دیگر،
+    # و فیلتر روی ستون‌های خروجی در کوئری محلی اعمال می‌شود
+    defaults = {p['name']: str(p['default']) for p in parameters}
+    return QUERY_PARAM_PATTERN.sub(lambda m: defaults[m.group(1)], template)
+
+def tds_remote_from(tbl_name, tbl_options):
+    # عبارت FROM سمت SQL Server برای یک جدول tds (کوئری زیرکوئری می‌شود، در غیر این صورت schema.table)
+    if 'query' in tbl_options:
+        return f"({tbl_options['query']}) q"
+    table_name = tbl_options.get('table_name', tbl_name.split('.')[-1])
+    schema_name = tbl_options.get('schema_name')
+    return f"{schema_name}.{table_name}" if schema_name else table_name
+
+# ==========================================
+# ورود اسکیمای خارجی (IMPORT FOREIGN SCHEMA)
+# ==========================================
+
+SNAPSHOT_DIR = Path(os.environ.get('PROVISION_SNAPSHOT_DIR', '/app/configs/snapshots'))
+IMPORT_PROBE_NAME = 'gateway_import_probe'
+
+def import_source_spec(entry, context_vars, server_spec):
+    # هر تغییری در این مشخصات (سرور، اسکیمای مبدا، فهرست جداول) باعث کشف مجدد می‌شود
+    return {
+        'server': resolve_config_val(entry['server'], context_vars),
+        'server_options': server_spec['options'],
+        'remote_schema': resolve_config_val(entry['remote_schema'], context_vars),
+        'limit_to': [resolve_config_val(t, context_vars) for t in entry.get('limit_to', [])],
+        'except': [resolve_config_val(t, context_vars) for t in entry.get('except', [])],
+    }
+
+def discover_foreign_schema(conn_db, spec, server_spec, credentials):
+    # سرور و اسکیمای موقت داخل یک تراکنش ساخته و با ROLLBACK حذف می‌شوند؛ فقط متادیتای ستون‌ها باقی می‌ماند
+    tables = {}
+    conn_db.autocommit = False
+    try:
+        cur = conn_db.cursor()
+        opts_sql = sql.SQL(', ').join([sql.SQL("{} {}").format(sql.Identifier(k), sql.Literal(v))
+                                       for k, v in server_spec['options'].items()])
+        cur.execute(sql.SQL("CREATE SERVER {} FOREIGN DATA WRAPPER {} OPTIONS ({});").format(
+            sql.Identifier(IMPORT_PROBE_NAME), sql.Identifier(f"{server_spec['type']}_fdw"), opts_sql))
+        cur.execute(sql.SQL("CREATE USER MAPPING FOR CURRENT_USER SERVER {} OPTIONS (username %s, password %s);").format(
+            sql.Identifier(IMPORT_PROBE_NAME)), (credentials['user'], credentials['password']))
+        cur.execute(sql.SQL("CREATE SCHEMA {};").format(sql.Identifier(IMPORT_PROBE_NAME)))
+
+        restriction = sql.SQL("")
+        if spec['limit_to']:
+            restriction = sql.SQL(" LIMIT TO ({})").format(sql.SQL(', ').join([sql.Identifier(t) for t in spec['limit_to']]))
+        elif spec['except']:
+            restriction = sql.SQL(" EXCEPT ({})").format(sql.SQL(', ').join([sql.Identifier(t) for t in spec['except']]))
+        cur.execute(sql.SQL("IMPORT FOREIGN SCHEMA {}{} FROM SERVER {} INTO {};").format(
+            sql.Identifier(spec['remote_schema']), restriction,
+            sql.Identifier(IMPORT_PROBE_NAME), sql.Identifier(IMPORT_PROBE_NAME)))
+
+        cur.execute("""
+            SELECT c.relname, a.attname, format_type(a.atttypid, a.atttypmod), ft.ftoptions
+            FROM pg_class c
+            JOIN pg_foreign_table ft ON ft.ftrelid = c.oid
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+            WHERE c.relnamespace = %s::regnamespace
+            ORDER BY c.relname, a.attnum
+        """, (IMPORT_PROBE_NAME,))
+        for relname, attname, col_type, ftoptions in cur.fetchall():
+            table = tables.setdefault(relname, {
+                'options': dict(o.split('=', 1) for o in ftoptions or []),
+                'columns': []
+            })
+            table['columns'].append({'name': attname, 'type': col_type})
+    finally:
+        conn_db.rollback()
+        conn_db.autocommit = True
+    return tables
+
+def load_import_snapshot(conn_db, db_name, entry, context_vars, server_spec, credentials, refresh=False):
+    entry_name = resolve_config_val(entry['name'], context_vars)
+    spec = import_source_spec(entry, context_vars, server_spec)
+    source_fingerprint = hashlib.sha256(yaml.safe_dump(spec, sort_keys=True).encode()).hexdigest()
+    snapshot_path = SNAPSHOT_DIR / db_name / f"{entry_name}.yaml"
+
+    if snapshot_path.exists() and not refresh:
         try:
-            cur.execute(func_sql)
-            print(f"      ⚙️  Created Generated Function (Static SQL): {func_name_str}")
+            with open(snapshot_path, 'r') as f:
+                snapshot = yaml.safe_load(f) or {}
+            if snapshot.get('source_fingerprint') == source_fingerprint:
+                print(f"      📸 Snapshot {entry_name}: {len(snapshot['tables'])} tables (cached)")
+                return snapshot['tables']
+            print(f"      🔁 Snapshot {entry_name}: import source changed, rediscovering...")
         except Exception as e:
-            print(f"      ❌ Function Error {func_name_str}: {e}")
-    cur.close()
+            print(f"      ⚠️ Snapshot {entry_name} unreadable ({e}), rediscovering...")
+
+    if conn_db is None:
+        raise ValueError("no usable snapshot and discovery needs a database connection (run without --plan once)")
+    tables = discover_foreign_schema(conn_db, spec, server_spec, credentials)
+    snapshot = {
+        'source': {k: v for k, v in spec.items() if k != 'server_options'},
+        'source_fingerprint': source_fingerprint,
+        'discovered_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'tables': tables,
+    }
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(snapshot_path, 'w') as f:
+        yaml.safe_dump(snapshot, f, sort_keys=False, allow_unicode=True)
+    print(f"      🔭 Snapshot {entry_name}: discovered {len(tables)} tables from {spec['remote_schema']} -> {snapshot_path}")
+    return tables
+
+def expand_import_entry(entry, context_vars, tables):
+    # هر جدول کشف‌شده به یک ورودی عادی جدول خارجی تبدیل می‌شود تا مسیر ساخت، گزینه‌ها و ANALYZE یکسان بماند
+    local_schema = resolve_config_val(entry['local_schema'], context_vars)
+    overrides = entry.get('column_types', {})
+    expanded = []
+    for table_name, table in tables.items():
+        table_overrides = {**overrides.get('*', {}), **overrides.get(table_name, {})}
+        expanded.append({
+            'name': f"{local_schema}.{table_name}",
+            'server': entry['server'],
+            'remote_options': table['options'],
+            'columns': [{'name': c['name'], 'type': table_overrides.get(c['name'], c['type'])} for c in table['columns']],
+            'options': entry.get('options'),
+            'analyze': entry.get('analyze', False),
+        })
+    return expanded
 
 # ==========================================
 # منطق اصلی پردازش
@@ -349,56 +1665,86 @@ def create_global_users(all_users_list):
             print(f"   ❌ User creation error ({username}): {e}")
     conn_glob.close()
 
-def scan_and_collect_users(config_dir):
-    users_list = []
-    for folder_name in ['users', 'user']:
-        for u_file in config_dir.rglob(f"{folder_name}/*.yaml"):
-            try:
-                with open(u_file, 'r') as f:
-                    user_cfg = yaml.safe_load(f)
-                    if user_cfg and (user_cfg.get('username') or user_cfg.get('name')):
-                        users_list.append({
-                            'username': resolve_global_env(user_cfg.get('username', user_cfg.get('name'))),
-                            'password': resolve_global_env(user_cfg.get('password'))
-                        })
-            except: pass
-    return users_list
+def plan_grant(cur, privilege_sql, on_class, target_sql, obj_name, username):
+    on_sql = sql.SQL(f"{on_class} " if on_class else "")
+    stmt = sql.SQL("GRANT {} ON {}{} TO {};").format(privilege_sql, on_sql, target_sql, sql.Identifier(username))
+    privilege = render_statement(cur, privilege_sql)
+    grant = (privilege, render_statement(cur, on_sql), render_statement(cur, target_sql),
+             render_statement(cur, sql.Identifier(username)))
+    return plan_item('grant', f"{privilege} ON {obj_name} TO {username}", [stmt],
+                     depends_on=[obj_name], grant=grant)
 
-def process_single_database(db_name_resolved, db_data, context_vars):
-    print(f"\n   {'='*15} DATABASE: {db_name_resolved} {'='*15}")
-    
-    conn_admin = connect(DB_DEFAULT_NAME)
-    db_owner = DB_ADMIN_USER
-    for cfg in db_data['configs']:
-        if 'database' in cfg and 'owner' in cfg['database']:
-            db_owner = resolve_config_val(cfg['database']['owner'], context_vars)
-            break
+# تنظیمات نشست قابل اعمال با ALTER ROLE ... IN DATABASE؛ pool_size / pool_mode فقط در PgBouncer استفاده می‌شوند
+ROLE_SETTING_TYPES = {
+    'work_mem': str,
+    'maintenance_work_mem': str,
+    'temp_buffers': str,
+    'temp_file_limit': str,
+    'statement_timeout': str,
+    'lock_timeout': str,
+    'idle_in_transaction_session_timeout': str,
+    'idle_session_timeout': str,
+    'max_parallel_workers_per_gather': int,
+    'jit': bool,
+}
+POOL_RESOURCE_KEYS = ('pool_size', 'pool_mode')
+POOL_MODES = ('session', 'transaction', 'statement')
 
-    try:
-        conn_admin.cursor().execute(sql.SQL("CREATE DATABASE {} OWNER {};").format(sql.Identifier(db_name_resolved), sql.Identifier(db_owner)))
-        print("      ✅ Database created.")
-    except psycopg2.errors.DuplicateDatabase:
-        print("      ℹ️  Database exists.")
-    except Exception as e:
-        print(f"      ❌ DB Error: {e}")
-        conn_admin.close()
-        return
-    finally:
-        conn_admin.close()
+def get_role_settings_profiles(cur):
+    # نام پروفایل‌هایی (user@db) که پیش‌تر اعمال شده‌اند؛ از جدول Fingerprint (در حالت --plan خالی)
+    if cur is None: return set()
+    cur.execute("SELECT to_regclass('provision_fingerprints') IS NOT NULL;")
+    if not cur.fetchone()[0]: return set()
+    cur.execute("SELECT object_name FROM provision_fingerprints WHERE object_kind = 'role_settings';")
+    return {name for name, in cur.fetchall()}
 
-    conn_db = connect(db_name_resolved)
-    cur = conn_db.cursor()
+def plan_role_settings(username, db_name, resources, previous_profiles):
+    # RESET ALL پیش از SETها تا تنظیمی که از کانفیگ حذف شده روی نقش باقی نماند؛
+    # دستورات فقط وقتی اجرا می‌شوند که مجموعه‌ی تنظیمات (و در نتیجه Fingerprint) عوض شود.
+    # نقشی که نه اکنون و نه قبلاً پروفایل داشته دست نمی‌خورد (تنظیمات دستی آن با RESET ALL پاک نمی‌شود)
+    target = sql.SQL("ALTER ROLE {} IN DATABASE {}").format(sql.Identifier(username), sql.Identifier(db_name))
+    statements = [sql.SQL("{} RESET ALL;").format(target)]
+    for key, value in (resources or {}).items():
+        if key in POOL_RESOURCE_KEYS: continue
+        if key not in ROLE_SETTING_TYPES:
+            plan_error(f"Resource Error {username}: '{key}' is not a supported setting ({', '.join(ROLE_SETTING_TYPES)})")
+            continue
+        try:
+            value = format_fdw_option(value, ROLE_SETTING_TYPES[key])
+        except ValueError as e:
+            plan_error(f"Resource Error {username}: {key} {e}")
+            continue
+        statements.append(sql.SQL("{} SET {} = {};").format(target, sql.Identifier(key), sql.Literal(value)))
+    if len(statements) == 1 and f"{username}@{db_name}" not in previous_profiles:
+        return None
+    return plan_item('role_settings', f"{username}@{db_name}", statements, quiet=len(statements) == 1,
+                     label=f"🎚️  Role settings ({len(statements) - 1})")
+
+def plan_extension(ext):
+    return plan_item('extension', ext, [sql.SQL("""
+            DO $$ BEGIN
+                IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = {0}) THEN
+                    CREATE EXTENSION IF NOT EXISTS {1};
+                END IF;
+            END $$;
+        """).format(sql.Literal(ext), sql.Identifier(ext))])
+
+def plan_database(cur, db_name_resolved, db_data, context_vars, refresh_snapshots=False):
+    plan = []
 
+    # افزونه‌هایی که روی سرور نصب نیستند بدون خطا رد می‌شوند
     for ext in ['mysql_fdw', 'tds_fdw', 'pg_stat_statements']:
-        try: cur.execute(sql.SQL("CREATE EXTENSION IF NOT EXISTS {};").format(sql.Identifier(ext)))
-        except: pass
-    
-    setup_security_infrastructure(conn_db)
+        plan.append(plan_extension(ext))
+
+    plan += plan_security_infrastructure()
 
     all_schemas = []
     all_fdws = []
     all_tables = []
     all_views = []
+    all_mviews = []
+    all_mirrors = []
+    all_period_snapshots = []
     all_jobs = []
     all_custom_funcs = []
     all_permissions = []
@@ -407,6 +1753,9 @@ def process_single_database(db_name_resolved, db_data, context_vars):
     fdw_names_set = set()
     table_names_set = set()
     view_names_set = set()
+    mview_names_set = set()
+    mirror_names_set = set()
+    period_snapshot_names_set = set()
     job_names_set = set()
     custom_func_names_set = set()
 
@@ -430,7 +1779,22 @@ def process_single_database(db_name_resolved, db_data, context_vars):
             v_name = resolve_config_val(v['name'], context_vars)
             if v_name not in view_names_set:
                 all_views.append(v); view_names_set.add(v_name)
+
+        for mv in cfg.get('materialized_views', []):
+            mv_name = resolve_config_val(mv['name'], context_vars)
+            if mv_name not in mview_names_set:
+                all_mviews.append(mv); mview_names_set.add(mv_name)
+
+        for m in cfg.get('mirrors', []):
+            m_name = resolve_config_val(m['name'], context_vars)
+            if m_name not in mirror_names_set:
+                all_mirrors.append(m); mirror_names_set.add(m_name)
                 
+        for ps in cfg.get('period_snapshots', []):
+            ps_name = resolve_config_val(ps['name'], context_vars)
+            if ps_name not in period_snapshot_names_set:
+                all_period_snapshots.append(ps); period_snapshot_names_set.add(ps_name)
+
         for j in cfg.get('incremental_jobs', []):
             j_name = resolve_config_val(j['name'], context_vars)
             if j_name not in job_names_set:
@@ -444,13 +1808,13 @@ def process_single_database(db_name_resolved, db_data, context_vars):
     for perm_cfg in db_data['user_permissions']:
         all_permissions.append(perm_cfg)
 
-    print("      🏗️  Schemas...")
     for s in all_schemas:
         s_name = resolve_config_val(s['name'], context_vars)
-        cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {};").format(sql.Identifier(s_name)))
+        plan.append(plan_item('schema', s_name, [sql.SQL("CREATE SCHEMA IF NOT EXISTS {};").format(sql.Identifier(s_name))]))
 
-    print("      🌐 FDWs...")
     fdw_credentials = {}
+    fdw_types = {}
+    server_specs = {}
     
     for fdw in all_fdws:
         fdw_name = resolve_config_val(fdw['name'], context_vars)
@@ -473,73 +1837,152 @@ def process_single_database(db_name_resolved, db_data, context_vars):
             options['port'] = str(resolve_config_val(fdw.get('port'), context_vars))
             if 'database' in fdw: options['dbname'] = resolve_config_val(fdw['database'], context_vars)
 
-        opts_sql = sql.SQL(', ').join([sql.SQL("{} {}").format(sql.Identifier(k), sql.Literal(v)) for k,v in options.items() if v])
+        elif fdw_type == 'postgres':
+            # postgres_fdw عمدتاً برای منبع جایگزین محلی (Benchmark) استفاده می‌شود
+            plan.append(plan_extension('postgres_fdw'))
+            options['host'] = resolve_config_val(fdw.get('host'), context_vars)
+            options['port'] = str(resolve_config_val(fdw.get('port', 5432), context_vars))
+            if 'database' in fdw: options['dbname'] = resolve_config_val(fdw['database'], context_vars)
+
+        options = {k: v for k, v in options.items() if v}
+        server_specs[fdw_name] = {'type': fdw_type, 'options': dict(options)}
+        opts_sql = sql.SQL(', ').join([sql.SQL("{} {}").format(sql.Identifier(k), sql.Literal(v)) for k,v in options.items()])
         
-        try: 
-            cur.execute(sql.SQL("CREATE SERVER {} FOREIGN DATA WRAPPER {} OPTIONS ({});").format(
-                sql.Identifier(fdw_name), sql.Identifier(f"{fdw_type}_fdw"), opts_sql))
-        except psycopg2.errors.DuplicateObject: 
-            pass
+        plan.append(plan_item('server', fdw_name, [sql.SQL("CREATE SERVER IF NOT EXISTS {} FOREIGN DATA WRAPPER {} OPTIONS ({});").format(
+            sql.Identifier(fdw_name), sql.Identifier(f"{fdw_type}_fdw"), opts_sql)], label="🌐 Server"))
+
+        options.update(validate_fdw_options(fdw_type, 'server', fdw.get('options'), fdw_name))
+        plan.append(plan_sync_options(cur, 'server_options', fdw_name, sql.Identifier(fdw_name), "ALTER SERVER",
+                                      "SELECT srvoptions FROM pg_foreign_server WHERE srvname = {}", options))
+        fdw_types[fdw_name] = fdw_type
         
         fdw_credentials[fdw_name] = {
             'user': resolve_config_val(fdw['user'], context_vars),
             'password': resolve_config_val(fdw['password'], context_vars)
         }
 
-    print("      📊 Tables...")
+    # ورودی‌های type: import از روی Snapshot (یا کشف از کاتالوگ راه دور) به جداول عادی باز می‌شوند
+    expanded_tables = []
+    for tbl in all_tables:
+        if tbl.get('type') != 'import':
+            expanded_tables.append(tbl)
+            continue
+        entry_name = resolve_config_val(tbl['name'], context_vars)
+        server_name = resolve_config_val(tbl['server'], context_vars)
+        if server_name not in server_specs:
+            plan_error(f"Import Error {entry_name}: server '{server_name}' is not defined in fdws")
+            continue
+        try:
+            tables = load_import_snapshot(cur.connection if cur else None, db_name_resolved, tbl, context_vars,
+                                          server_specs[server_name], fdw_credentials[server_name], refresh_snapshots)
+        except Exception as e:
+            plan_error(f"Import Error {entry_name}: {e}")
+            continue
+        for imported in expand_import_entry(tbl, context_vars, tables):
+            if imported['name'] not in table_names_set:
+                expanded_tables.append(imported); table_names_set.add(imported['name'])
+    all_tables = expanded_tables
+
+    remote_sources = {}
     for tbl in all_tables:
         tbl_name = resolve_config_val(tbl['name'], context_vars)
         server_name = resolve_config_val(tbl['server'], context_vars)
         cols = sql.SQL(', ').join([sql.SQL("{} {}").format(sql.Identifier(c['name']), sql.SQL(c['type'])) for c in tbl['columns']])
+
+        tbl_options = dict(tbl.get('remote_options', {}))
+        stale_options = ()
+        if tbl.get('type') == 'query':
+            # فقط tds_fdw گزینه‌ی query دارد؛ Join و GROUP BY کامل روی SQL Server اجرا می‌شود
+            if fdw_types.get(server_name) != 'tds':
+                plan_error(f"Query Table Error {tbl_name}: server '{server_name}' is not a tds server")
+                continue
+            default_query = render_remote_query(query_template(tbl, context_vars), tbl.get('parameters', []))
+            tbl_options['query'] = default_query
+            stale_options = ('schema_name', 'table_name')
+        else:
+            if 'remote_schema' in tbl: tbl_options['schema_name'] = tbl['remote_schema']
+            if 'remote_table' in tbl: tbl_options['table_name'] = tbl['remote_table']
+            stale_options = ('query',)
+        if fdw_types.get(server_name) == 'tds':
+            remote_sources[tbl_name] = (server_name, tds_remote_from(tbl_name, tbl_options))
+        opts_sql = sql.SQL(', ').join([sql.SQL("{} {}").format(sql.Identifier(k), sql.Literal(v)) for k, v in tbl_options.items()])
         
-        opts = []
-        if 'remote_schema' in tbl: opts.append(sql.SQL("schema_name {}").format(sql.Literal(tbl['remote_schema'])))
-        if 'remote_table' in tbl: opts.append(sql.SQL("table_name {}").format(sql.Literal(tbl['remote_table'])))
-        opts_sql = sql.SQL(', ').join(opts)
-        
-        try: 
-            cur.execute(sql.SQL("CREATE FOREIGN TABLE {} ({}) SERVER {} OPTIONS ({});").format(parse_identifier(tbl_name), cols, sql.Identifier(server_name), opts_sql))
-            print(f"         ✅ Created table: {tbl_name}")
-        except psycopg2.errors.DuplicateTable: 
-            print(f"         ℹ️  Table exists: {tbl_name}")
-        except Exception as e: 
-            print(f"      ❌ Table Error {tbl_name}: {e}")
-
-    print("      👁️  Views...")
+        plan.append(plan_item('foreign_table', tbl_name, [sql.SQL("CREATE FOREIGN TABLE IF NOT EXISTS {} ({}) SERVER {} OPTIONS ({});").format(
+            parse_identifier(tbl_name), cols, sql.Identifier(server_name), opts_sql)],
+            depends_on=[server_name], label="📊 Created table"))
+
+        tbl_options.update(validate_fdw_options(fdw_types.get(server_name), 'table', tbl.get('options'), tbl_name))
+        plan.append(plan_sync_options(cur, 'table_options', tbl_name, parse_identifier(tbl_name), "ALTER FOREIGN TABLE",
+                                      "SELECT ftoptions FROM pg_foreign_table WHERE ftrelid = to_regclass({})", tbl_options,
+                                      drop=stale_options))
+
+        # ANALYZE فقط پس از ساخت جدول یا تغییر گزینه‌های آن (یا با --force) اجرا می‌شود
+        if tbl.get('analyze'):
+            plan.append(plan_item('analyze', tbl_name, [sql.SQL("ANALYZE {};").format(parse_identifier(tbl_name))],
+                                  depends_on=[tbl_name], label="📈 Analyzed"))
+
+        if tbl.get('type') == 'query':
+            plan.append(plan_drop_query_table_function(tbl_name, tbl, context_vars))
+
+    # ویوی مسیریاب پیش از ویوها و توابعی ساخته می‌شود که از آن می‌خوانند
+    if all_period_snapshots:
+        plan += plan_period_snapshots(all_period_snapshots, context_vars, db_name_resolved, remote_sources)
+
     for vw in all_views:
         vw_name = resolve_config_val(vw['name'], context_vars)
         vw_sql = resolve_config_val(vw['sql'], context_vars)
-        try: 
-            cur.execute(sql.SQL("CREATE OR REPLACE VIEW {} AS {};").format(parse_identifier(vw_name), sql.SQL(vw_sql)))
-        except Exception as e: 
-            print(f"      ❌ View Error {vw_name}: {e}")
+        plan.append(plan_item('view', vw_name, [sql.SQL("CREATE OR REPLACE VIEW {} AS {};").format(
+            parse_identifier(vw_name), sql.SQL(vw_sql))], label="👁️  View"))
+
+    if all_mviews:
+        plan += plan_materialized_views(all_mviews, context_vars, db_name_resolved)
+
+    table_columns = {resolve_config_val(t['name'], context_vars): t.get('columns', []) for t in all_tables}
+    for ps in all_period_snapshots:
+        table_columns[resolve_config_val(ps['view'], context_vars)] = table_columns.get(resolve_config_val(ps['source'], context_vars), [])
+
+    if all_mirrors:
+        plan += plan_mirrors(cur, all_mirrors, context_vars, db_name_resolved, table_columns)
+
+    # instrumentation: {enabled, ring_size} در کانفیگ دیتابیس؛ instrument: true/false روی هر تابع آن را بازنویسی می‌کند
+    instrumentation = next((cfg['instrumentation'] for cfg in db_data['configs'] if cfg.get('instrumentation')), {})
+    instrument = bool(instrumentation.get('enabled', False))
+    if instrument or any(e.get('instrument') for e in all_jobs + all_custom_funcs):
+        plan += plan_instrumentation_infrastructure(instrumentation.get('ring_size', 100000))
 
     if all_jobs:
-        create_incremental_job_functions(conn_db, all_jobs, context_vars)
+        plan += plan_incremental_job_functions(cur, all_jobs, context_vars, table_columns, instrument)
     
     if all_custom_funcs:
-        create_custom_functions(conn_db, all_custom_funcs, context_vars)
+        plan += plan_custom_functions(all_custom_funcs, context_vars, instrument)
 
-    print("      🔐 Permissions...")
-    
     users_in_this_db = []
+    policy_users = []
+    role_profiles = get_role_settings_profiles(cur)
 
     for user in all_permissions:
         username = resolve_config_val(user.get('username'), context_vars)
         users_in_this_db.append(username)
 
-        cur.execute(sql.SQL("GRANT CONNECT ON DATABASE {} TO {};").format(sql.Identifier(db_name_resolved), sql.Identifier(username)))
+        plan.append(plan_grant(cur, sql.SQL("CONNECT"), "DATABASE", sql.Identifier(db_name_resolved),
+                               db_name_resolved, username))
         
         for s_name in schema_names_set:
-            cur.execute(sql.SQL("GRANT USAGE ON SCHEMA {} TO {};").format(sql.Identifier(s_name), sql.Identifier(username)))
+            plan.append(plan_grant(cur, sql.SQL("USAGE"), "SCHEMA", sql.Identifier(s_name), s_name, username))
 
         access_time = user.get('access_time')
         if access_time: 
             st = access_time.get('start')
             en = access_time.get('end')
+            tz = access_time.get('timezone', os.environ.get('TZ', 'UTC'))
             if st and en: 
-                cur.execute("INSERT INTO auth_policies (username, allowed_start, allowed_end) VALUES (%s,%s,%s) ON CONFLICT (username) DO UPDATE SET allowed_start=%s, allowed_end=%s;", 
-                           (username, st, en, st, en))
+                policy_users.append(username)
+                plan.append(plan_item('access_policy', username, [(
+                    "INSERT INTO auth_policies (username, allowed_start, allowed_end, time_zone) VALUES (%s,%s,%s,%s) ON CONFLICT (username) DO UPDATE SET allowed_start=%s, allowed_end=%s, time_zone=%s;",
+                    (username, st, en, tz, st, en, tz))], depends_on=['auth_policies']))
+
+        role_settings = plan_role_settings(username, db_name_resolved, user.get('resources'), role_profiles)
+        if role_settings: plan.append(role_settings)
 
         for perm in user.get('permissions', []):
             if 'view' in perm:
@@ -551,106 +1994,109 @@ def process_single_database(db_name_resolved, db_data, context_vars):
                     v_name = resolve_config_val(v_conf.get('name'), context_vars)
                     cols = v_conf.get('columns')
                 if v_name:
-                    try:
-                        if cols:
-                            cols_sql = sql.SQL(', ').join([sql.Identifier(c) for c in cols])
-                            cur.execute(sql.SQL("GRANT SELECT ({}) ON {} TO {};").format(cols_sql, parse_identifier(v_name), sql.Identifier(username)))
-                        else:
-                            cur.execute(sql.SQL("GRANT SELECT ON {} TO {};").format(parse_identifier(v_name), sql.Identifier(username)))
-                    except: pass
+                    if cols:
+                        cols_sql = sql.SQL(', ').join([sql.Identifier(c) for c in cols])
+                        plan.append(plan_grant(cur, sql.SQL("SELECT ({})").format(cols_sql), "", parse_identifier(v_name), v_name, username))
+                    else:
+                        plan.append(plan_grant(cur, sql.SQL("SELECT"), "", parse_identifier(v_name), v_name, username))
             if 'table' in perm:
                 t_conf = perm['table']
                 t_name = None
                 if isinstance(t_conf, str): t_name = resolve_config_val(t_conf, context_vars)
                 elif isinstance(t_conf, dict): t_name = resolve_config_val(t_conf.get('name'), context_vars)
                 if t_name:
-                    try: cur.execute(sql.SQL("GRANT SELECT ON {} TO {};").format(parse_identifier(t_name), sql.Identifier(username)))
-                    except: pass
+                    plan.append(plan_grant(cur, sql.SQL("SELECT"), "", parse_identifier(t_name), t_name, username))
             if 'function' in perm:
                 f_conf = perm['function']
                 f_name = None
                 if isinstance(f_conf, str): f_name = resolve_config_val(f_conf, context_vars)
                 elif isinstance(f_conf, dict): f_name = resolve_config_val(f_conf.get('name'), context_vars)
                 if f_name:
-                    try: cur.execute(sql.SQL("GRANT EXECUTE ON FUNCTION {} TO {};").format(parse_identifier(f_name), sql.Identifier(username)))
-                    except: pass
+                    plan.append(plan_grant(cur, sql.SQL("EXECUTE"), "FUNCTION", parse_identifier(f_name), f_name, username))
 
     for job in all_jobs:
         func_name_str = resolve_config_val(job['name'], context_vars)
         for consumer in job.get('allowed_consumers', []):
             resolved_user = resolve_config_val(consumer, context_vars)
-            try: cur.execute(sql.SQL("GRANT EXECUTE ON FUNCTION {} TO {};").format(parse_identifier(func_name_str), sql.Identifier(resolved_user)))
-            except: pass
+            plan.append(plan_grant(cur, sql.SQL("EXECUTE"), "FUNCTION", parse_identifier(func_name_str), func_name_str, resolved_user))
             
     for cf in all_custom_funcs:
         func_name_str = resolve_config_val(cf['name'], context_vars)
         for consumer in cf.get('allowed_consumers', []):
             resolved_user = resolve_config_val(consumer, context_vars)
-            try: cur.execute(sql.SQL("GRANT EXECUTE ON FUNCTION {} TO {};").format(parse_identifier(func_name_str), sql.Identifier(resolved_user)))
-            except: pass
+            plan.append(plan_grant(cur, sql.SQL("EXECUTE"), "FUNCTION", parse_identifier(func_name_str), func_name_str, resolved_user))
+            if cf.get('cache'):
+                plan.append(plan_grant(cur, sql.SQL("EXECUTE"), "FUNCTION", parse_identifier(f"{func_name_str}_invalidate"),
+                                       f"{func_name_str}_invalidate", resolved_user))
+
+    # سیاست کاربرانی که access_time آن‌ها از کانفیگ حذف شده پاک می‌شود تا Login Trigger دیگر آن‌ها را محدود نکند
+    plan.append(plan_item('access_policy', '__configured__', [(
+        "DELETE FROM auth_policies WHERE NOT (username = ANY(%s::text[]));", (sorted(policy_users),))],
+        depends_on=['auth_policies'], quiet=True,
+        cron=make_cron_entry('* * * * *', db_name_resolved, "SELECT terminate_expired_sessions();") if policy_users else None))
 
-    print("      🔗 Creating User Mappings...")
     for fdw_name in fdw_credentials:
-        try: 
-            cur.execute(sql.SQL("CREATE USER MAPPING FOR {} SERVER {} OPTIONS (username %s, password %s);").format(
-                sql.Identifier(DB_ADMIN_USER), sql.Identifier(fdw_name)), 
-                (fdw_credentials[fdw_name]['user'], fdw_credentials[fdw_name]['password']))
-        except psycopg2.errors.DuplicateObject: 
-            pass
+        for l_user in [DB_ADMIN_USER] + users_in_this_db:
+            plan.append(plan_item('user_mapping', f"{l_user}@{fdw_name}", [(
+                sql.SQL("CREATE USER MAPPING IF NOT EXISTS FOR {} SERVER {} OPTIONS (username %s, password %s);").format(
+                    sql.Identifier(l_user), sql.Identifier(fdw_name)),
+                (fdw_credentials[fdw_name]['user'], fdw_credentials[fdw_name]['password']))],
+                depends_on=[fdw_name]))
 
-        for l_user in users_in_this_db:
-            try: 
-                cur.execute(sql.SQL("CREATE USER MAPPING FOR {} SERVER {} OPTIONS (username %s, password %s);").format(
-                    sql.Identifier(l_user), sql.Identifier(fdw_name)), 
-                    (fdw_credentials[fdw_name]['user'], fdw_credentials[fdw_name]['password']))
-            except: pass
+    return plan
+
+def process_single_database(db_name_resolved, db_data, context_vars, force=False, transactional=False, refresh_snapshots=False):
+    # خروجی: cron_entries و errors (تعداد اشیای ناموفق و خطاهای کانفیگ همین دیتابیس)
+    print(f"\n   {'='*15} DATABASE: {db_name_resolved} {'='*15}")
+    PLAN_ERRORS.count = 0
+    
+    conn_admin = connect(DB_DEFAULT_NAME)
+    db_owner = DB_ADMIN_USER
+    for cfg in db_data['configs']:
+        if 'database' in cfg and 'owner' in cfg['database']:
+            db_owner = resolve_config_val(cfg['database']['owner'], context_vars)
+            break
+
+    try:
+        conn_admin.cursor().execute(sql.SQL("CREATE DATABASE {} OWNER {};").format(sql.Identifier(db_name_resolved), sql.Identifier(db_owner)))
+        print("      ✅ Database created.")
+    except psycopg2.errors.DuplicateDatabase:
+        print("      ℹ️  Database exists.")
+    except Exception as e:
+        print(f"      ❌ DB Error: {e}")
+        conn_admin.close()
+        return {'cron_entries': [], 'errors': 1}
+    finally:
+        conn_admin.close()
+
+    conn_db = connect(db_name_resolved)
+    cur = conn_db.cursor()
+
+    print("      🧩 Rendering plan...")
+    plan = plan_database(cur, db_name_resolved, db_data, context_vars, refresh_snapshots)
+    mode = "single transaction" if transactional else "autocommit"
+    print(f"      🚚 Applying {len(plan)} objects ({mode}{', forced' if force else ''})...")
+    errors = PLAN_ERRORS.count
+    try:
+        errors += apply_plan(conn_db, plan, force, transactional)['errors']
+    except Exception as e:
+        if transactional: conn_db.rollback()
+        print(f"      ❌ Apply Error (rolled back): {e}" if transactional else f"      ❌ Apply Error: {e}")
+        errors += 1
 
     conn_db.close()
     print(f"      ✅ Database {db_name_resolved} Processing Complete.")
+    return {'cron_entries': [item['cron'] for item in plan if item['cron']], 'errors': errors}
 
-def process_domain(domain_path):
-    parent_dir = domain_path.parent.name
-    current_dir = domain_path.name
-    context_vars = {'__parent__': parent_dir, '__current__': current_dir}
-    print(f"\n{'='*20} PROCESSING DOMAIN: {parent_dir}/{current_dir} {'='*20}")
-    db_configs_map = defaultdict(lambda: {"configs": [], "user_permissions": []})
-    for y_file in domain_path.glob("*.yaml"):
-        try:
-            with open(y_file, 'r') as f:
-                cfg = yaml.safe_load(f)
-                if not cfg: continue
-                if 'database' in cfg:
-                    db_name = resolve_config_val(cfg['database']['name'], context_vars)
-                    db_configs_map[db_name]['configs'].append(cfg)
-        except Exception as e:
-            print(f"      ❌ Error reading {y_file.name}: {e}")
-    users_path = domain_path / "users"
-    if not users_path.exists(): users_path = domain_path / "user"
-    if users_path.exists():
-        for u_file in users_path.glob("*.yaml"):
-            try:
-                with open(u_file, 'r') as f:
-                    user_cfg = yaml.safe_load(f)
-                    if not user_cfg: continue
-                    for grant in user_cfg.get('grants', []):
-                        target_db = resolve_config_val(grant.get('database'), context_vars)
-                        if target_db:
-                            user_data = {
-                                'username': resolve_config_val(user_cfg.get('username', user_cfg.get('name')), context_vars),
-                                'access_time': grant.get('access_time', user_cfg.get('access_time')),
-                                'permissions': grant.get('permissions', [])
-                            }
-                            db_configs_map[target_db]['user_permissions'].append(user_data)
-            except Exception as e:
-                print(f"      ❌ Error reading user file {u_file.name}: {e}")
-    for db_name, data in db_configs_map.items():
-        process_single_database(db_name, data, context_vars)
-
-def main():
-    print("🚀 Starting Modular Provisioning Engine...")
-    config_dir = Path("/app/configs/domains")
-    all_users = scan_and_collect_users(config_dir)
-    create_global_users(all_users)
+def collect_domain_databases(domain_path):
+    # کامپایل یک دامنه بدون کش (برای اسکریپت‌های کمکی مانند benchmark.py)
+    files = sorted(domain_path.glob("*.yaml")) + sorted(domain_path.glob("user*/*.yaml"))
+    domain = compile_domain(domain_path, load_config_documents(files))
+    for error in domain['errors']: print(f"      ❌ {error}")
+    return domain_tasks(domain)
+
+def discover_domains(config_dir):
+    domains = []
     if config_dir.exists():
         for project_folder in config_dir.iterdir():
             if project_folder.is_dir():
@@ -658,9 +2104,557 @@ def main():
                 if has_subfolders:
                     for domain_folder in project_folder.iterdir():
                         if domain_folder.is_dir() and domain_folder.name not in ['user', 'users']:
-                            process_domain(domain_folder)
+                            domains.append(domain_folder)
                 else:
-                    process_domain(project_folder)
-    print("\n🎉 ALL TASKS COMPLETED.")
+                    domains.append(project_folder)
+    return domains
+
+def find_config_entry(config_dir, sections, name):
+    # یافتن یک شیء (Job، ویو، جدول، ...) با نام Resolveشده در همه دامنه‌ها؛ برای اسکریپت‌های کلاینت (extract / export)
+    for domain_path in discover_domains(config_dir):
+        context_vars = {'__parent__': domain_path.parent.name, '__current__': domain_path.name}
+        for y_file in sorted(domain_path.glob("*.yaml")):
+            with open(y_file, 'r') as f:
+                cfg = yaml.safe_load(f) or {}
+            for section in sections:
+                for entry in cfg.get(section, []):
+                    if resolve_config_val(entry['name'], context_vars) == name:
+                        db_name = resolve_config_val(cfg.get('database', {}).get('name'), context_vars)
+                        return section, entry, db_name
+    return None, None, None
+
+# ==========================================
+# کامپایل کانفیگ و کش برنامه (Compiled Config)
+# ==========================================
+
+# کلیدهای الزامی هر بخش؛ ورودی ناقص پیش از رسیدن به SQL گزارش و کنار گذاشته می‌شود
+CONFIG_REQUIRED_KEYS = {
+    'schemas': ['name'],
+    'fdws': ['name', 'type', 'user', 'password'],
+    'tables': ['name', 'server'],
+    'views': ['name', 'sql'],
+    'materialized_views': ['name', 'sql', 'unique_key'],
+    'mirrors': ['name', 'source', 'primary_key', 'watermark_column'],
+    'period_snapshots': ['name', 'source', 'view'],
+    'incremental_jobs': ['name', 'target_table', 'key_column', 'key_type'],
+    'custom_functions': ['name'],
+}
+CONFIG_INTERVAL_KEYS = {
+    'materialized_views': 'refresh_interval',
+    'mirrors': 'sync_interval',
+    'period_snapshots': 'freeze_interval',
+}
+CONTEXT_VAR_PATTERN = re.compile(r'\$\{(__\w+__)\}')
+PLAN_CACHE_VERSION = 1
+
+def substitute_context(obj, context_vars):
+    # متغیرهای مسیر (__parent__، __current__) یک بار در زمان کامپایل جایگزین می‌شوند؛
+    # متغیرهای محیطی (رمزها) عمداً دست نمی‌خورند تا در فایل کش ذخیره نشوند
+    if isinstance(obj, str):
+        return CONTEXT_VAR_PATTERN.sub(lambda m: context_vars.get(m.group(1), m.group(0)), obj) if '${__' in obj else obj
+    if isinstance(obj, list): return [substitute_context(v, context_vars) for v in obj]
+    if isinstance(obj, dict): return {k: substitute_context(v, context_vars) for k, v in obj.items()}
+    return obj
+
+def validate_entries(cfg, source):
+    errors = []
+    for section, required in CONFIG_REQUIRED_KEYS.items():
+        entries = cfg.get(section) or []
+        if not isinstance(entries, list):
+            errors.append(f"{source}: '{section}' must be a list")
+            cfg[section] = []
+            continue
+        kept = []
+        for i, entry in enumerate(entries):
+            label = f"{source}: {section}[{i}]" + (f" {entry.get('name')}" if isinstance(entry, dict) and entry.get('name') else "")
+            if not isinstance(entry, dict):
+                errors.append(f"{label} must be a mapping"); continue
+            missing = [k for k in required if entry.get(k) in (None, '', [])]
+            if section == 'fdws' and entry.get('type') not in FDW_OPTION_TYPES:
+                errors.append(f"{label}: unknown fdw type '{entry.get('type')}' (use {', '.join(FDW_OPTION_TYPES)})"); continue
+            if section == 'tables':
+                if entry.get('type') == 'import':
+                    missing += [k for k in ('remote_schema', 'local_schema') if not entry.get(k)]
+                elif not entry.get('columns') or any(not isinstance(c, dict) or not c.get('name') or not c.get('type')
+                                                     for c in entry['columns']):
+                    missing.append('columns (name + type)')
+                if entry.get('type') == 'query':
+                    # پارامترها به صورت {{name}} در متن کوئری می‌آیند و مقدار هر کدام (default) یک عبارت T-SQL است
+                    params = entry.get('parameters') or []
+                    if not entry.get('query'):
+                        missing.append('query')
+                    elif any(k in entry for k in ('remote_schema', 'remote_table')):
+                        errors.append(f"{label}: query tables cannot also set remote_schema/remote_table"); continue
+                    elif any(not isinstance(p, dict) or not p.get('name') or p.get('default') is None for p in params):
+                        missing.append('parameters (name + default)')
+                    else:
+                        undeclared = set(QUERY_PARAM_PATTERN.findall(entry['query'])) - {p['name'] for p in params}
+                        if undeclared:
+                            errors.append(f"{label}: undeclared query parameters {', '.join(sorted(undeclared))}"); continue
+            if missing:
+                errors.append(f"{label}: missing {', '.join(missing)}"); continue
+            interval_key = CONFIG_INTERVAL_KEYS.get(section)
+            if interval_key and entry.get(interval_key) is not None:
+                try:
+                    interval_to_cron(entry[interval_key])
+                except ValueError as e:
+                    errors.append(f"{label}: {interval_key} {e}"); continue
+            kept.append(entry)
+        cfg[section] = kept
+    return errors
+
+def validate_references(configs, source):
+    # ارجاع‌های درون هر دیتابیس: سرور جداول باید در fdws همان دیتابیس تعریف شده باشد
+    errors = []
+    servers = {f['name'] for cfg in configs for f in cfg.get('fdws', [])}
+    for cfg in configs:
+        kept = []
+        for t in cfg.get('tables', []):
+            if t['server'] in servers: kept.append(t)
+            else: errors.append(f"{source}: table {t['name']} uses undefined server '{t['server']}'")
+        cfg['tables'] = kept
+    return errors
+
+def load_config_documents(files, cached_files=None):
+    # خروجی: {مسیر: (سند YAML یا None، mtime_ns، sha256)}؛ فایل با mtime و اندازه‌ی تغییرنکرده دوباره هش نمی‌شود
+    documents = {}
+    for path in files:
+        stat = path.stat()
+        cached = (cached_files or {}).get(str(path))
+        if cached and cached['mtime_ns'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            documents[path] = (None, stat.st_mtime_ns, stat.st_size, cached['sha256'])
+            continue
+        raw = path.read_bytes()
+        documents[path] = (raw, stat.st_mtime_ns, stat.st_size, hashlib.sha256(raw).hexdigest())
+    return documents
+
+def parse_document(documents, path, errors):
+    raw = documents[path][0]
+    if raw is None: raw = path.read_bytes()
+    try:
+        return yaml.safe_load(raw) or {}
+    except yaml.YAMLError as e:
+        errors.append(f"{path}: invalid YAML ({e})")
+        return {}
+
+def compile_domain(domain_path, documents):
+    context_vars = {'__parent__': domain_path.parent.name, '__current__': domain_path.name}
+    domain = {'path': str(domain_path), 'context_vars': context_vars, 'configs': [], 'grants': [], 'errors': []}
+    by_database = defaultdict(list)
+    for y_file in sorted(p for p in documents if p.parent == domain_path):
+        cfg = parse_document(documents, y_file, domain['errors'])
+        if 'database' not in cfg: continue
+        if not isinstance(cfg['database'], dict) or not cfg['database'].get('name'):
+            domain['errors'].append(f"{y_file}: database.name is required"); continue
+        cfg = substitute_context(cfg, context_vars)
+        domain['errors'] += validate_entries(cfg, y_file.name)
+        by_database[cfg['database']['name']].append(cfg)
+        domain['configs'].append(cfg)
+    for db_name, configs in by_database.items():
+        domain['errors'] += validate_references(configs, f"{domain_path.name}/{db_name}")
+
+    users_dir = domain_path / "users" if (domain_path / "users").exists() else domain_path / "user"
+    for u_file in sorted(p for p in documents if p.parent == users_dir):
+        user_cfg = substitute_context(parse_document(documents, u_file, domain['errors']), context_vars)
+        username = user_cfg.get('username', user_cfg.get('name'))
+        if not username: continue
+        for i, grant in enumerate(user_cfg.get('grants', [])):
+            if not grant.get('database'):
+                domain['errors'].append(f"{u_file.name}: grants[{i}] has no database"); continue
+            # resources در سطح کاربر پیش‌فرض همه‌ی grantهاست و resources هر grant آن را بازنویسی می‌کند
+            resources = {**(user_cfg.get('resources') or {}), **(grant.get('resources') or {})}
+            # تنظیمات PgBouncer نامعتبر خطای کانفیگ است و حذف می‌شود؛ خود grant (دسترسی‌ها) باقی می‌ماند
+            if 'pool_mode' in resources and resources['pool_mode'] not in POOL_MODES:
+                domain['errors'].append(f"{u_file.name}: grants[{i}] pool_mode '{resources.pop('pool_mode')}' "
+                                        f"(use {', '.join(POOL_MODES)})")
+            if 'pool_size' in resources and (not str(resources['pool_size']).isdigit() or int(resources['pool_size']) < 1):
+                domain['errors'].append(f"{u_file.name}: grants[{i}] pool_size '{resources.pop('pool_size')}' "
+                                        f"must be a positive integer")
+            domain['grants'].append({
+                'database': grant['database'],
+                'username': username,
+                'access_time': grant.get('access_time', user_cfg.get('access_time')),
+                'resources': resources,
+                'permissions': grant.get('permissions', []),
+            })
+    return domain
+
+def domain_tasks(domain):
+    context_vars = domain['context_vars']
+    print(f"\n{'='*20} LOADING DOMAIN: {context_vars['__parent__']}/{context_vars['__current__']} {'='*20}")
+    db_configs_map = defaultdict(lambda: {"configs": [], "user_permissions": []})
+    for cfg in domain['configs']:
+        db_configs_map[resolve_config_val(cfg['database']['name'], context_vars)]['configs'].append(cfg)
+    for grant in domain['grants']:
+        target_db = resolve_config_val(grant['database'], context_vars)
+        db_configs_map[target_db]['user_permissions'].append({
+            'username': resolve_config_val(grant['username'], context_vars),
+            'access_time': grant['access_time'],
+            'resources': grant.get('resources', {}),
+            'permissions': grant['permissions'],
+        })
+    for db_name in db_configs_map:
+        print(f"   📦 Database: {db_name}")
+    return [(db_name, data, context_vars) for db_name, data in db_configs_map.items()]
+
+def compile_config(config_dir, cache_file=None):
+    # کل درخت کانفیگ یک بار خوانده و اعتبارسنجی می‌شود؛ نتیجه با کلید mtime/هش فایل‌ها (و هش همین اسکریپت) کش می‌شود
+    files = sorted(config_dir.rglob("*.yaml"))
+    cache = {}
+    if cache_file and cache_file.exists():
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+    documents = load_config_documents(files, cache.get('files'))
+    key = hashlib.sha256(json.dumps([PLAN_CACHE_VERSION, hashlib.sha256(Path(__file__).read_bytes()).hexdigest(),
+                                     [(str(p), d[3]) for p, d in documents.items()]]).encode()).hexdigest()
+    if cache.get('key') == key:
+        print(f"🗂️  Using compiled config cache ({len(files)} files unchanged): {cache_file}")
+        return cache['compiled']
+
+    print(f"🧩 Compiling {len(files)} config file(s) from {config_dir}...")
+    compiled = {'users': [], 'domains': [], 'errors': []}
+    for domain_path in discover_domains(config_dir):
+        domain = compile_domain(domain_path, documents)
+        compiled['errors'] += domain.pop('errors')
+        compiled['domains'].append(domain)
+
+    seen_users = set()
+    for u_file in (p for p in documents if p.parent.name in ('users', 'user')):
+        user_cfg = parse_document(documents, u_file, compiled['errors'])
+        username = user_cfg.get('username', user_cfg.get('name'))
+        if username and username not in seen_users:
+            seen_users.add(username)
+            compiled['users'].append({'username': username, 'password': user_cfg.get('password')})
+
+    if cache_file:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_file.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump({'key': key, 'compiled': compiled,
+                           'files': {str(p): {'mtime_ns': d[1], 'size': d[2], 'sha256': d[3]} for p, d in documents.items()}}, f)
+            os.replace(tmp_path, cache_file)
+        except OSError as e:
+            print(f"   ⚠️ Could not write config cache {cache_file}: {e}")
+    return compiled
+
+def print_plan(compiled, tasks, refresh_snapshots=False):
+    # --plan: برنامه‌ی کامل بدون اتصال به دیتابیس چاپ می‌شود؛ رمزها ماسک می‌شوند
+    print("\n-- ===== ROLES =====")
+    for user in compiled['users']:
+        print(f"-- CREATE USER {render_offline(sql.Identifier(resolve_global_env(user['username'])))} WITH PASSWORD '********';")
+    for db_name, data, context_vars in tasks:
+        print(f"\n-- ===== DATABASE: {db_name} =====")
+        print(render_offline(sql.SQL("-- CREATE DATABASE {};").format(sql.Identifier(db_name))))
+        plan = plan_database(None, db_name, data, context_vars, refresh_snapshots)
+        for item in plan:
+            print(f"\n-- [{item['kind']}] {item['name']}" + (f" (after: {', '.join(item['depends_on'])})" if item['depends_on'] else ""))
+            for statement, params in item['statements']:
+                if item['kind'] == 'user_mapping': params = params[:-1] + ('********',)
+                print(render_offline(statement, params).strip())
+            if item['cron']: print(f"-- cron: {item['cron']}")
+
+# ==========================================
+# اجرای موازی دیتابیس‌ها
+# ==========================================
+
+class ThreadRoutedStdout:
+    # خروجی print هر Worker در بافر مخصوص همان Thread جمع می‌شود تا لاگ دیتابیس‌ها درهم نشود
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer or self.stream).write(data)
+
+    def flush(self):
+        buffer = getattr(self.local, 'buffer', None)
+        (buffer or self.stream).flush()
+
+def run_database_task(task, routed_stdout, force=False, transactional=False, refresh_snapshots=False):
+    db_name, data, context_vars = task
+    buffer = io.StringIO()
+    routed_stdout.local.buffer = buffer
+    started = time.monotonic()
+    result = {'database': db_name, 'domain': f"{context_vars.get('__parent__', '')}/{context_vars.get('__current__', '')}",
+              'status': 'ok', 'cron_entries': [], 'errors': 0}
+    try:
+        result.update(process_single_database(db_name, data, context_vars, force, transactional, refresh_snapshots))
+    except Exception as e:
+        print(f"      ❌ Provisioning aborted for {db_name}: {e}")
+        result.update({'status': 'failed', 'errors': getattr(PLAN_ERRORS, 'count', 0) + 1})
+    finally:
+        routed_stdout.local.buffer = None
+    result['seconds'] = time.monotonic() - started
+    result['output'] = buffer.getvalue()
+    if result['status'] == 'ok' and result['errors']:
+        result['status'] = 'errors'
+    return result
+
+def run_database_tasks(tasks, jobs, force=False, transactional=False, refresh_snapshots=False):
+    jobs = max(1, min(jobs, len(tasks) or 1))
+    print(f"\n⚡ Provisioning {len(tasks)} database(s) with {jobs} worker(s)...")
+    routed_stdout = ThreadRoutedStdout(sys.stdout)
+    sys.stdout = routed_stdout
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(run_database_task, task, routed_stdout, force, transactional, refresh_snapshots) for task in tasks]
+            for future in as_completed(futures):
+                result = future.result()
+                routed_stdout.stream.write(result['output'])
+                routed_stdout.stream.flush()
+                results.append(result)
+    finally:
+        sys.stdout = routed_stdout.stream
+    return results
+
+def print_summary(results, wall_seconds):
+    print(f"\n{'='*20} PROVISIONING SUMMARY {'='*20}")
+    width = max([len(r['database']) for r in results] + [8])
+    print(f"   {'DATABASE'.ljust(width)}  {'STATUS':<8}  {'ERRORS':>6}  {'TIME(s)':>8}")
+    for r in sorted(results, key=lambda r: r['seconds'], reverse=True):
+        print(f"   {r['database'].ljust(width)}  {r['status']:<8}  {r['errors']:>6}  {r['seconds']:>8.2f}")
+    print(f"   Wall time: {wall_seconds:.2f}s (sum of databases: {sum(r['seconds'] for r in results):.2f}s)")
+
+def record_provision_runs(results):
+    # مدت و وضعیت آخرین اجرا برای هر دیتابیس در دیتابیس پیش‌فرض ثبت می‌شود تا exporter آن را منتشر کند
+    try:
+        conn = connect(DB_DEFAULT_NAME)
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS provision_runs (
+                database_name VARCHAR(255) PRIMARY KEY,
+                domain VARCHAR(255),
+                status VARCHAR(16),
+                errors INTEGER,
+                seconds FLOAT8,
+                finished_at TIMESTAMPTZ DEFAULT now()
+            );
+        """)
+        for r in results:
+            cur.execute("""
+                INSERT INTO provision_runs (database_name, domain, status, errors, seconds, finished_at)
+                VALUES (%s, %s, %s, %s, %s, now())
+                ON CONFLICT (database_name) DO UPDATE SET domain = EXCLUDED.domain, status = EXCLUDED.status,
+                    errors = EXCLUDED.errors, seconds = EXCLUDED.seconds, finished_at = EXCLUDED.finished_at;
+            """, (r['database'], r['domain'], r['status'], r['errors'], r['seconds']))
+        conn.close()
+    except Exception as e:
+        print(f"⚠️ Could not record provisioning runs: {e}")
+
+# ==========================================
+# تولید تنظیمات PgBouncer (Connection Pooling)
+# ==========================================
+
+def render_pgbouncer_config(tasks):
+    # هر دیتابیس Provisionشده یک Pool در [databases] دارد (database.pool_size یا پیش‌فرض)؛
+    # سقف اتصال سمت سرور هر کاربر از resources.pool_size و حالت Pool از resources.pool_mode می‌آید
+    databases = {DB_DEFAULT_NAME: PGBOUNCER_DEFAULT_POOL_SIZE} if DB_DEFAULT_NAME else {}
+    users = {}
+    for db_name, data, context_vars in tasks:
+        pool_size = next((cfg['database'].get('pool_size') for cfg in data['configs'] if cfg['database'].get('pool_size')),
+                         PGBOUNCER_DEFAULT_POOL_SIZE)
+        databases[db_name] = int(pool_size)
+        for perm in data['user_permissions']:
+            resources = perm.get('resources') or {}
+            if not perm.get('username') or not any(k in resources for k in POOL_RESOURCE_KEYS): continue
+            user = users.setdefault(perm['username'], {})
+            if 'pool_mode' in resources: user['pool_mode'] = resources['pool_mode']
+            # یک کاربر در چند دیتابیس: بزرگ‌ترین سقف اعمال می‌شود (max_user_connections برای کل کاربر است)
+            if 'pool_size' in resources: user['pool_size'] = max(int(resources['pool_size']), user.get('pool_size', 0))
+
+    lines = [
+        ";; generated by provision.py from configs/domains - manual edits are overwritten",
+        "[databases]",
+    ]
+    for db_name, pool_size in sorted(databases.items()):
+        lines.append(f"{db_name} = host={PGBOUNCER_DB_HOST} port=5432 dbname={db_name} pool_size={pool_size}")
+    lines += ["", "[users]"]
+    for username, user in sorted(users.items()):
+        options = []
+        if 'pool_mode' in user: options.append(f"pool_mode={user['pool_mode']}")
+        if 'pool_size' in user: options.append(f"max_user_connections={user['pool_size']}")
+        # خط بدون گزینه (name = ) در [users] نامعتبر است
+        if not options: continue
+        lines.append(f"{username} = {' '.join(options)}")
+    lines += [
+        "",
+        "[pgbouncer]",
+        "listen_addr = 0.0.0.0",
+        "listen_port = 5432",
+        "auth_type = md5",
+        "auth_file = /etc/pgbouncer/userlist.txt",
+        # رمز سایر کاربران با auth_query از pg_shadow خوانده می‌شود؛ userlist فقط کاربر مدیر را دارد
+        f"auth_user = {DB_ADMIN_USER}",
+        f"auth_dbname = {DB_DEFAULT_NAME}",
+        "auth_query = SELECT usename, passwd FROM pg_shadow WHERE usename = $1",
+        f"admin_users = {DB_ADMIN_USER}",
+        f"pool_mode = {PGBOUNCER_POOL_MODE}",
+        f"default_pool_size = {PGBOUNCER_DEFAULT_POOL_SIZE}",
+        f"max_client_conn = {PGBOUNCER_MAX_CLIENT_CONN}",
+        "ignore_startup_parameters = extra_float_digits",
+    ]
+    return "\n".join(lines) + "\n"
+
+def write_pgbouncer_config(tasks, config_file=PGBOUNCER_CONFIG_FILE):
+    content = render_pgbouncer_config(tasks)
+    try:
+        if config_file.exists() and config_file.read_text() == content:
+            return
+        config_file.parent.mkdir(parents=True, exist_ok=True)
+        # بازنویسی درجا (بدون rename): فایل به صورت Bind Mount در کانتینر pgbouncer است و inode نباید عوض شود
+        with open(config_file, 'w') as f:
+            f.write(content)
+        print(f"🔌 PgBouncer pools written: {config_file}")
+    except OSError as e:
+        print(f"   ⚠️ Could not write PgBouncer config {config_file}: {e}")
+        return
+    try:
+        conn = psycopg2.connect(host=PGBOUNCER_HOST, port=5432, user=DB_ADMIN_USER, password=DB_ADMIN_PASS,
+                                dbname='pgbouncer', connect_timeout=3)
+        conn.autocommit = True
+        conn.cursor().execute("RELOAD;")
+        conn.close()
+        print("   ✅ PgBouncer reloaded.")
+    except Exception as e:
+        print(f"   ⚠️ PgBouncer reload skipped ({str(e).strip().splitlines()[0] if str(e).strip() else e})")
+
+# ==========================================
+# حالت Watch (اعمال تغییرات کانفیگ روی سرور در حال اجرا)
+# ==========================================
+
+def config_tree_state(config_dir):
+    state = {}
+    for path in config_dir.rglob("*.yaml"):
+        try:
+            stat = path.stat()
+            state[str(path)] = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            pass
+    return state
+
+def task_fingerprint(task):
+    db_name, data, context_vars = task
+    return hashlib.sha256(json.dumps([data, context_vars], sort_keys=True, default=str).encode()).hexdigest()
+
+def load_tasks(args):
+    compiled = compile_config(Path(args.config_dir), None if args.no_cache else Path(args.plan_cache))
+    for error in compiled['errors']:
+        print(f"   ❌ Config: {error}")
+    tasks = []
+    for domain in compiled['domains']:
+        tasks += domain_tasks(domain)
+    return compiled, tasks
+
+def provision_tasks(tasks, args, cron_by_db, force=False):
+    started = time.monotonic()
+    results = run_database_tasks(tasks, args.jobs, force, args.transactional, args.refresh_snapshots)
+    # بلوک Cron همیشه از مجموعه‌ی کامل دیتابیس‌ها بازنویسی می‌شود، نه فقط دیتابیس‌های این دور
+    for r in results:
+        cron_by_db[r['database']] = r['cron_entries']
+    install_cron_jobs([entry for entries in cron_by_db.values() for entry in entries])
+    record_provision_runs(results)
+    print_summary(results, time.monotonic() - started)
+    return results
+
+def watch_config(args, compiled, tasks, cron_by_db):
+    # Polling روی mtime/اندازه‌ی فایل‌ها (بدون وابستگی به inotify)؛ پس از آخرین تغییر، debounce ثانیه صبر می‌شود
+    # و فقط دیتابیس‌هایی که کانفیگ کامپایل‌شده‌ی آن‌ها عوض شده دوباره Provision می‌شوند
+    config_dir = Path(args.config_dir)
+    known = {task[0]: task_fingerprint(task) for task in tasks}
+    known_users = {u['username']: u for u in compiled['users']}
+    state = config_tree_state(config_dir)
+    changed_files = set()
+    last_change = None
+    print(f"\n👀 Watching {config_dir} (poll {args.watch_interval}s, debounce {args.watch_debounce}s)...")
+    while True:
+        time.sleep(args.watch_interval)
+        current = config_tree_state(config_dir)
+        if current != state:
+            changed_files |= {p for p in set(current) | set(state) if current.get(p) != state.get(p)}
+            state, last_change = current, time.monotonic()
+            continue
+        if not changed_files or time.monotonic() - last_change < args.watch_debounce:
+            continue
+
+        print(f"\n🔄 {len(changed_files)} config file(s) changed: {', '.join(sorted(Path(p).name for p in changed_files))}")
+        changed_files = set()
+        try:
+            compiled, tasks = load_tasks(args)
+        except Exception as e:
+            print(f"   ❌ Reload failed, keeping the running configuration: {e}")
+            continue
+
+        users = [u for u in compiled['users'] if known_users.get(u['username']) != u]
+        if users: create_global_users(users)
+        known_users = {u['username']: u for u in compiled['users']}
+
+        affected = [task for task in tasks if known.get(task[0]) != task_fingerprint(task)]
+        for db_name in sorted(set(known) - {task[0] for task in tasks}):
+            print(f"   🗑️  Database {db_name} removed from config (left on server)")
+            known.pop(db_name)
+            cron_by_db.pop(db_name, None)
+        write_pgbouncer_config(tasks)
+        if not affected:
+            print("   ℹ️  No database plan changed.")
+            continue
+        print(f"   🎯 Re-provisioning: {', '.join(task[0] for task in affected)}")
+        provision_tasks(affected, args, cron_by_db)
+        known.update({task[0]: task_fingerprint(task) for task in affected})
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Modular Provisioning Engine")
+    parser.add_argument('--jobs', '-j', type=int, default=PROVISION_JOBS,
+                        help="number of databases provisioned concurrently (env: PROVISION_JOBS)")
+    parser.add_argument('--force', action='store_true', default=PROVISION_FORCE,
+                        help="re-apply every object even if its fingerprint is unchanged (env: PROVISION_FORCE)")
+    parser.add_argument('--transactional', action='store_true', default=PROVISION_TRANSACTIONAL,
+                        help="apply each database's plan all-or-nothing in one transaction with batched statements; "
+                             "the first failing object rolls back the whole database (env: PROVISION_TRANSACTIONAL)")
+    parser.add_argument('--refresh-snapshots', action='store_true', default=PROVISION_REFRESH_SNAPSHOTS,
+                        help="re-query remote catalogs for type: import tables instead of using cached snapshots (env: PROVISION_REFRESH_SNAPSHOTS)")
+    parser.add_argument('--plan', action='store_true',
+                        help="print the rendered SQL of every database without connecting (dry run)")
+    parser.add_argument('--config-dir', default=CONFIG_DIR, help="domain configs directory (env: GATEWAY_CONFIG_DIR)")
+    parser.add_argument('--plan-cache', default=PLAN_CACHE_FILE,
+                        help="compiled config cache file (env: PROVISION_PLAN_CACHE)")
+    parser.add_argument('--no-cache', action='store_true', help="ignore and do not write the compiled config cache")
+    parser.add_argument('--watch', action='store_true',
+                        help="after provisioning, keep polling the config directory and re-provision changed databases")
+    parser.add_argument('--watch-interval', type=float, default=PROVISION_WATCH_INTERVAL,
+                        help="seconds between polls in --watch mode (env: PROVISION_WATCH_INTERVAL)")
+    parser.add_argument('--watch-debounce', type=float, default=PROVISION_WATCH_DEBOUNCE,
+                        help="quiet seconds after the last edit before re-provisioning (env: PROVISION_WATCH_DEBOUNCE)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['audit']:
+        # زیرفرمان ممیزی Push Down: provision.py audit [--baseline audit.json]
+        from audit import main as audit_main
+        return audit_main(argv[1:])
+    args = parse_args(argv)
+    print("🚀 Starting Modular Provisioning Engine...")
+    started = time.monotonic()
+    compiled, tasks = load_tasks(args)
+    if args.plan:
+        print_plan(compiled, tasks, args.refresh_snapshots)
+        return
+    # تنظیمات PgBouncer فقط به کانفیگ وابسته است و پیش از Provision نوشته می‌شود تا شروع pgbouncer منتظر کل اجرا نماند
+    write_pgbouncer_config(tasks)
+    create_global_users(compiled['users'])
+    cron_by_db = {}
+    provision_tasks(tasks, args, cron_by_db, args.force)
+    print(f"\n🎉 ALL TASKS COMPLETED in {time.monotonic() - started:.1f}s.")
+    if args.watch:
+        try:
+            watch_config(args, compiled, tasks, cron_by_db)
+        except KeyboardInterrupt:
+            print("\n👋 Watch stopped.")
 
 if __name__ == "__main__": main()
\ No newline at end of file